@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models.user import User
-from .models import Study, Series, Instance, PACSStudy, PACSSeries, PACSInstance
+from .models import Study, Series, Instance, PACSStudy, PACSSeries, PACSInstance, PACSIndexCheckpoint
 from django.contrib.admin.exceptions import AlreadyRegistered
 
 try:
@@ -15,3 +15,4 @@ admin.site.register(Instance)
 admin.site.register(PACSStudy)
 admin.site.register(PACSSeries)
 admin.site.register(PACSInstance)
+admin.site.register(PACSIndexCheckpoint)
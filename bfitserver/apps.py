@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class UploaderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bfitserver'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (registers model signal handlers)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django_rq import get_connection
+from rq.logutils import setup_loghandlers
+
+from bfitserver.models.analysis import Analysis
+from bfitserver.rqworker import AIWorkerPool
+from bfitserver.utils.scheduling import rq_queue_name
+
+
+class Command(BaseCommand):
+    """
+    Run a pool of AIWorkers on one analysis queue (interactive, then batch).
+
+    Example usage:
+    python manage.py aiworkerpool abd --num-workers 2
+    """
+
+    help = "Fork a pool of preloaded AIWorkers for an analysis queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue", choices=Analysis.Queue.values)
+        parser.add_argument(
+            "--num-workers", type=int, default=None,
+            help="Worker processes (default: ANALYSIS_WORKER_CONCURRENCY[queue])",
+        )
+        parser.add_argument("--burst", action="store_true", help="Exit once the queues are empty")
+
+    def handle(self, *args, **options):
+        queue = options["queue"]
+        num_workers = options["num_workers"] or settings.ANALYSIS_WORKER_CONCURRENCY.get(queue, 1)
+        if num_workers < 1:
+            raise CommandError("--num-workers must be at least 1")
+        logging_level = {0: "WARNING", 1: "INFO"}.get(options["verbosity"], "DEBUG")
+        setup_loghandlers(logging_level)
+
+        queue_names = [rq_queue_name(queue, p) for p in Analysis.Priority.values]
+        pool = AIWorkerPool(
+            queues=queue_names,
+            connection=get_connection(queue_names[0]),
+            num_workers=num_workers,
+        )
+        pool.start(burst=options["burst"], logging_level=logging_level)
@@ -0,0 +1,59 @@
+import time
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.management.base import BaseCommand
+from pydicom.errors import InvalidDicomError
+
+from bfitserver.models.dicomweb import Instance
+from bfitserver.utils.dicomweb import instance_fields
+
+
+class Command(BaseCommand):
+    """
+    Fill ``Instance.metadata`` and ``frame_number`` from the stored files.
+
+    Example usage:
+    python manage.py backfill_instance_metadata --batch-size 500
+
+    Instances stored by the upload form before it read headers have empty
+    metadata, so QIDO-RS attribute matching and WADO-RS metadata skip them.
+    Only those rows are read unless ``--all`` is given.
+    """
+
+    help = "Read the DICOM header of stored instances into metadata/frame_number"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Instances per bulk update")
+        parser.add_argument("--all", action="store_true", help="Re-read every instance")
+
+    def handle(self, *args, **options):
+        instances = Instance.objects.order_by("pk")
+        if not options["all"]:
+            instances = instances.filter(metadata={})
+        batch_size = options["batch_size"]
+        updated, failed, last_pk = 0, 0, 0
+        started = time.perf_counter()
+        while True:
+            # keyset batches: updated rows drop out of the metadata={} filter
+            batch = list(instances.filter(pk__gt=last_pk).only("pk", "file")[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            changed = []
+            for instance in batch:
+                try:
+                    fields = instance_fields(instance.file.path)
+                except (InvalidDicomError, OSError, ValueError, TypeError, SuspiciousFileOperation) as e:
+                    self.stderr.write(f"Skipped instance {instance.pk} ({instance.file.name}): {e}")
+                    failed += 1
+                    continue
+                instance.metadata = fields["metadata"]
+                instance.frame_number = fields["frame_number"]
+                changed.append(instance)
+            Instance.objects.bulk_update(changed, ["metadata", "frame_number"])
+            updated += len(changed)
+            self.stdout.write(f"Updated {updated} instances")
+        self.stdout.write(
+            f"Backfilled {updated} instances, {failed} unreadable, "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
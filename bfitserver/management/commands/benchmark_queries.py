@@ -0,0 +1,141 @@
+import statistics
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from bfitserver.models.analysis import Analysis
+from bfitserver.models.dicomweb import Instance, Series, Study
+from bfitserver.models.user import User
+
+BENCH_USER = "benchmark"
+BATCH_SIZE = 5000
+# never PROCESSING: the scheduler would admit seeded analyses as real jobs
+SEED_STATUSES = [
+    Analysis.Status.COMPLETED, Analysis.Status.FAILED, Analysis.Status.CANCELED,
+]
+
+
+class Command(BaseCommand):
+    """
+    Time the hot list/lookup queries, optionally on a seeded dataset.
+
+    Example usage:
+    python manage.py benchmark_queries --seed --instances 1000000 --explain
+
+    Seeded rows belong to the "benchmark" user (``--drop`` removes them); no
+    files are written, instances only get a file name. Seeding needs DEBUG or
+    ``--force``, and seeded analyses are all finished, so the scheduler
+    never picks them up.
+    """
+
+    help = "Seed a synthetic dataset and time the list/lookup queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", action="store_true", help="Seed the dataset first")
+        parser.add_argument("--instances", type=int, default=1_000_000)
+        parser.add_argument("--series-size", type=int, default=500, help="Instances per series")
+        parser.add_argument("--analyses-per-series", type=int, default=1)
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--explain", action="store_true", help="Print each query plan")
+        parser.add_argument("--drop", action="store_true", help="Delete the benchmark user's rows and exit")
+        parser.add_argument("--force", action="store_true", help="Allow --seed without DEBUG")
+
+    def handle(self, *args, **options):
+        if options["drop"]:
+            User.objects.filter(username=BENCH_USER).delete()
+            self.stdout.write("Benchmark data removed")
+            return
+        if options["seed"]:
+            if not (settings.DEBUG or options["force"]):
+                raise CommandError("Refusing to seed benchmark data without DEBUG; pass --force")
+            self.seed(options["instances"], options["series_size"], options["analyses_per_series"])
+
+        owner = User.objects.filter(username=BENCH_USER).first()
+        series = Series.objects.filter(owner=owner).order_by("created_at").last()
+        if series is None:
+            self.stderr.write("No benchmark data, run with --seed")
+            return
+
+        queries = {
+            "home series page": lambda: Series.objects.filter(owner=owner)
+                .values("series_id", "modality", "created_at", study_uid=F("study__study_id"))
+                .annotate(instances=Coalesce(Subquery(
+                    Instance.objects.filter(series=OuterRef("pk"))
+                    .order_by().values("series").annotate(n=Count("pk")).values("n")
+                ), 0))
+                .order_by("-created_at")[:51],
+            "series by UID": lambda: Series.objects.filter(series_id=series.series_id)[:1],
+            "instances of series": lambda: Instance.objects.filter(series=series)
+                .order_by("frame_number").values_list("file", flat=True),
+            "analysis list page": lambda: Analysis.objects.select_related("series", "series__study")
+                .order_by("-created_at", "-id")[:51],
+            "pending per queue": lambda: Analysis.objects.filter(
+                status=Analysis.Status.PROCESSING, queue=Analysis.Queue.ABDOMEN
+            ).values("id")[:100],
+        }
+        self.stdout.write(f"{'query':<24}{'median ms':>10}{'p95 ms':>10}{'rows':>8}")
+        for name, build in queries.items():
+            samples, rows = [], 0
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                rows = len(list(build()))
+                samples.append((time.perf_counter() - started) * 1000)
+            samples.sort()
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+            self.stdout.write(f"{name:<24}{statistics.median(samples):>10.2f}{p95:>10.2f}{rows:>8}")
+            if options["explain"]:
+                self.stdout.write(build().explain() + "\n")
+
+    def seed(self, instances: int, series_size: int, analyses_per_series: int):
+        owner, _ = User.objects.get_or_create(username=BENCH_USER)
+        n_series = max(1, instances // series_size)
+        now = timezone.now()
+        started = time.perf_counter()
+        with transaction.atomic():
+            studies = Study.objects.bulk_create(
+                [Study(study_id=f"2.25.{uuid.uuid4().int}", owner=owner) for _ in range(n_series)],
+                batch_size=BATCH_SIZE,
+            )
+            series = Series.objects.bulk_create(
+                [
+                    Series(series_id=f"2.25.{uuid.uuid4().int}", study=study, owner=owner,
+                           modality=Series.Modality.ABD, num_frames=series_size)
+                    for study in studies
+                ],
+                batch_size=BATCH_SIZE,
+            )
+            # auto_now_add stamps every row alike; spread them for realistic ordering
+            for idx, s in enumerate(series):
+                s.created_at = now - timedelta(minutes=idx)
+            Series.objects.bulk_update(series, ["created_at"], batch_size=BATCH_SIZE)
+            batch = []
+            for s in series:
+                for frame in range(series_size):
+                    batch.append(Instance(
+                        instance_id=f"2.25.{uuid.uuid4().int}", series=s, owner=owner,
+                        frame_number=frame, file=f"{BENCH_USER}/{s.pk}/{frame}.dcm",
+                    ))
+                    if len(batch) >= BATCH_SIZE:
+                        Instance.objects.bulk_create(batch)
+                        batch = []
+            Instance.objects.bulk_create(batch)
+            Analysis.objects.bulk_create(
+                [
+                    Analysis(id=str(uuid.uuid4()), queue=Analysis.Queue.ABDOMEN, series=s,
+                             owner=owner, status=SEED_STATUSES[(idx + n) % len(SEED_STATUSES)])
+                    for idx, s in enumerate(series)
+                    for n in range(analyses_per_series)
+                ],
+                batch_size=BATCH_SIZE,
+            )
+        self.stdout.write(
+            f"Seeded {n_series} series / {n_series * series_size} instances "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
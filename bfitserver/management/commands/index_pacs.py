@@ -0,0 +1,258 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+
+from dicom_sorter import match_rule
+from bfitserver.models.dicomweb import (
+    PACSIndexCheckpoint, PACSInstance, PACSSeries, PACSStudy,
+)
+
+# header fields read from each file; parsing stops after the last of them
+HEADER_TAGS = [
+    "SOPInstanceUID", "StudyDate", "ProtocolName", "PatientName", "PatientID",
+    "ScanOptions", "PixelBandwidth", "StudyInstanceUID", "SeriesInstanceUID",
+]
+FILES_PER_TASK = 64
+LOCATION_MAX_LENGTH = PACSInstance._meta.get_field("location").max_length
+
+
+def read_headers(paths: list[str], rules: list[dict]) -> list[tuple | None]:
+    """
+    Index fields of each file, run in the worker processes: (path, study,
+    series, instance, patient id, patient name, study date, tag), or None
+    for files that are not DICOM or whose series matches no rule.
+    """
+    rows = []
+    for path in paths:
+        try:
+            ds = dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+            tag = match_rule(
+                rules, ds.get("ProtocolName", ""), ds.get("ScanOptions", ""),
+                ds.get("PixelBandwidth", -1),
+            )
+            rows.append(tag and (
+                path, str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID),
+                str(ds.SOPInstanceUID), str(ds.get("PatientID", "")) or None,
+                str(ds.get("PatientName", "")) or None, str(ds.get("StudyDate", "")), tag,
+            ))
+        except (InvalidDicomError, AttributeError, EOFError, OSError, ValueError, TypeError):
+            rows.append(None)
+    return rows
+
+
+def changed_at(stat) -> float:
+    # ctime catches files copied with their mtime preserved (rsync -a, cp -p)
+    return max(stat.st_mtime, stat.st_ctime)
+
+
+def directories(root: str):
+    """Yield (directory, file entries) depth first, in sorted path order."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        yield directory, [e for e in entries if e.is_file(follow_symlinks=False)]
+        stack.extend(reversed([e.path for e in entries if e.is_dir(follow_symlinks=False)]))
+
+
+def count_frames(series_ids) -> None:
+    counts = (
+        PACSInstance.objects.filter(series=OuterRef("pk")).order_by()
+        .values("series").annotate(n=Count("pk")).values("n")
+    )
+    PACSSeries.objects.filter(pk__in=list(series_ids)).update(
+        num_frames=Coalesce(Subquery(counts), 0)
+    )
+
+
+def study_date(value: str):
+    try:
+        return datetime.strptime(value, "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+class Command(BaseCommand):
+    """
+    Index a mounted PACS export tree into PACSStudy/PACSSeries/PACSInstance.
+
+    Example usage:
+    python manage.py index_pacs /pacs-dicom --workers 16
+
+    Runs are incremental: only files changed since the last complete run
+    are read, and directories without new entries are not even stat'ed
+    file by file. An interrupted run resumes after the last directory it
+    stored. ``--full`` re-reads everything. Like the upload form, only
+    series matching a dicom_config.json rule (abd/thigh) are indexed.
+    Instances whose file is gone are dropped at the end of each run,
+    unless ``--no-prune`` is given.
+    """
+
+    help = "Crawl a PACS export tree and upsert the PACS index tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "root", nargs="?", default=PACSInstance._meta.get_field("location").path,
+        )
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Header reader processes")
+        parser.add_argument("--batch-size", type=int, default=5000,
+                            help="Instances per bulk upsert")
+        parser.add_argument("--full", action="store_true",
+                            help="Ignore the checkpoint and re-read every file")
+        parser.add_argument("--no-prune", action="store_true",
+                            help="Keep index rows of files removed from the tree")
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(options["root"])
+        if not os.path.isdir(root):
+            raise CommandError(f"{root} is not a directory")
+        with open(Path(settings.BASE_DIR) / "dicom_config.json") as f:
+            self.rules = json.load(f)["rules"]
+        self.batch_size = options["batch_size"]
+
+        self.checkpoint, _ = PACSIndexCheckpoint.objects.get_or_create(root=root)
+        if options["full"]:
+            self.checkpoint.indexed_until = 0
+            self.checkpoint.run_started = None
+        if self.checkpoint.run_started is None:
+            self.checkpoint.run_started = time.time()
+            self.checkpoint.resume_after = ""
+            self.checkpoint.save()
+        elif self.checkpoint.resume_after:
+            self.stdout.write(f"Resuming after {self.checkpoint.resume_after}")
+        since = self.checkpoint.indexed_until
+        resume = Path(self.checkpoint.resume_after).parts if self.checkpoint.resume_after else None
+
+        self.studies, self.series, self.instances = {}, {}, {}
+        self.done_directory = None
+        self.stats = dict(read=0, indexed=0, skipped=0, pruned=0)
+        started = time.perf_counter()
+
+        # forked readers must not share the parent's DB connections
+        connections.close_all()
+        workers = max(1, options["workers"])
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            inflight = deque()
+            for directory, files in directories(root):
+                relative = os.path.relpath(directory, root)
+                parts = () if relative == "." else Path(relative).parts
+                if resume is not None and parts <= resume:
+                    continue
+                paths = self.new_files(directory, files, since)
+                chunks = [paths[i:i + FILES_PER_TASK] for i in range(0, len(paths), FILES_PER_TASK)]
+                for i, chunk in enumerate(chunks):
+                    last = i == len(chunks) - 1
+                    inflight.append((relative if last else None, pool.submit(read_headers, chunk, self.rules)))
+                if not chunks:
+                    inflight.append((relative, None))
+                while len(inflight) > workers * 4:
+                    self.collect(*inflight.popleft())
+            while inflight:
+                self.collect(*inflight.popleft())
+        self.flush()
+        if not options["no_prune"]:
+            self.prune(root)
+
+        self.checkpoint.indexed_until = self.checkpoint.run_started
+        self.checkpoint.run_started = None
+        self.checkpoint.resume_after = ""
+        self.checkpoint.save()
+        self.stdout.write(
+            f"Read {self.stats['read']} files, indexed {self.stats['indexed']} instances, "
+            f"skipped {self.stats['skipped']}, pruned {self.stats['pruned']} "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+    def new_files(self, directory: str, files, since: float) -> list[str]:
+        try:
+            if since and changed_at(os.stat(directory)) < since:
+                return []   # no entry added, renamed or removed since
+        except OSError:
+            return []
+        paths = []
+        for entry in files:
+            try:
+                if since and changed_at(entry.stat(follow_symlinks=False)) < since:
+                    continue
+            except OSError:
+                continue
+            if len(entry.path) > LOCATION_MAX_LENGTH:
+                self.stderr.write(f"Path too long for the index, skipped: {entry.path}")
+                continue
+            paths.append(entry.path)
+        return paths
+
+    def collect(self, directory: str | None, future):
+        for row in future.result() if future is not None else []:
+            self.stats["read"] += 1
+            if row is None:
+                self.stats["skipped"] += 1
+                continue
+            path, study, series, instance, patient_id, patient_name, date, tag = row
+            self.studies[study] = PACSStudy(
+                study_id=study, patient_id=patient_id, patient_name=patient_name,
+                study_date=study_date(date),
+            )
+            self.series[series] = PACSSeries(series_id=series, study_id=study, modality=tag)
+            self.instances[instance] = PACSInstance(instance_id=instance, series_id=series, location=path)
+        if directory is not None:
+            self.done_directory = directory
+        if len(self.instances) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.instances:
+            with transaction.atomic():
+                PACSStudy.objects.bulk_create(
+                    self.studies.values(), update_conflicts=True, unique_fields=["study_id"],
+                    update_fields=["patient_id", "patient_name", "study_date"],
+                )
+                PACSSeries.objects.bulk_create(
+                    self.series.values(), update_conflicts=True, unique_fields=["series_id"],
+                    update_fields=["study", "modality"],
+                )
+                PACSInstance.objects.bulk_create(
+                    self.instances.values(), update_conflicts=True, unique_fields=["instance_id"],
+                    update_fields=["series", "location"],
+                )
+                count_frames(self.series)
+            self.stats["indexed"] += len(self.instances)
+            self.stdout.write(f"Indexed {self.stats['indexed']} instances (up to {self.done_directory})")
+            self.studies, self.series, self.instances = {}, {}, {}
+        if self.done_directory is not None and self.done_directory != ".":
+            self.checkpoint.resume_after = self.done_directory
+            self.checkpoint.save(update_fields=["resume_after", "updated_at"])
+
+    def prune(self, root: str):
+        """Drop the instances under ``root`` whose file no longer exists."""
+        rows = PACSInstance.objects.filter(location__startswith=os.path.join(root, ""))
+        gone, series = [], set()
+        for instance_id, series_id, location in (
+            rows.values_list("instance_id", "series_id", "location")
+            .iterator(chunk_size=self.batch_size)
+        ):
+            if not os.path.exists(location):
+                gone.append(instance_id)
+                series.add(series_id)
+        with transaction.atomic():
+            for start in range(0, len(gone), self.batch_size):
+                PACSInstance.objects.filter(pk__in=gone[start:start + self.batch_size]).delete()
+            count_frames(series)
+        self.stats["pruned"] = len(gone)
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-19 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0003_alter_analysis_id_alter_report_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='stage',
+            field=models.CharField(choices=[('queued', 'Queued'), ('conversion', 'Conversion'), ('windowing', 'Windowing'), ('inference', 'Inference'), ('post_processing', 'Post-processing'), ('seg_export', 'SEG export'), ('upload', 'Upload'), ('done', 'Done')], default='queued', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='stage_timings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
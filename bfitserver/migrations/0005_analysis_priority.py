@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-19 18:55
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def admit_existing(apps, schema_editor):
+    # jobs created before scheduling already went straight to RQ
+    Analysis = apps.get_model('bfitserver', 'Analysis')
+    Analysis.objects.update(admitted_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0004_analysis_stage_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='admitted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='priority',
+            field=models.CharField(choices=[('interactive', 'Interactive'), ('batch', 'Batch')], default='interactive', max_length=20),
+        ),
+        migrations.RunPython(admit_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-19 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0005_analysis_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='input_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='model_version',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
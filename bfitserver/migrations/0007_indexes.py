@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0006_analysis_input_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['-created_at'], name='analysis_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['status', 'queue'], name='analysis_status_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['series', 'frame_number'], name='instance_series_frame_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='series',
+            index=models.Index(fields=['owner', '-created_at'], name='series_owner_created_idx'),
+        ),
+    ]
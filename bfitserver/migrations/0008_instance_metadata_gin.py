@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:22
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0007_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='instance',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['metadata'], name='instance_metadata_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
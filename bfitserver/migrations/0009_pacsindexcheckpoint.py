@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0008_instance_metadata_gin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PACSIndexCheckpoint',
+            fields=[
+                ('root', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('indexed_until', models.FloatField(default=0)),
+                ('run_started', models.FloatField(blank=True, null=True)),
+                ('resume_after', models.TextField(blank=True, default='')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0009_pacsindexcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='pacs_series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='bfitserver.pacsseries'),
+        ),
+        migrations.AlterField(
+            model_name='analysis',
+            name='series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='bfitserver.series'),
+        ),
+        migrations.AddConstraint(
+            model_name='analysis',
+            constraint=models.CheckConstraint(condition=models.Q(('series__isnull', True), ('pacs_series__isnull', True), _connector='XOR'), name='analysis_one_series'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0010_analysis_pacs_series'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analysisartifact',
+            index=models.Index(fields=['analysis', 'updated_at'], name='artifact_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='predictionresult',
+            index=models.Index(fields=['analysis', 'updated_at'], name='prediction_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='segmentationresult',
+            index=models.Index(fields=['analysis', 'updated_at'], name='segmentation_updated_idx'),
+        ),
+    ]
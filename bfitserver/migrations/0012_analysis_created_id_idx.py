@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bfitserver', '0011_result_updated_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='analysis',
+            name='analysis_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['-created_at', '-id'], name='analysis_created_idx'),
+        ),
+    ]
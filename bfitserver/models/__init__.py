@@ -10,4 +10,5 @@ __all__ = [
     "PACSStudy",
     "PACSSeries",
     "PACSInstance",
+    "PACSIndexCheckpoint",
 ]
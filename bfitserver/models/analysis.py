@@ -1,7 +1,7 @@
 from django.db import models
 from pathlib import Path
 
-from .dicomweb import Study, Series
+from .dicomweb import Study, Series, PACSSeries
 from .user import User
 
 
@@ -20,9 +20,27 @@ class Analysis(models.Model):
         COMPLETED  = "completed",  "Completed"
         CANCELED   = "canceled",   "Canceled"
 
+    class Stage(models.TextChoices):
+        QUEUED          = "queued",          "Queued"
+        CONVERSION      = "conversion",      "Conversion"
+        WINDOWING       = "windowing",       "Windowing"
+        INFERENCE       = "inference",       "Inference"
+        POST_PROCESSING = "post_processing", "Post-processing"
+        SEG_EXPORT      = "seg_export",      "SEG export"
+        UPLOAD          = "upload",          "Upload"
+        DONE            = "done",            "Done"
+
+    class Priority(models.TextChoices):
+        INTERACTIVE = "interactive", "Interactive"
+        BATCH       = "batch",       "Batch"
+
     id           = models.CharField(max_length=128, primary_key=True)
     queue        = models.CharField(max_length=20, choices=Queue.choices)
-    series       = models.ForeignKey(Series, on_delete=models.CASCADE)
+    # an uploaded series, or a PACS-indexed one whose files are read in place
+    series       = models.ForeignKey(Series, null=True, blank=True, on_delete=models.CASCADE)
+    pacs_series  = models.ForeignKey(
+        PACSSeries, null=True, blank=True, on_delete=models.CASCADE
+    )
     status       = models.CharField(max_length=20, choices=Status.choices)
     created_at   = models.DateTimeField(auto_now_add=True)
     ended_at     = models.DateTimeField(auto_now=True)
@@ -30,15 +48,44 @@ class Analysis(models.Model):
     owner        = models.ForeignKey(
         User, related_name="analysis", on_delete=models.CASCADE
     )
+    # fine-grained progress, see utils/progress.py
+    stage         = models.CharField(
+        max_length=20, choices=Stage.choices, default=Stage.QUEUED
+    )
+    progress      = models.PositiveSmallIntegerField(default=0)
+    stage_timings = models.JSONField(default=dict, blank=True)
+    # scheduling, see utils/scheduling.py; admitted_at is set once the job is on RQ
+    priority      = models.CharField(
+        max_length=20, choices=Priority.choices, default=Priority.INTERACTIVE
+    )
+    admitted_at   = models.DateTimeField(null=True, blank=True)
+    # idempotent creation, see utils/idempotency.py
+    model_version = models.CharField(max_length=64, blank=True, default="")
+    input_hash    = models.CharField(max_length=64, blank=True, default="", db_index=True)
 
     class Meta:
         get_latest_by = "ended_at"
         constraints   = [
             models.UniqueConstraint(
                 fields=["id", "owner"], name="analysis_owner_uniq"
-            )
+            ),
+            models.CheckConstraint(
+                condition=models.Q(series__isnull=True) ^ models.Q(pacs_series__isnull=True),
+                name="analysis_one_series",
+            ),
+        ]
+        indexes = [
+            # list API, newest first (AnalysisCursorPagination)
+            models.Index(fields=["-created_at", "-id"], name="analysis_created_idx"),
+            # scheduler and queue metrics
+            models.Index(fields=["status", "queue"], name="analysis_status_queue_idx"),
         ]
 
+    @property
+    def input_series(self):
+        """The analysed ``Series`` or ``PACSSeries``."""
+        return self.series if self.series_id is not None else self.pacs_series
+
 
 # ----------------------------------------------------------------------
 # Prediction Result
@@ -51,6 +98,12 @@ class PredictionResult(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # latest change per analysis, for the API's conditional GETs
+        indexes = [
+            models.Index(fields=["analysis", "updated_at"], name="prediction_updated_idx"),
+        ]
+
 
 # ----------------------------------------------------------------------
 # Helpers for upload paths
@@ -82,6 +135,12 @@ class SegmentationResult(models.Model):
     created_at          = models.DateTimeField(auto_now_add=True)
     updated_at          = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # see PredictionResult
+        indexes = [
+            models.Index(fields=["analysis", "updated_at"], name="segmentation_updated_idx"),
+        ]
+
     def delete(self, *args, **kwargs):
         if self.segmentation_mask.storage.exists(self.segmentation_mask.name):
             self.segmentation_mask.delete(save=False)
@@ -102,6 +161,12 @@ class AnalysisArtifact(models.Model):
     created_at    = models.DateTimeField(auto_now_add=True)
     updated_at    = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # see PredictionResult
+        indexes = [
+            models.Index(fields=["analysis", "updated_at"], name="artifact_updated_idx"),
+        ]
+
     def delete(self, *args, **kwargs):
         if self.artifact.storage.exists(self.artifact.name):
             self.artifact.delete(save=False)
@@ -1,3 +1,4 @@
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 from .user import User
 
@@ -53,6 +54,10 @@ class Series(models.Model):
                 fields=["series_id", "owner"], name="series_id_owner_uniq"
             )
         ]
+        # lookups by series_id alone use the unique constraint's index
+        indexes = [
+            models.Index(fields=["owner", "-created_at"], name="series_owner_created_idx"),
+        ]
 
 
 def get_dicomweb_instance_upload_path(instance, filename):
@@ -75,6 +80,7 @@ def get_dicomweb_instance_upload_path(instance, filename):
 class Instance(models.Model):
     instance_id = models.CharField(max_length=64, db_column="SOP Instancce UID")
     series = models.ForeignKey(Series, on_delete=models.CASCADE)
+    # DICOM JSON of the instance without bulk data, matched by QIDO-RS
     metadata = models.JSONField(default=dict)
     frame_number = models.IntegerField(null=True)
     file = models.FileField(max_length=255, upload_to=get_dicomweb_instance_upload_path)
@@ -92,6 +98,11 @@ class Instance(models.Model):
                 fields=["instance_id", "owner"], name="instance_id_owner_uniq"
             )
         ]
+        indexes = [
+            models.Index(fields=["series", "frame_number"], name="instance_series_frame_idx"),
+            # jsonb containment (@>) for QIDO-RS attribute matching
+            GinIndex(fields=["metadata"], name="instance_metadata_gin", opclasses=["jsonb_path_ops"]),
+        ]
 
 
 class PACSStudy(models.Model):
@@ -116,3 +127,16 @@ class PACSInstance(models.Model):
     instance_id = models.CharField(primary_key=True, max_length=64, db_column="SOP Instancce UID")
     series = models.ForeignKey(PACSSeries, on_delete=models.CASCADE)
     location = models.FilePathField(path="/pacs-dicom", max_length=255)
+
+
+class PACSIndexCheckpoint(models.Model):
+    """Progress of ``manage.py index_pacs`` over one crawled PACS root."""
+
+    root = models.CharField(primary_key=True, max_length=255)
+    # change time (epoch seconds) up to which files are indexed
+    indexed_until = models.FloatField(default=0)
+    # start of an unfinished run, and the last directory it fully stored
+    run_started = models.FloatField(null=True, blank=True)
+    resume_after = models.TextField(blank=True, default="")
+    updated_at = models.DateTimeField(auto_now=True)
+
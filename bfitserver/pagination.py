@@ -0,0 +1,28 @@
+from rest_framework.pagination import CursorPagination
+
+
+class AnalysisCursorPagination(CursorPagination):
+    """
+    Stable cursor pages over the analysis list, newest first.
+
+    Unlike offset pages, a cursor page does not shift when new analyses are
+    enqueued while a client is polling. ``id`` breaks ties between analyses
+    created in the same microsecond, so no row is skipped or repeated.
+    """
+
+    ordering              = ("-created_at", "-id")
+    page_size             = 50
+    page_size_query_param = "page_size"
+    max_page_size         = 500
+
+
+class SeriesCursorPagination(CursorPagination):
+    """
+    Keyset pages over a user's series, newest first (served by the
+    (owner, -created_at) index). Used by the home page browser.
+    """
+
+    ordering              = "-created_at"
+    page_size             = 50
+    page_size_query_param = "page_size"
+    max_page_size         = 500
@@ -1,15 +1,26 @@
+import time
 import signal
 import logging
+import importlib
 import traceback
-from django_rq import get_connection
+import multiprocessing
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
 from rq.worker import SimpleWorker
-from rq.command import send_stop_job_command
-from rq.exceptions import InvalidJobOperation
+from rq.worker_pool import WorkerPool
 from .models.analysis import Analysis
+from .utils.events import publish_status
+from .utils import metrics, scheduling
+from . import tasks
 
 logger = logging.getLogger("rq.worker")
 
 
+class WorkerShutdown(Exception):
+    """Raised into a running job when its worker is shut down."""
+
+
 class AIWorker(SimpleWorker):
     """
     Custom RQ Worker class for handling worker shutdown.
@@ -18,30 +29,127 @@ class AIWorker(SimpleWorker):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._logger = logger
+        self._cancelled_job_id = None
         self._logger.info("Instantiating the AI Worker")
+        self._install_signal_handlers()
+
+    def _install_signal_handlers(self):
+        # work() re-installs handlers on start; keep ours instead of request_stop
         signal.signal(signal.SIGTERM, self.handle_shutdown)
         signal.signal(signal.SIGINT, self.handle_shutdown)
 
+    def kill_horse(self, sig=signal.SIGKILL):
+        # Jobs run in this process, there is no horse. RQ would otherwise signal
+        # our own process group, which in a pool includes every sibling worker.
+        if self.horse_pid:
+            return super().kill_horse(sig)
+        # abort the inference instead; its HTTP call then fails the job
+        job = self.get_current_job()
+        if job is not None:
+            self._cancelled_job_id = job.id
+            self.cancel_inference(job)
+
+    def cancel_inference(self, job):
+        self._logger.info(f"Cancelling inference of job {job.id}")
+        tasks.cancel_inference(scheduling.analysis_queue(job.origin), job.id)
+
+    def perform_job(self, job, queue):
+        """
+        Run the job, recording start/finish counters, duration and busy state,
+        then let the scheduler refill the queue.
+        """
+        metrics.JOBS_STARTED.labels(queue.name).inc()
+        busy = metrics.WORKERS_BUSY.labels(queue.name)
+        busy.inc()
+        started = time.perf_counter()
+        succeeded = False
+        try:
+            succeeded = super().perform_job(job, queue)
+            return succeeded
+        finally:
+            busy.dec()
+            if job.id == self._cancelled_job_id:
+                outcome = "cancelled"
+            else:
+                outcome = "succeeded" if succeeded else "failed"
+            metrics.job_finished(queue.name, outcome, time.perf_counter() - started)
+            # the slot is free again, admit the next pending analysis
+            try:
+                scheduling.dispatch(scheduling.analysis_queue(queue.name))
+            except Exception:
+                self._logger.error(traceback.format_exc())
+
+    def teardown(self):
+        super().teardown()
+        metrics.worker_exited()
+
     def handle_shutdown(self, signum, frame):
         """
         Handle worker shutdown.
+
+        A running job is marked canceled and interrupted, then the worker
+        stops (right away when idle, once the interrupted job has unwound
+        otherwise). A second signal forces the exit.
         """
         self._logger.info(f"Worker received signal {signum}, shutting down...")
         current_job = self.get_current_job()
         if current_job:
             try:
-                conn = get_connection(current_job.origin)
-                send_stop_job_command(conn, current_job.id)
+                self.cancel_inference(current_job)
                 self._logger.info(f"Terminated running job {current_job.id}")
+                self._cancelled_job_id = current_job.id
+                metrics.JOBS_CANCELLED.labels(current_job.origin).inc()
+                # .update() bypasses auto_now; bump ended_at so API ETags change
                 Analysis.objects.filter(id=current_job.id).update(
-                    status=Analysis.Status.CANCELED
-                )
-            except InvalidJobOperation:
-                self._logger.error(
-                    f"Failed to terminate job {current_job.id}, either it has finished execution or does not exist"
+                    status=Analysis.Status.CANCELED, ended_at=timezone.now()
                 )
+                for analysis in Analysis.objects.filter(id=current_job.id):
+                    publish_status(analysis)
             except Exception:
                 self._logger.warning(
                     f"Failed to handle termination of job {current_job.id}"
                 )
                 self._logger.error(traceback.format_exc())
+        self.request_stop(signum, frame)
+        if current_job:
+            raise WorkerShutdown(f"Worker shut down by signal {signum}")
+
+
+class AIWorkerPool(WorkerPool):
+    """
+    Pool of ``AIWorker`` processes forked from one preloaded parent.
+
+    The parent imports ``ANALYSIS_WORKER_PRELOAD`` (modules, or
+    ``module:callable`` hooks that load models) before forking, so every child
+    shares those pages copy-on-write instead of loading its own copy. Stopping
+    the pool sends each child SIGINT, which runs ``AIWorker.handle_shutdown``;
+    dead children are respawned while the pool is running.
+    """
+
+    def __init__(self, *args, preload=None, **kwargs):
+        kwargs.setdefault("worker_class", AIWorker)
+        super().__init__(*args, **kwargs)
+        self.preload_paths = settings.ANALYSIS_WORKER_PRELOAD if preload is None else preload
+
+    def preload(self):
+        for path in self.preload_paths:
+            module_name, _, hook = path.partition(":")
+            started = time.perf_counter()
+            module = importlib.import_module(module_name)
+            if hook:
+                getattr(module, hook)()
+            self.log.info("Preloaded %s in %.1fs", path, time.perf_counter() - started)
+
+    def get_worker_process(self, name, burst, _sleep=0, logging_level="INFO"):
+        process = super().get_worker_process(name, burst, _sleep, logging_level)
+        # children must fork() from the preloaded parent, whatever the platform default
+        return multiprocessing.get_context("fork").Process(
+            target=process._target, args=process._args, kwargs=process._kwargs,
+            name=process.name,
+        )
+
+    def start(self, burst=False, logging_level="INFO"):
+        self.preload()
+        # forked children must not share the parent's database sockets
+        connections.close_all()
+        super().start(burst=burst, logging_level=logging_level)
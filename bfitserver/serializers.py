@@ -1,8 +1,10 @@
+import json
 import logging
 import gzip
 import base64
 import numpy as np
 from pathlib import Path
+from django.urls import reverse
 from rest_framework import serializers
 from .models.user import User
 from .models.dicomweb import Study, Series, Instance, PACSSeries
@@ -15,6 +17,7 @@ from .models.analysis import (
     Report,
 )
 from nibabel import Nifti1Image
+from .utils import artifact_cache
 
 logger = logging.getLogger("apolloserver")
 
@@ -77,10 +80,11 @@ class PACSSeriesSerializer(serializers.ModelSerializer):
 
 # Analysis
 class AnalysisSerializer(serializers.ModelSerializer):
-    series = serializers.ReadOnlyField(source="series.series_id")
-    study = serializers.ReadOnlyField(source="series.study.study_id")
-    patient_name = serializers.ReadOnlyField(source="series.study.patient_name")
-    patient_id = serializers.ReadOnlyField(source="series.study.patient_id")
+    series = serializers.ReadOnlyField(source="input_series.series_id")
+    study = serializers.ReadOnlyField(source="input_series.study.study_id")
+    patient_name = serializers.ReadOnlyField(source="input_series.study.patient_name")
+    patient_id = serializers.ReadOnlyField(source="input_series.study.patient_id")
+    from_pacs = serializers.SerializerMethodField()
 
     class Meta:
         model = Analysis
@@ -90,12 +94,22 @@ class AnalysisSerializer(serializers.ModelSerializer):
             "study",
             "patient_name",
             "patient_id",
+            "from_pacs",
             "queue",
             "status",
+            "stage",
+            "progress",
+            "stage_timings",
+            "priority",
+            "admitted_at",
+            "model_version",
             "created_at",
             "ended_at",
         ]
 
+    def get_from_pacs(self, obj):
+        return obj.pacs_series_id is not None
+
 
 class PredictionResultSerializer(serializers.ModelSerializer):
     class Meta:
@@ -103,7 +117,15 @@ class PredictionResultSerializer(serializers.ModelSerializer):
         fields = ["prediction", "created_at", "updated_at"]
 
 
+def file_url(serializer, view_name, obj):
+    """Absolute URL of the streaming download endpoint for ``obj``."""
+    url = reverse(view_name, args=[obj.pk])
+    request = serializer.context.get("request")
+    return request.build_absolute_uri(url) if request else url
+
+
 class SegmentationResultSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
     base64_string = serializers.SerializerMethodField()
 
     class Meta:
@@ -115,10 +137,17 @@ class SegmentationResultSerializer(serializers.ModelSerializer):
             "updated_at",
             "is_custom",
             "prediction_overrides",
+            "url",
             "base64_string",
         ]
 
+    def get_url(self, obj):
+        return file_url(self, "segmentation-file", obj)
+
     def get_base64_string(self, obj):
+        # masks are fetched from `url`; inline payloads only on explicit request
+        if not self.context.get("include_base64"):
+            return None
         fp = obj.segmentation_mask.path
         ext = Path(fp).suffix
         if ext == ".gz":
@@ -132,18 +161,36 @@ class SegmentationResultSerializer(serializers.ModelSerializer):
 
 
 class AnalysisArtifactSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
     artifact = serializers.SerializerMethodField()
 
+    # small artifacts that are still decoded inline; everything else via `url`
+    INLINE_SUFFIXES = (".txt", ".json", ".png")
+
     class Meta:
         model = AnalysisArtifact
-        fields = ["artifact", "artifact_type", "created_at", "updated_at"]
+        fields = ["url", "artifact", "artifact_type", "created_at", "updated_at"]
+
+    def get_url(self, obj):
+        return file_url(self, "artifact-file", obj)
 
     def get_artifact(self, obj):
+        ext = Path(obj.artifact.name).suffix
+        if ext not in self.INLINE_SUFFIXES and not self.context.get("include_base64"):
+            return None
+        # decoding is pure CPU work on an immutable file, so memoize it per revision
+        return artifact_cache.get_decoded(obj, self.decode_artifact)
+
+    @staticmethod
+    def decode_artifact(obj):
         with open(obj.artifact.path, "rb") as f:
             ext = Path(f.name).suffix
             if ext == ".txt":
                 # return numpy arrays as JSON serializable lists
                 return np.loadtxt(f).tolist()
+            if ext == ".json":
+                # compact per-slice profiles etc. are passed through as-is
+                return json.load(f)
             if ext == ".png":
                 # return base64 encoded image with data header
                 return f"data:image/png;base64,{base64.b64encode(f.read()).decode('utf-8')}"
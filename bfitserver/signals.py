@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models.analysis import AnalysisArtifact
+from .utils import artifact_cache
+
+
+@receiver(post_save, sender=AnalysisArtifact)
+@receiver(post_delete, sender=AnalysisArtifact)
+def drop_decoded_artifact(sender, instance, **kwargs):
+    """Forget the cached decoded payload whenever an artifact changes."""
+    artifact_cache.invalidate(instance.pk)
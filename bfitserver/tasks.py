@@ -1,21 +1,267 @@
 """
-Very small placeholder tasks so that Django can import them.
-If you copy real RQ tasks into your project, simply remove this file.
+Analysis tasks: run a series through the inference service of its queue.
+
+A task uploads the series' DICOM files to ``AI_ENDPOINTS[queue]`` and returns
+the result in the shape ``utils.analysis.report_success`` stores – ``prediction``,
+``segmentation`` and ``artifact`` maps plus the service's ``stage_timings``.
+Jobs are bounded by ``ANALYSIS_JOB_TIMEOUT`` twice: RQ kills the work horse and
+the HTTP call times out. Outcomes are persisted by the ``on_success`` /
+``on_failure`` callbacks in ``ENQUEUE_OPTIONS``.
+
+Requests carry the analysis id as cancel token; ``cancel_inference`` asks the
+service to kill that request's predictor and drop its temp files, which makes
+the pending HTTP call return 409 so the job ends too. While the call is pending
+the worker polls ``/progress/<analysis id>`` every
+``ANALYSIS_PROGRESS_POLL_INTERVAL`` seconds and reports each stage the service
+enters (conversion, windowing, inference, ...).
+
+Failed requests return the outputs of finished stages, which are checkpointed
+(``utils/checkpoints.py``) and sent along on the retry ``utils/retry.py``
+schedules, so the service resumes after the last completed stage.
+
+``utils/scheduling.py`` puts the tasks on RQ; in ``ANALYSIS_LOCAL_MODE`` they
+run on ``utils/local_executor.py`` instead.
 """
-import logging, time
+import base64
+import csv
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import ExitStack
+from pathlib import Path
 from typing import List
+from urllib.parse import urljoin
+
+import requests
+from django.conf import settings
+from rq import get_current_job
+from rq.job import Callback
+
+from .models.analysis import Analysis
+from .utils import checkpoints
+from .utils.analysis import report_failure, report_success
+from .utils.log_filter import RateLimitLogFilter
+from .utils.progress import SERVICE_STAGES, STAGE_PROGRESS, report_stage
+
+logger = logging.getLogger("rq.worker")
+# polled every few seconds while a request runs: keep its repeats out of the log
+progress_logger = logging.getLogger("rq.worker.progress")
+progress_logger.addFilter(RateLimitLogFilter(interval=60, burst=5))
+
+# artifact_type of the service's per-slice volume profile (see views.profile)
+PROFILE_ARTIFACT_TYPE = "volume_profile"
+# header naming the cancel token of an inference request (utils/cancellation.py)
+CANCEL_HEADER = "X-Cancel-Token"
+
+ENQUEUE_OPTIONS = dict(
+    job_timeout=settings.ANALYSIS_JOB_TIMEOUT,
+    result_ttl=0,
+    failure_ttl=7 * 24 * 3600,
+    # storing results decodes and writes every returned file
+    on_success=Callback(report_success, timeout=300),
+    on_failure=Callback(report_failure, timeout=60),
+)
+
+
+class InferenceError(RuntimeError):
+    """The inference service rejected the request or returned no result."""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class InferenceCancelled(InferenceError):
+    """The analysis was canceled before or during inference."""
+
+
+def _analysis_id(analysis_id: str | None) -> str:
+    if analysis_id:
+        return analysis_id
+    job = get_current_job()
+    if job is None:
+        raise RuntimeError("analysis_id is required outside of an RQ job")
+    return job.id
+
+
+def _infer(queue: str, dicoms: List[str], analysis_id: str) -> dict:
+    """POST the DICOM files as multipart uploads and return the decoded response."""
+    endpoint = settings.AI_ENDPOINTS[queue]
+    analysis = Analysis.objects.select_related("owner").get(id=analysis_id)
+    if analysis.status == Analysis.Status.CANCELED:
+        raise InferenceCancelled(f"Analysis {analysis_id} was canceled")
+    first = Analysis.Stage.INFERENCE if queue == Analysis.Queue.MMAP else Analysis.Stage.CONVERSION
+    report_stage(first, analysis_id=analysis_id)
+    with ExitStack() as opened:
+        # handed over open, so requests reads each file once into the body
+        files = [
+            ("file", (f"I{idx}.dcm", opened.enter_context(open(path, "rb")), "application/dicom"))
+            for idx, path in enumerate(dicoms)
+        ]
+        resumed = checkpoints.upload_files(analysis)
+        logger.info(
+            "Sending %d DICOM and %d checkpoint files of %s to %s",
+            len(files), len(resumed), analysis_id, endpoint,
+        )
+        files += resumed
+        # the call runs on a thread; this one keeps the DB and RQ job context
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            pending = pool.submit(
+                requests.post,
+                endpoint,
+                files=files,
+                headers={CANCEL_HEADER: str(analysis_id)},
+                timeout=(settings.AI_CONNECT_TIMEOUT, settings.ANALYSIS_JOB_TIMEOUT),
+            )
+            response = _follow_progress(endpoint, analysis_id, pending, first)
+        finally:
+            # never wait for the call here, e.g. when RQ times the job out
+            pool.shutdown(wait=False)
+    if response.status_code == 409:
+        raise InferenceCancelled(f"{endpoint} cancelled analysis {analysis_id}")
+    if not response.ok:
+        try:
+            body = response.json()
+        except ValueError:
+            body = None   # not a JSON error body, e.g. from a proxy
+        if isinstance(body, dict):
+            checkpoints.save(analysis, body.get("checkpoints"))
+            detail = str(body.get("error"))
+        else:
+            detail = response.text
+        raise InferenceError(
+            f"{endpoint} returned {response.status_code}: {detail[:500]}",
+            retryable=response.status_code >= 500,
+        )
+    return response.json()
+
 
-logger = logging.getLogger("bfitserver")
+def _follow_progress(endpoint: str, analysis_id: str, pending, stage: str):
+    """Wait for the ``pending`` response, reporting the service's live stage."""
+    url = urljoin(endpoint, f"/progress/{analysis_id}")
+    while True:
+        try:
+            return pending.result(timeout=settings.ANALYSIS_PROGRESS_POLL_INTERVAL)
+        except FutureTimeout:
+            pass
+        try:
+            reply = requests.get(url, timeout=settings.AI_CONNECT_TIMEOUT)
+            current = reply.json().get("stage") if reply.ok else None
+        except (requests.RequestException, ValueError):
+            progress_logger.debug("No progress for %s from %s", analysis_id, url, exc_info=True)
+            continue
+        # forward only: a series of several volumes repeats the stages per volume
+        if current in SERVICE_STAGES and STAGE_PROGRESS[current] > STAGE_PROGRESS[stage]:
+            stage = current
+            report_stage(stage, analysis_id=analysis_id)
+
+
+def cancel_inference(queue: str, analysis_id: str) -> bool:
+    """Ask the inference service to abort the request of ``analysis_id``."""
+    url = urljoin(settings.AI_ENDPOINTS[queue], f"/cancel/{analysis_id}")
+    try:
+        response = requests.post(url, timeout=settings.AI_CONNECT_TIMEOUT)
+    except requests.RequestException:
+        logger.warning("Could not cancel inference of %s at %s", analysis_id, url, exc_info=True)
+        return False
+    if not response.ok:
+        logger.warning("%s returned %s", url, response.status_code)
+    return response.ok
+
+
+def _named(entries, tp: str) -> dict:
+    """``[{filename, b64_data}, ...]`` → ``{tp: (filename, b64), tp_1: ...}``."""
+    entries = [e for e in entries or [] if e and e.get("b64_data")]
+    return {
+        (tp if idx == 0 else f"{tp}_{idx}"): (e["filename"], e["b64_data"])
+        for idx, e in enumerate(entries)
+    }
+
+
+def _prediction(volume_csv: dict | None) -> dict:
+    """Tissue volumes (cc) and fat percentages from the service's volume_stats.csv."""
+    if not volume_csv or not volume_csv.get("b64_data"):
+        return {}
+    text = base64.b64decode(volume_csv["b64_data"]).decode("utf-8")
+    row = next(csv.DictReader(io.StringIO(text)), None)
+    if row is None:
+        return {}
+    prediction = {}
+    for column, value in row.items():
+        if column and column.endswith("_Volume") and column != "Total_Volume":
+            tissue = column.removesuffix("_Volume")
+            prediction[tissue] = {
+                "score": None,
+                "volume": float(value),
+                "percent": float(row.get(f"{tissue}_%") or 0),
+            }
+    if row.get("Total_Volume"):
+        prediction["total"] = {"volume": float(row["Total_Volume"])}
+    return prediction
+
+
+def segment_result(body: dict) -> dict:
+    """Map a ``/segment/*`` response onto the stored result shape."""
+    artifact = {
+        **_named([body.get("volume_csv")], "volume_csv"),
+        **_named([body.get("volume_profile")], PROFILE_ARTIFACT_TYPE),
+    }
+    for label, plot in (body.get("volume_plots") or {}).items():
+        artifact.update(_named([plot], f"plot_{label}"))
+    return {
+        "prediction": _prediction(body.get("volume_csv")),
+        "segmentation": {
+            **_named(body.get("segmented_nifti_files"), "nifti"),
+            **_named(body.get("segmented_dcm_files"), "dicom_seg"),
+        },
+        "artifact": artifact,
+        "stage_timings": body.get("stage_timings") or {},
+    }
+
+
+def musclemap_result(body: dict) -> dict:
+    """Map a ``/musclemap/*`` response onto the stored result shape."""
+    outputs = body.get("encoded_outputs") or []
+    masks = [o for o in outputs if o["filename"].endswith((".nii", ".nii.gz"))]
+    others = [o for o in outputs if o not in masks]
+    artifact = {}
+    for o in others:
+        artifact.update(_named([o], Path(o["filename"]).stem))
+    return {
+        "segmentation": _named(masks, "musclemap"),
+        "artifact": artifact,
+        "stage_timings": body.get("stage_timings") or {},
+    }
+
+
+def _run(queue: str, dicoms: List[str], analysis_id: str | None, to_result) -> dict:
+    analysis_id = _analysis_id(analysis_id)
+    if not dicoms:
+        raise InferenceError(f"Analysis {analysis_id} has no DICOM instances")
+    result = to_result(_infer(queue, dicoms, analysis_id))
+    if not result["segmentation"]:
+        raise InferenceError(f"{settings.AI_ENDPOINTS[queue]} returned no segmentation")
+    return result
 
-def _fake_worker(name: str, dicoms: List[str]):
-    logger.info("[%-5s] stub started  n=%d", name, len(dicoms))
-    time.sleep(2)                       # simulate work
-    logger.info("[%-5s] stub finished", name)
-    return {"status": "ok", "n_dicoms": len(dicoms)}
 
 # -------------------------------------------------------------------
-# public API expected by views.py
+# public API (RQ job functions, referenced by TASKS)
 # -------------------------------------------------------------------
-def segmentation_abdomen(dicoms: List[str]): return _fake_worker("ABD",   dicoms)
-def segmentation_thigh  (dicoms: List[str]): return _fake_worker("THIGH", dicoms)
-def segmentation_mmap   (dicoms: List[str]): return _fake_worker("MMAP",  dicoms)
+def segmentation_abdomen(dicoms: List[str], analysis_id: str | None = None):
+    return _run(Analysis.Queue.ABDOMEN, dicoms, analysis_id, segment_result)
+
+
+def segmentation_thigh(dicoms: List[str], analysis_id: str | None = None):
+    return _run(Analysis.Queue.THIGH, dicoms, analysis_id, segment_result)
+
+
+def segmentation_mmap(dicoms: List[str], analysis_id: str | None = None):
+    return _run(Analysis.Queue.MMAP, dicoms, analysis_id, musclemap_result)
+
+
+TASKS = {
+    Analysis.Queue.ABDOMEN: segmentation_abdomen,
+    Analysis.Queue.THIGH:   segmentation_thigh,
+    Analysis.Queue.MMAP:    segmentation_mmap,
+}
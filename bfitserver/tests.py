@@ -1,3 +1,404 @@
-from django.test import TestCase
+import io
+import json
+import tempfile
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.http import QueryDict
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+from rest_framework.test import APIClient
+
+from .models.analysis import Analysis
+from .models.dicomweb import Instance, PACSInstance, PACSSeries, PACSStudy, Series, Study
+from .models.user import User
+from .utils import dicomweb, idempotency, scheduling, stow
+
+
+def make_series(owner, series_id="1.2.3.1", study_id="1.2.3", modality=Series.Modality.ABD):
+    study, _ = Study.objects.get_or_create(study_id=study_id, owner=owner)
+    return Series.objects.create(series_id=series_id, study=study, owner=owner, modality=modality)
+
+
+def make_analysis(series, **fields):
+    fields.setdefault("queue", Analysis.Queue.ABDOMEN)
+    fields.setdefault("status", Analysis.Status.COMPLETED)
+    return Analysis.objects.create(id=str(uuid.uuid4()), series=series, owner=series.owner, **fields)
+
+
+class AnalysisConditionalGetTests(TestCase):
+    """ETag / Last-Modified revalidation and cursor pages of the analysis API."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create(username="admin")
+        self.series = make_series(self.owner)
+        self.analysis = make_analysis(self.series)
+
+    def test_list_if_none_match_returns_304_until_an_analysis_changes(self):
+        first = self.client.get("/api/analysis/")
+        self.assertEqual(first.status_code, 200)
+        etag = first["ETag"]
+
+        self.assertEqual(self.client.get("/api/analysis/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Analysis.objects.filter(pk=self.analysis.pk).update(
+            ended_at=timezone.now() + timedelta(seconds=5)
+        )
+        self.assertEqual(self.client.get("/api/analysis/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_new_analysis_changes_the_list_etag(self):
+        etag = self.client.get("/api/analysis/")["ETag"]
+        make_analysis(self.series)
+        self.assertNotEqual(self.client.get("/api/analysis/")["ETag"], etag)
+
+    def test_retrieve_if_modified_since_last_modified_returns_304(self):
+        url = f"/api/analysis/{self.analysis.pk}/"
+        last_modified = self.client.get(url)["Last-Modified"]
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        earlier = http_date(self.analysis.ended_at.timestamp() - 60)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=earlier).status_code, 200)
+
+    def test_cursor_pages_neither_skip_nor_repeat_equal_timestamps(self):
+        for _ in range(4):
+            make_analysis(self.series)
+        Analysis.objects.update(created_at=timezone.now())
+
+        seen, url = [], "/api/analysis/?page_size=2"
+        while url:
+            page = self.client.get(url).json()
+            seen += [row["id"] for row in page["results"]]
+            url = page["next"]
+        self.assertCountEqual(seen, Analysis.objects.values_list("id", flat=True))
+        self.assertEqual(len(seen), len(set(seen)))
+
+
+@override_settings(ANALYSIS_ADMISSION_LIMITS={"abd": 4})
+class SchedulingTests(TestCase):
+    """Admission order of pending analyses and what admission records."""
+
+    def setUp(self):
+        self.admin = User.objects.create(username="admin")
+        self.clinic = User.objects.create(username="clinic")
+        self.series = make_series(self.admin)
+
+    def pending(self, owner, priority):
+        analysis = make_analysis(
+            self.series, status=Analysis.Status.PROCESSING, priority=priority
+        )
+        Analysis.objects.filter(pk=analysis.pk).update(owner=owner)
+        return Analysis.objects.get(pk=analysis.pk)
+
+    def test_pick_takes_interactive_jobs_first(self):
+        batch = self.pending(self.admin, Analysis.Priority.BATCH)
+        interactive = self.pending(self.clinic, Analysis.Priority.INTERACTIVE)
+        self.assertEqual(scheduling.pick("abd", 1), [interactive])
+        self.assertEqual(scheduling.pick("abd", 5), [interactive, batch])
+
+    def test_pick_round_robins_batch_jobs_over_owners(self):
+        large = [self.pending(self.admin, Analysis.Priority.BATCH) for _ in range(4)]
+        small = [self.pending(self.clinic, Analysis.Priority.BATCH) for _ in range(2)]
+        self.assertEqual(scheduling.pick("abd", 4), [large[0], small[0], large[1], small[1]])
+
+    def test_pick_prefers_the_least_loaded_owner(self):
+        running = self.pending(self.admin, Analysis.Priority.BATCH)
+        Analysis.objects.filter(pk=running.pk).update(admitted_at=timezone.now())
+        waiting_admin = self.pending(self.admin, Analysis.Priority.BATCH)
+        waiting_clinic = self.pending(self.clinic, Analysis.Priority.BATCH)
+        self.assertEqual(scheduling.pick("abd", 1), [waiting_clinic])
+        self.assertEqual(scheduling.pick("abd", 2), [waiting_clinic, waiting_admin])
+
+    def test_admit_enqueues_on_the_priority_queue_and_stamps_admission(self):
+        analysis = self.pending(self.admin, Analysis.Priority.BATCH)
+        with mock.patch("django_rq.get_queue") as get_queue, \
+                mock.patch.object(scheduling, "publish_status"):
+            scheduling.admit(analysis)
+        get_queue.assert_called_once_with("abd-batch")
+        self.assertEqual(get_queue.return_value.enqueue.call_args.kwargs["job_id"], analysis.id)
+        analysis.refresh_from_db()
+        self.assertIsNotNone(analysis.admitted_at)
+        self.assertEqual(scheduling.pending("abd").count(), 0)
+        self.assertEqual(scheduling.in_flight("abd").count(), 1)
+
+
+@override_settings(ANALYSIS_LOCAL_MODE=False)
+class IdempotentCreateTests(TestCase):
+    """Input hashes and reuse of analyses with identical inputs."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create(username="admin")
+        self.series = make_series(self.owner)
+        for uid in ("1.2.3.1.2", "1.2.3.1.1"):
+            Instance.objects.create(
+                instance_id=uid, series=self.series, owner=self.owner, file=f"{uid}.dcm"
+            )
+        for patcher in (
+            mock.patch.object(scheduling, "dispatch"),
+            mock.patch("bfitserver.utils.events.publish_status"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create(self, query=""):
+        return self.client.post(
+            f"/api/analysis/?series_id={self.series.series_id}{query}", {}, format="json"
+        )
+
+    def test_input_hash_depends_on_every_input(self):
+        digest = idempotency.input_hash(self.series, "abd", "v1", {"a": 1, "b": 2})
+        self.assertEqual(digest, idempotency.input_hash(self.series, "abd", "v1", {"b": 2, "a": 1}))
+        self.assertNotEqual(digest, idempotency.input_hash(self.series, "abd", "v2", {"a": 1, "b": 2}))
+        self.assertNotEqual(digest, idempotency.input_hash(self.series, "abd", "v1", {"a": 1}))
+        Instance.objects.create(
+            instance_id="1.2.3.1.3", series=self.series, owner=self.owner, file="1.2.3.1.3.dcm"
+        )
+        self.assertNotEqual(digest, idempotency.input_hash(self.series, "abd", "v1", {"a": 1, "b": 2}))
+
+    def test_input_hash_of_a_pacs_series_uses_its_instances(self):
+        study = PACSStudy.objects.create(study_id="1.2.3")
+        pacs = PACSSeries.objects.create(series_id="1.2.3.1", study=study, modality="abd")
+        for uid in ("1.2.3.1.1", "1.2.3.1.2"):
+            PACSInstance.objects.create(instance_id=uid, series=pacs, location=f"/pacs-dicom/{uid}")
+        self.assertEqual(
+            idempotency.input_hash(pacs, "abd", "v1", None),
+            idempotency.input_hash(self.series, "abd", "v1", None),
+        )
+
+    def test_identical_request_reuses_the_processing_analysis(self):
+        first = self.create()
+        self.assertEqual(first.status_code, 201)
+        second = self.create()
+        self.assertEqual(second.status_code, 200)
+        self.assertTrue(second.json()["reused"])
+        self.assertEqual(second.json()["job_id"], first.json()["job_id"])
+        self.assertEqual(Analysis.objects.count(), 1)
+
+    def test_failed_analysis_and_force_start_new_runs(self):
+        first = self.create().json()["job_id"]
+        self.assertEqual(self.create("&force=1").status_code, 201)
+        Analysis.objects.update(status=Analysis.Status.FAILED)
+        again = self.create()
+        self.assertEqual(again.status_code, 201)
+        self.assertNotEqual(again.json()["job_id"], first)
+        self.assertEqual(Analysis.objects.count(), 3)
+
+
+class QidoQueryTests(SimpleTestCase):
+    """Parsing of QIDO-RS query strings."""
+
+    def query(self, string, level=dicomweb.STUDY):
+        return dicomweb.Query(QueryDict(string), level)
+
+    def test_resolve_keyword_and_hex_tag(self):
+        self.assertEqual(dicomweb.resolve("PatientID"), ("PatientID", "00100020", "LO"))
+        self.assertEqual(dicomweb.resolve("0020000d"), ("StudyInstanceUID", "0020000D", "UI"))
+        for key in ("PatientNme", "7FE1FFFF"):
+            with self.assertRaises(dicomweb.QueryError):
+                dicomweb.resolve(key)
+
+    def test_matches_and_returned_attributes(self):
+        query = self.query("PatientID=P1&00100010=&limit=5&offset=10")
+        self.assertEqual(query.matches, [("PatientID", "00100020", "LO", "P1")])
+        self.assertIn("00100010", query.tags)
+        self.assertEqual((query.limit, query.offset), (5, 10))
+        self.assertIsNone(self.query("includefield=all").tags)
+
+    def test_non_attribute_parameters_are_ignored(self):
+        query = self.query("_=1700000000000&callback=cb&PatientID=P1")
+        self.assertEqual([m[0] for m in query.matches], ["PatientID"])
+
+    def test_unknown_attribute_is_rejected(self):
+        with self.assertRaises(dicomweb.QueryError):
+            self.query("PatientNme=P1")
+
+    def test_repeated_attribute_is_rejected(self):
+        with self.assertRaises(dicomweb.QueryError):
+            self.query("PatientID=P1&PatientID=P2")
+        self.assertEqual(len(self.query("StudyInstanceUID=1.2,1.3").conditions()), 1)
+
+    def test_invalid_values(self):
+        for string in ("StudyDate=2024-13-01", "InstanceNumber=x", "limit=-1", "offset=a"):
+            with self.subTest(string), self.assertRaises(dicomweb.QueryError):
+                self.query(string, dicomweb.INSTANCE).conditions()
+
+
+class QidoEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        User.objects.create(username="admin")
+
+    def test_cache_buster_is_accepted_and_unknown_attribute_is_400(self):
+        self.assertEqual(self.client.get("/dicomweb/studies?_=1700000000000").status_code, 204)
+        response = self.client.get("/dicomweb/studies?PatientNme=P1")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("PatientNme", response.json()["error"])
+
+
+def dicom_bytes(study_uid, series_uid, sop_uid=None, matches_rule=True):
+    ds = dcmread(get_testdata_file("CT_small.dcm"))
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = study_uid, series_uid
+    ds.SOPInstanceUID = sop_uid or generate_uid()
+    if matches_rule:   # the abd rule of dicom_config.json
+        ds.ProtocolName, ds.ScanOptions, ds.PixelBandwidth = "t1_vibe_tra_p2_bh_dixon abd", "DIXF", 849
+    out = io.BytesIO()
+    ds.save_as(out, enforce_file_format=True)
+    return out.getvalue()
+
+
+def multipart(parts, boundary=b"XbOuNdArY"):
+    return b"preamble\r\n" + b"".join(
+        b"--" + boundary + b"\r\nContent-Type: application/dicom\r\n\r\n" + part + b"\r\n"
+        for part in parts
+    ) + b"--" + boundary + b"--\r\n"
+
+
+class StowParserTests(SimpleTestCase):
+    """Parsing of STOW-RS multipart/related bodies."""
+
+    def test_boundary(self):
+        self.assertEqual(
+            stow.boundary('multipart/related; type="application/dicom"; boundary="a b"'), b"a b"
+        )
+        for content_type, status in (
+            ("application/dicom", 415),
+            ('multipart/related; type="application/json"; boundary=a', 415),
+            ("multipart/related", 400),
+        ):
+            with self.subTest(content_type), self.assertRaises(stow.StoreError) as raised:
+                stow.boundary(content_type)
+            self.assertEqual(raised.exception.status, status)
+
+    def test_parts_split_across_small_reads(self):
+        body = b"--b\r\nContent-Type: application/dicom\r\n\r\nfirst\r\n--b\r\n"
+        body += b"X-Other: 1\r\n\r\nsecond part\r\n--b--\r\n"
+        with mock.patch.object(stow, "CHUNK_SIZE", 3):
+            parts = [
+                (headers, b"".join(chunks)) for headers, chunks in stow.iter_parts(io.BytesIO(body), b"b")
+            ]
+        self.assertEqual(parts, [
+            ({"content-type": "application/dicom"}, b"first"),
+            ({"x-other": "1"}, b"second part"),
+        ])
+
+    def test_truncated_bodies(self):
+        for body in (b"no delimiter", b"--b\r\nContent-Type: x", b"--b\r\n\r\nunterminated"):
+            with self.subTest(body), self.assertRaises(stow.StoreError):
+                for _, chunks in stow.iter_parts(io.BytesIO(body), b"b"):
+                    b"".join(chunks)
+
+
+class StowEndpointTests(TestCase):
+    """Storing instances with STOW-RS, and the failures it reports."""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = Path(media.name)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.client = APIClient()
+        User.objects.create(username="admin")
+        self.study, self.series = generate_uid(), generate_uid()
+
+    def store(self, parts, study=None):
+        url = "/dicomweb/studies" + (f"/{study}" if study else "")
+        response = self.client.generic(
+            "POST", url, multipart(parts),
+            content_type='multipart/related; type="application/dicom"; boundary=XbOuNdArY',
+        )
+        return response.status_code, json.loads(response.content)
+
+    def failures(self, result):
+        return [f["00081197"]["Value"][0] for f in result.get("00081198", {}).get("Value", [])]
+
+    def test_stores_instances_and_replaces_resent_ones(self):
+        sop = generate_uid()
+        parts = [dicom_bytes(self.study, self.series, sop), dicom_bytes(self.study, self.series)]
+        resent = dicom_bytes(self.study, self.series, sop)
+        status, result = self.store(parts + [resent], self.study)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(result["00081199"]["Value"]), 3)
+        self.assertEqual(Instance.objects.count(), 2)
+        stored = Instance.objects.get(instance_id=sop)
+        self.assertEqual(Path(stored.file.path).read_bytes(), resent)
+        self.assertEqual(stored.metadata["0020000D"]["Value"], [self.study])
+        self.assertEqual(list((self.media / "admin" / "stow").iterdir()), [])
+
+    def test_partial_failure_reports_each_failed_part(self):
+        status, result = self.store([
+            dicom_bytes(self.study, self.series),
+            dicom_bytes(self.study, generate_uid(), matches_rule=False),
+            b"not dicom at all",
+            dicom_bytes("1.2.3", self.series),
+        ], self.study)
+        self.assertEqual(status, 202)
+        self.assertEqual(len(result["00081199"]["Value"]), 1)
+        self.assertEqual(
+            self.failures(result),
+            [stow.PROCESSING_FAILURE, stow.CANNOT_UNDERSTAND, stow.CANNOT_UNDERSTAND],
+        )
+
+    def test_invalid_uids_are_rejected_before_anything_is_stored(self):
+        traversal = "../../../../escaped"
+        status, result = self.store([
+            dicom_bytes(self.study, self.series, sop_uid=traversal),
+            dicom_bytes(traversal, self.series),
+            dicom_bytes(self.study, "1.2.840." + "1" * 60),
+            dicom_bytes(self.study, self.series, sop_uid="1.2.3.abc"),
+        ])
+        self.assertEqual(status, 409)
+        self.assertEqual(self.failures(result), [stow.CANNOT_UNDERSTAND] * 4)
+        self.assertFalse(Instance.objects.exists())
+        self.assertFalse(Study.objects.exists())
+        self.assertEqual([p for p in self.media.rglob("*") if p.is_file()], [])
+        self.assertFalse(any(self.media.parent.glob("escaped*")))
+
+    def test_unparseable_body_is_400(self):
+        response = self.client.generic(
+            "POST", "/dicomweb/studies", b"--a\r\nContent-Type: application/dicom\r\n\r\nabc",
+            content_type="multipart/related; boundary=a",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class IndexPacsTests(TransactionTestCase):
+    """``manage.py index_pacs`` keeps the index in step with the tree."""
+
+    def setUp(self):
+        tree = tempfile.TemporaryDirectory()
+        self.addCleanup(tree.cleanup)
+        self.root = Path(tree.name)
+        self.study, self.series = generate_uid(), generate_uid()
+        self.files = []
+        for idx in range(3):
+            path = self.root / "study" / f"I{idx}.dcm"
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(dicom_bytes(self.study, self.series))
+            self.files.append(path)
+
+    def index(self, *args):
+        call_command("index_pacs", str(self.root), "--workers", "1", *args, stdout=io.StringIO())
+
+    def test_removed_files_are_pruned(self):
+        self.index()
+        self.assertEqual(PACSSeries.objects.get(pk=self.series).num_frames, 3)
+
+        self.files[0].unlink()
+        self.index("--no-prune")
+        self.assertEqual(PACSInstance.objects.count(), 3)
+        self.index()
+        self.assertEqual(
+            sorted(PACSInstance.objects.values_list("location", flat=True)),
+            [str(p) for p in self.files[1:]],
+        )
+        self.assertEqual(PACSSeries.objects.get(pk=self.series).num_frames, 2)
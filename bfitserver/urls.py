@@ -1,6 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import home, upload_dicom_folder, AnalysisViewSet
+from .views import (
+    home, upload_dicom_folder, segmentation_file, artifact_file, analysis_events,
+    prometheus_metrics, AnalysisViewSet, qido_series, qido_instances,
+    wado_retrieve, wado_metadata, wado_frames, wado_bulkdata, wado_rendered, dicomweb_studies,
+)
 
 router = DefaultRouter()
 router.register(r"analysis", AnalysisViewSet, basename="analysis")
@@ -8,5 +12,36 @@ router.register(r"analysis", AnalysisViewSet, basename="analysis")
 urlpatterns = [
     path("",          home,                  name="home"),     #  GET /
     path("upload/",   upload_dicom_folder,   name="upload"),   #  GET+POST /upload/
+    path("api/segmentations/<int:pk>/file/", segmentation_file, name="segmentation-file"),
+    path("api/artifacts/<int:pk>/file/",     artifact_file,     name="artifact-file"),
+    path("api/analysis/events/", analysis_events, name="analysis-events"),
+    path("metrics/",  prometheus_metrics,    name="metrics"),  #  GET /metrics/ (Prometheus)
     path("api/",      include(router.urls)),                  #  /api/analysis/...
+    # DICOMweb QIDO-RS
+    path("dicomweb/studies",   dicomweb_studies, name="dicomweb-studies"),   # + STOW-RS
+    path("dicomweb/series",    qido_series,    name="dicomweb-series"),
+    path("dicomweb/instances", qido_instances, name="dicomweb-instances"),
+    path("dicomweb/studies/<str:study>/series",    qido_series,    name="dicomweb-study-series"),
+    path("dicomweb/studies/<str:study>/instances", qido_instances, name="dicomweb-study-instances"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances",
+         qido_instances, name="dicomweb-series-instances"),
+    # DICOMweb WADO-RS
+    path("dicomweb/studies/<str:study>",          dicomweb_studies, name="dicomweb-study"),   # + STOW-RS
+    path("dicomweb/studies/<str:study>/metadata", wado_metadata, name="dicomweb-study-metadata"),
+    path("dicomweb/studies/<str:study>/series/<str:series>",
+         wado_retrieve, name="dicomweb-study-series-retrieve"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/metadata",
+         wado_metadata, name="dicomweb-series-metadata"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances/<str:instance>",
+         wado_retrieve, name="dicomweb-instance"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances/<str:instance>/metadata",
+         wado_metadata, name="dicomweb-instance-metadata"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances/<str:instance>/rendered",
+         wado_rendered, name="dicomweb-instance-rendered"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances/<str:instance>/frames/<str:frames>",
+         wado_frames, name="dicomweb-frames"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances/<str:instance>/frames/<str:frames>/rendered",
+         wado_rendered, name="dicomweb-frames-rendered"),
+    path("dicomweb/studies/<str:study>/series/<str:series>/instances/<str:instance>/bulkdata/<str:tag>",
+         wado_bulkdata, name="dicomweb-bulkdata"),
 ]
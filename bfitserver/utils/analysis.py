@@ -1,209 +1,196 @@
-# import os
-# import time
-# import logging
-# import requests
-# import json
-# import base64
-# from django_rq import job
-# from django.core.files.base import ContentFile
-# from ..models.analysis import (
-#     Analysis,
-#     PredictionResult,
-#     SegmentationResult,
-#     AnalysisArtifact,
-# )
-# from .log_filter import TruncateLogFilter
-
-# AI_ABD_ENDPOINT = os.environ["AI_ABD_ENDPOINT"]
-# AI_THIGH_ENDPOINT = os.environ["AI_THIGH_ENDPOINT"]
-# AI_MMAP_ENDPOINT = os.environ["AI_MMAP_ENDPOINT"]
-
-# logger = logging.getLogger("rq.worker")
-# logger.addFilter(TruncateLogFilter(max_length=500))
-
-
-# def report_success(job, connection, result, *args, **kwargs):
-#     """
-#     Specifies the on success callback function to be called
-#     when RQ job is executed successfully. Callbacks are limited
-#     to 60s runtime.
-#     """
-#     try:
-#         logger.info(f"Executing success callback")
-#         analysis = Analysis.objects.get(id=job.id)
-#         analysis.status = Analysis.Status.COMPLETED
-#         if "prediction" in result:
-#             PredictionResult.objects.create(
-#                 analysis=analysis, prediction=result["prediction"]
-#             )
-#         if "segmentation" in result:
-#             # handle decoding and storing of base64 encoded segmentation masks
-#             for tp, (name, data) in result["segmentation"].items():
-#                 # decode base64 string into binary and save to filefield
-#                 f = ContentFile(content=base64.b64decode(data), name=name)
-#                 SegmentationResult.objects.create(
-#                     analysis=analysis, segmentation_mask=f, mask_type=tp
-#                 )
-#         if "artifact" in result:
-#             # handle decoding and storing of intermediate model artifacts
-#             for tp, (name, data) in result["artifact"].items():
-#                 f = ContentFile(content=base64.b64decode(data), name=name)
-#                 AnalysisArtifact.objects.create(
-#                     analysis=analysis, artifact=f, artifact_type=tp
-#                 )
-#         analysis.save()
-#         logger.info(f"Analysis {analysis.id} processed successfully")
-#     except Analysis.DoesNotExist:
-#         logger.error(f"Analysis with job id {job.id} not found")
-
-
-# def report_failure(job, connection, type, value, traceback):
-#     """
-#     Specifies the on failure callback function to be called
-#     when RQ job execution fails. Callbacks are limited to 60s
-#     runtime.
-#     """
-#     logger.error(
-#         f"Analysis {job.id} failed with error {type}: {str(value)}"
-#     )
-#     Analysis.objects.filter(id=job.id).update(status=Analysis.Status.FAILED)
-
-
-# @job(
-#     "abdomen",
-#     timeout=3600,
-#     result_ttl=0,
-#     on_success=report_success,
-#     on_failure=report_failure,
-# )
-# def abdomen(dicoms):
-#     encoded_images = []
-#     # base64 encode all Dicom instances for inference
-#     for dicom in dicoms:
-#         fp = dicom.file.path
-#         with open(fp, "rb") as f:
-#             encoded_f = base64.b64encode(f.read()).decode("utf-8")
-#         logger.info(f"base64 encoded {fp}")
-#         encoded_images.append(encoded_f)
-
-#     payload = {"data": encoded_images}
-#     start = time.perf_counter()
-#     response = requests.post(
-#         AI_ABD_ENDPOINT,
-#         headers={
-#             "Content-Type": "application/json",
-#         },
-#         json=payload,
-#     )
-#     response.raise_for_status()
-#     end = time.perf_counter()
-#     logger.info(f"abd analysis completed in {end-start:.2f} seconds")
-
-#     response_body = response.json()
-#     prediction = json.loads(response_body["prediction"])
-#     scaling_factor = 1
-#     if "params" in response_body:
-#         scaling_factor = float(response_body["params"]["scaling_factor"])
-#     result = {}
-#     result["prediction"] = {
-#         "SSAT": {"score": None, "volume": None, "percent": None},
-#         "DSAT": {"score": None, "volume": None, "percent": None},
-#         "VAT": {"score": None, "volume": None, "percent": None},
-#     }  # Placeholder response
-
-#     # for artery, data in result["prediction"].items():
-#     #     data["score"] = int(prediction["agatston_score"][artery] * scaling_factor)
-#     #     data["volume"] = int(prediction["total_volume"][artery])
-#     #     data["lesion_count"] = int(prediction["lesion_count"][artery])
-
-#     # result["prediction"]["total"] = {
-#     #     "lesion_count": sum(
-#     #         [data["lesion_count"] for data in result["prediction"].values()]
-#     #     ),
-#     #     "volume": sum([data["volume"] for data in result["prediction"].values()]),
-#     #     "score": sum([data["score"] for data in result["prediction"].values()]),
-#     #}
-#     result["segmentation"] = response_body["segmentation"]
-#     result["artifact"] = response_body["artifact"]
-#     return result
-
-
-# @job(
-#     "thigh",
-#     timeout=3600,
-#     result_ttl=0,
-#     on_success=report_success,
-#     on_failure=report_failure,
-# )
-# def thigh(dicoms):
-#     encoded_images = []
-#     # base64 encode all Dicom instances for inference
-#     for dicom in dicoms:
-#         fp = dicom.file.path
-#         with open(fp, "rb") as f:
-#             encoded_f = base64.b64encode(f.read()).decode("utf-8")
-#         logger.info(f"base64 encoded {fp}")
-#         encoded_images.append(encoded_f)
-
-#     payload = {"data": encoded_images}
-#     start = time.perf_counter()
-#     response = requests.post(
-#         AI_THIGH_ENDPOINT,
-#         headers={
-#             "Content-Type": "application/json",
-#         },
-#         json=payload,
-#     )
-#     response.raise_for_status()
-#     end = time.perf_counter()
-#     logger.info(f"Thigh analysis completed in {end-start:.2f} seconds")
-
-#     response_body = response.json()
-#     response_body = response.json()
-#     prediction = json.loads(response_body["prediction"])
-#     scaling_factor = 1
-#     if "params" in response_body:
-#         scaling_factor = float(response_body["params"]["scaling_factor"])
-#     result = {}
-#     result["prediction"] = {
-#         "BONE": {"score": None, "volume": None, "percent": None},
-#         "IMAT": {"score": None, "volume": None, "percent": None},
-#         "VAT": {"score": None, "volume": None, "percent": None},
-#         "MUSCLE": {"score": None, "volume": None, "percent": None},
-#     }  # Placeholder response
-#     result["segmentation"] = response_body["segmentation"]
-#     result["artifact"] = response_body["artifact"]
-#     return result
-
-# @job(
-#     "mmap",
-#     timeout=3600,
-#     result_ttl=0,
-#     on_success=report_success,
-#     on_failure=report_failure,
-# )
-# def mmap(dicoms):
-#     encoded_images = []
-#     # base64 encode all Dicom instances for inference
-#     for dicom in dicoms:
-#         fp = dicom.file.path
-#         with open(fp, "rb") as f:
-#             encoded_f = base64.b64encode(f.read()).decode("utf-8")
-#         logger.info(f"base64 encoded {fp}")
-#         encoded_images.append(encoded_f)
-
-#     payload = {"data": encoded_images}
-#     start = time.perf_counter()
-#     response = requests.post(
-#         AI_MMAP_ENDPOINT,
-#         headers={
-#             "Content-Type": "application/json",
-#         },
-#         json=payload,
-#     )
-#     response.raise_for_status()
-#     end = time.perf_counter()
-#     logger.info(f"MMAP analysis completed in {end-start:.2f} seconds")
-
-#     response_body = response.json()
-#     return response_body
+import logging
+import base64
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import File
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from ..models.analysis import (
+    Analysis,
+    PredictionResult,
+    SegmentationResult,
+    AnalysisArtifact,
+)
+from . import checkpoints
+from .events import publish_status
+from .retry import is_retryable
+from .progress import (
+    report_stage,
+    report_stage_failed,
+    merge_remote_timings,
+)
+from .log_filter import TruncateLogFilter
+
+logger = logging.getLogger("rq.worker")
+logger.addFilter(TruncateLogFilter(max_length=500))
+
+# result files written to storage concurrently by report_success
+WRITE_WORKERS = 8
+
+
+class Base64File(File):
+    """
+    A base64 payload that decodes chunk by chunk while storage writes it,
+    instead of holding the decoded copy of a whole mask in memory.
+    Expects unwrapped base64 (no newlines), as the inference services send.
+    """
+
+    def __init__(self, data: str, name: str):
+        super().__init__(None, name)
+        self.data = data
+
+    def chunks(self, chunk_size=None):
+        # 4 characters encode 3 bytes, so slices of 4k characters decode alone
+        step = (chunk_size or self.DEFAULT_CHUNK_SIZE) // 3 * 4
+        for start in range(0, len(self.data), step):
+            yield base64.b64decode(self.data[start:start + step])
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+
+def _write(row, field: str, name: str, data: str):
+    # runs on a writer thread: storage only, but never leave a connection behind
+    try:
+        getattr(row, field).save(name, Base64File(data, name), save=False)
+    finally:
+        close_old_connections()
+    return row
+
+
+def _write_results(analysis: Analysis, result: dict) -> list:
+    """Write all result files in parallel; returns the unsaved result rows."""
+    jobs = [
+        (SegmentationResult(analysis=analysis, mask_type=tp), "segmentation_mask", name, data)
+        for tp, (name, data) in result.get("segmentation", {}).items()
+    ] + [
+        (AnalysisArtifact(analysis=analysis, artifact_type=tp), "artifact", name, data)
+        for tp, (name, data) in result.get("artifact", {}).items()
+    ]
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(WRITE_WORKERS, len(jobs))) as pool:
+        futures = [pool.submit(_write, *job) for job in jobs]
+    rows = [f.result() for f in futures if f.exception() is None]
+    if len(rows) < len(futures):
+        _discard(rows)
+        raise next(f.exception() for f in futures if f.exception() is not None)
+    return rows
+
+
+def _discard(rows) -> None:
+    for row in rows:
+        stored = row.segmentation_mask if isinstance(row, SegmentationResult) else row.artifact
+        stored.storage.delete(stored.name)
+
+
+def report_success(job, connection, result, *args, **kwargs):
+    """
+    Specifies the on success callback function to be called
+    when RQ job is executed successfully. The callback timeout
+    is set in tasks.ENQUEUE_OPTIONS.
+
+    Result files are written to storage in parallel first; their rows and
+    the COMPLETED status are then saved in one transaction with bulk inserts.
+    """
+    try:
+        logger.info(f"Executing success callback")
+        # owner is read by upload_to in the writer threads, load it up front
+        analysis = Analysis.objects.select_related("owner").get(id=job.id)
+        if analysis.status == Analysis.Status.CANCELED:
+            logger.info(f"Analysis {analysis.id} was canceled, discarding its result")
+            checkpoints.clear(analysis)
+            return
+        report_stage(Analysis.Stage.UPLOAD, analysis_id=job.id)
+        rows = _write_results(analysis, result)
+        try:
+            with transaction.atomic():
+                current = Analysis.objects.select_for_update().get(id=analysis.id)
+                canceled = current.status == Analysis.Status.CANCELED
+                if not canceled:
+                    current.status = Analysis.Status.COMPLETED
+                    merge_remote_timings(current, result.get("stage_timings"))
+                    if "prediction" in result:
+                        PredictionResult.objects.create(
+                            analysis=current, prediction=result["prediction"]
+                        )
+                    SegmentationResult.objects.bulk_create(
+                        [r for r in rows if isinstance(r, SegmentationResult)]
+                    )
+                    AnalysisArtifact.objects.bulk_create(
+                        [r for r in rows if isinstance(r, AnalysisArtifact)]
+                    )
+                    current.save()
+        except BaseException:
+            _discard(rows)
+            raise
+        checkpoints.clear(analysis)
+        if canceled:
+            _discard(rows)
+            logger.info(f"Analysis {analysis.id} was canceled while storing, discarding its result")
+            return
+        report_stage(Analysis.Stage.DONE, analysis_id=analysis.id)
+        logger.info(f"Analysis {analysis.id} processed successfully ({len(rows)} files)")
+    except Analysis.DoesNotExist:
+        logger.error(f"Analysis with job id {job.id} not found")
+
+
+def report_failure(job, connection, type, value, traceback):
+    """
+    Specifies the on failure callback function to be called
+    when RQ job execution fails. Callbacks are limited to 60s
+    runtime. Canceled analyses keep their status.
+
+    Transient errors of jobs with retries left (see utils/retry.py) keep the
+    analysis PROCESSING; anything else clears ``retries_left``, which RQ
+    reads right after this callback, so the job fails for good. The freed
+    slot is then handed to the next pending analysis, which also covers jobs
+    RQ fails when it cleans up after a dead worker.
+    """
+    analysis = Analysis.objects.select_related("owner").filter(id=job.id).first()
+    if getattr(job, "retries_left", None):
+        canceled = analysis is None or analysis.status == Analysis.Status.CANCELED
+        if canceled or not is_retryable(value):
+            job.retries_left = 0
+        else:
+            delay = job.get_retry_interval()
+            logger.warning(
+                f"Analysis {job.id} failed with error {type}: {str(value)}, "
+                f"retrying in {delay}s ({job.retries_left} retries left)"
+            )
+            report_stage_failed(job.id, error=str(value))
+            publish_status(analysis, error=str(value), retry_in=delay)
+            return
+    if analysis is None:
+        logger.error(f"Deleted analysis {job.id} failed with error {type}: {str(value)}")
+        return
+    fail_analysis(analysis, value)
+
+
+def fail_analysis(analysis: Analysis, error: BaseException) -> None:
+    """
+    Mark ``analysis`` failed for good with ``error``, unless it was canceled,
+    and free its slot. Also used for analyses that never reached a worker.
+    """
+    logger.error(
+        f"Analysis {analysis.id} failed with error {type(error)}: {str(error)}"
+    )
+    report_stage_failed(analysis.id, error=str(error))
+    Analysis.objects.filter(id=analysis.id).exclude(status=Analysis.Status.CANCELED).update(
+        status=Analysis.Status.FAILED, ended_at=timezone.now()
+    )
+    analysis.refresh_from_db()
+    publish_status(analysis, error=str(error))
+    checkpoints.clear(analysis)
+    if not settings.ANALYSIS_LOCAL_MODE:
+        transaction.on_commit(partial(_dispatch, analysis.queue))
+
+
+def _dispatch(queue: str) -> None:
+    from .scheduling import dispatch   # scheduling imports the tasks, which import us
+    try:
+        dispatch(queue)
+    except Exception:
+        logger.exception(f"Dispatch of {queue} queue after a failure failed")
+
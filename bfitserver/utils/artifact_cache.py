@@ -0,0 +1,68 @@
+"""
+Cache of decoded analysis artifacts (parsed ``.txt``/``.json``, base64 PNGs, ...).
+
+An in-process LRU bounded by total size: each entry is weighed by the length of
+its stored artifact file, and the least recently used entries are evicted until
+the total fits ``ARTIFACT_CACHE_MAX_BYTES``. Entries are keyed by artifact id and
+stamped with the artifact's ``updated_at``, so a modified artifact is never
+served stale. Signal handlers in ``bfitserver.signals`` drop entries when an
+artifact is saved or deleted.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger("bfitserver")
+
+_lock = threading.Lock()
+_entries: OrderedDict = OrderedDict()   # artifact id -> (stamp, payload, size)
+_total = 0
+
+
+def _stamp(artifact) -> str:
+    return artifact.updated_at.isoformat() if artifact.updated_at else ""
+
+
+def _size(artifact) -> int:
+    try:
+        return artifact.artifact.size
+    except (OSError, ValueError):
+        return settings.ARTIFACT_CACHE_MAX_ENTRY_BYTES + 1   # unknown: don't cache
+
+
+def _drop(artifact_id) -> None:
+    global _total
+    entry = _entries.pop(artifact_id, None)
+    if entry is not None:
+        _total -= entry[2]
+
+
+def get_decoded(artifact, decode):
+    """Return ``decode(artifact)``, memoized on (artifact id, updated_at)."""
+    global _total
+    stamp = _stamp(artifact)
+    with _lock:
+        hit = _entries.get(artifact.pk)
+        if hit is not None and hit[0] == stamp:
+            _entries.move_to_end(artifact.pk)
+            return hit[1]
+
+    payload = decode(artifact)
+    size = _size(artifact)
+    if size > settings.ARTIFACT_CACHE_MAX_ENTRY_BYTES:
+        logger.debug("Artifact %s too large to cache", artifact.pk)
+        return payload
+    with _lock:
+        _drop(artifact.pk)
+        _entries[artifact.pk] = (stamp, payload, size)
+        _total += size
+        while _total > settings.ARTIFACT_CACHE_MAX_BYTES and _entries:
+            _drop(next(iter(_entries)))
+    return payload
+
+
+def invalidate(artifact_id) -> None:
+    with _lock:
+        _drop(artifact_id)
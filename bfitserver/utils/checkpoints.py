@@ -0,0 +1,65 @@
+"""
+Stage checkpoints of analysis jobs.
+
+When an inference request fails after some of its stages finished, the
+segmentation service returns their outputs under ``checkpoints``:
+``conversion`` holds the converted NIfTI volumes and ``inference`` holds the
+raw nnUNet predictions. They are kept in
+``<owner>/analysis/<id>/checkpoints/<stage>/`` in MEDIA_ROOT, next to the
+analysis results. A retry uploads them with the DICOM files, and the service
+skips the stages they cover. Checkpoints are removed once the analysis
+completes or fails for good.
+"""
+import base64
+import logging
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+
+from ..models.analysis import Analysis
+
+logger = logging.getLogger("rq.worker")
+
+# checkpointed stage → multipart field the service reads it from
+STAGES = {
+    Analysis.Stage.CONVERSION: "file",
+    Analysis.Stage.INFERENCE:  "prediction",
+}
+
+
+def checkpoint_dir(analysis: Analysis) -> Path:
+    return Path(settings.MEDIA_ROOT, analysis.owner.username, "analysis", analysis.id, "checkpoints")
+
+
+def save(analysis: Analysis, checkpoints: dict | None) -> list[str]:
+    """Store ``{stage: [{filename, b64_data}, ...]}``; returns the stages saved."""
+    saved = []
+    for stage, entries in (checkpoints or {}).items():
+        entries = [e for e in entries or [] if e and e.get("b64_data")]
+        if stage not in STAGES or not entries:
+            continue
+        folder = checkpoint_dir(analysis) / stage
+        folder.mkdir(parents=True, exist_ok=True)
+        for entry in entries:
+            # service-chosen names, keep them inside the folder
+            (folder / Path(entry["filename"]).name).write_bytes(base64.b64decode(entry["b64_data"]))
+        saved.append(stage)
+    if saved:
+        logger.info("Checkpointed %s of analysis %s", ", ".join(saved), analysis.id)
+    return saved
+
+
+def upload_files(analysis: Analysis) -> list[tuple]:
+    """Checkpointed outputs as ``requests`` multipart entries."""
+    files = []
+    for stage, field in STAGES.items():
+        folder = checkpoint_dir(analysis) / stage
+        if folder.is_dir():
+            for path in sorted(folder.iterdir()):
+                files.append((field, (path.name, path.read_bytes(), "application/octet-stream")))
+    return files
+
+
+def clear(analysis: Analysis) -> None:
+    shutil.rmtree(checkpoint_dir(analysis), ignore_errors=True)
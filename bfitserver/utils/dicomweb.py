@@ -0,0 +1,300 @@
+"""
+DICOMweb helpers: QIDO-RS query matching and DICOM JSON rendering.
+
+Attributes kept in columns (UIDs, patient, study date, instance number) are
+matched on the columns and their indexes. Any other attribute is matched in
+``Instance.metadata``, the DICOM JSON (PS3.18 F.2) of the instance without bulk
+data. Exact values use jsonb containment, which the GIN index on
+``metadata`` serves. Wildcards and ranges compare the first value as text.
+
+Study and series results take the attributes that are not columns from a
+representative instance, the first one in frame order.
+"""
+import re
+from datetime import datetime
+
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.fields.json import KT
+from django.db.models.lookups import GreaterThanOrEqual, LessThanOrEqual, Regex, IRegex
+from pydicom import dcmread
+from pydicom.datadict import dictionary_VR, keyword_for_tag, tag_for_keyword
+
+from ..models.dicomweb import Instance
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+STUDY, SERIES, INSTANCE = "study", "series", "instance"
+
+# attributes returned by default at each level (PS3.18 table 10.6.3-3)
+STUDY_ATTRIBUTES = [
+    "StudyDate", "StudyTime", "AccessionNumber", "ModalitiesInStudy",
+    "ReferringPhysicianName", "PatientName", "PatientID", "PatientBirthDate",
+    "PatientSex", "StudyInstanceUID", "StudyID", "StudyDescription",
+    "NumberOfStudyRelatedSeries", "NumberOfStudyRelatedInstances", "RetrieveURL",
+]
+SERIES_ATTRIBUTES = [
+    "Modality", "SeriesDescription", "SeriesNumber", "SeriesInstanceUID",
+    "BodyPartExamined", "PerformedProcedureStepStartDate",
+    "PerformedProcedureStepStartTime", "NumberOfSeriesRelatedInstances", "RetrieveURL",
+]
+INSTANCE_ATTRIBUTES = [
+    "SOPClassUID", "SOPInstanceUID", "InstanceNumber", "Rows", "Columns",
+    "BitsAllocated", "NumberOfFrames", "RetrieveURL",
+]
+LEVEL_ATTRIBUTES = {
+    STUDY: STUDY_ATTRIBUTES,
+    SERIES: STUDY_ATTRIBUTES + SERIES_ATTRIBUTES,
+    INSTANCE: STUDY_ATTRIBUTES + SERIES_ATTRIBUTES + INSTANCE_ATTRIBUTES,
+}
+
+# column backed attributes, as paths from Instance
+COLUMNS = {
+    "StudyInstanceUID":  "series__study__study_id",
+    "PatientID":         "series__study__patient_id",
+    "PatientName":       "series__study__patient_name",
+    "StudyDate":         "series__study__study_date",
+    "SeriesInstanceUID": "series__series_id",
+    "SOPInstanceUID":    "instance_id",
+    "InstanceNumber":    "frame_number",
+}
+# path from Instance to the model queried at each level
+PREFIX = {STUDY: "series__study__", SERIES: "series__", INSTANCE: ""}
+# instances of the queried row, for attributes matched in metadata
+OWNER_PATH = {STUDY: "series__study", SERIES: "series"}
+
+# stored as numbers in DICOM JSON
+INTEGER_VRS = {"IS", "SL", "SS", "UL", "US", "SV", "UV"}
+DECIMAL_VRS = {"DS", "FL", "FD"}
+RANGE_VRS = {"DA", "TM", "DT"}
+
+# query parameters that are not attribute keys
+CONTROL_PARAMETERS = {"limit", "offset", "includefield", "fuzzymatching"}
+# keys spelled like a keyword or a hex tag; any other parameter, e.g. the
+# ``_=<timestamp>`` of cache-busting clients, is not a query and is ignored
+ATTRIBUTE_KEY = re.compile(r"[0-9A-Fa-f]{8}|[A-Z]")
+
+
+class QueryError(ValueError):
+    """A QIDO-RS request that cannot be answered (400 Bad Request)."""
+
+
+def tag(keyword: str) -> str:
+    return f"{tag_for_keyword(keyword):08X}"
+
+
+def resolve(key: str) -> tuple[str, str, str]:
+    """(keyword, tag, VR) of an attribute given by keyword or hex tag."""
+    if re.fullmatch(r"[0-9A-Fa-f]{8}", key):
+        number = int(key, 16)
+        keyword = keyword_for_tag(number)
+    else:
+        number = tag_for_keyword(key)
+        keyword = key
+    if number is None or not keyword:
+        raise QueryError(f"Unknown attribute {key}")
+    return keyword, f"{number:08X}", dictionary_VR(number)
+
+
+def _split_range(value: str) -> tuple[str | None, str | None]:
+    low, _, high = value.partition("-")
+    return low or None, high or None
+
+
+def _parse_date(value: str):
+    try:
+        return datetime.strptime(value, "%Y%m%d").date()
+    except ValueError:
+        raise QueryError(f"Invalid date {value}") from None
+
+
+def _wildcard(value: str) -> str:
+    return "^" + "".join(
+        ".*" if c == "*" else "." if c == "?" else re.escape(c) for c in value
+    ) + "$"
+
+
+def _typed(vr: str, value: str):
+    try:
+        if vr in INTEGER_VRS:
+            return int(value)
+        if vr in DECIMAL_VRS:
+            return float(value)
+    except ValueError:
+        raise QueryError(f"Invalid {vr} value {value}") from None
+    return {"Alphabetic": value} if vr == "PN" else value
+
+
+def _column_match(path: str, vr: str, value: str) -> list:
+    if vr == "UI":
+        return [Q(**{f"{path}__in": re.split(r"[,\\]", value)})]
+    if vr == "DA":
+        if "-" not in value:
+            return [Q(**{path: _parse_date(value)})]
+        low, high = _split_range(value)
+        conditions = []
+        if low:
+            conditions.append(Q(**{f"{path}__gte": _parse_date(low)}))
+        if high:
+            conditions.append(Q(**{f"{path}__lte": _parse_date(high)}))
+        return conditions
+    if "*" in value or "?" in value:
+        lookup = "iregex" if vr == "PN" else "regex"
+        return [Q(**{f"{path}__{lookup}": _wildcard(value)})]
+    if vr in INTEGER_VRS:
+        return [Q(**{path: _typed(vr, value)})]
+    return [Q(**{f"{path}__iexact" if vr == "PN" else path: value})]
+
+
+def _metadata_match(tag_: str, vr: str, value: str) -> list:
+    if vr == "UI":
+        q = Q()
+        for uid in re.split(r"[,\\]", value):
+            q |= Q(metadata__contains={tag_: {"Value": [uid]}})
+        return [q]
+    text = KT(f"metadata__{tag_}__Value__0" + ("__Alphabetic" if vr == "PN" else ""))
+    if vr in RANGE_VRS and "-" in value:
+        low, high = _split_range(value)
+        conditions = []
+        if low:
+            conditions.append(GreaterThanOrEqual(text, low))
+        if high:
+            conditions.append(LessThanOrEqual(text, high))
+        return conditions
+    if "*" in value or "?" in value:
+        return [(IRegex if vr == "PN" else Regex)(text, _wildcard(value))]
+    return [Q(metadata__contains={tag_: {"Value": [_typed(vr, value)]}})]
+
+
+class Query:
+    """
+    A parsed QIDO-RS query string.
+
+    ``conditions()`` gives the filters for the model of the queried level;
+    ``tags`` are the attributes to return (None for ``includefield=all``).
+    """
+
+    def __init__(self, params, level: str):
+        self.level = level
+        self.matches: list[tuple[str, str, str, str]] = []
+        self.tags: set[str] | None = {tag(k) for k in LEVEL_ATTRIBUTES[level]}
+        for key in params:
+            if key in CONTROL_PARAMETERS or not ATTRIBUTE_KEY.match(key):
+                continue
+            keyword, tag_, vr = resolve(key)
+            values = params.getlist(key)
+            if len(values) > 1:
+                raise QueryError(f"{key} given more than once, list UIDs as a,b instead")
+            value = values[0]
+            self.tags.add(tag_)
+            if value:   # an empty value only asks for the attribute
+                self.matches.append((keyword, tag_, vr, value))
+        for field in params.getlist("includefield"):
+            for key in filter(None, field.split(",")):
+                if key == "all":
+                    self.tags = None
+                    break
+                self.tags.add(resolve(key)[1])
+            if self.tags is None:
+                break
+        self.limit = self._bounded(params, "limit", DEFAULT_LIMIT, MAX_LIMIT)
+        self.offset = self._bounded(params, "offset", 0, None)
+
+    @staticmethod
+    def _bounded(params, name: str, default: int, maximum: int | None) -> int:
+        try:
+            value = int(params.get(name, default))
+        except ValueError:
+            raise QueryError(f"Invalid {name}") from None
+        if value < 0:
+            raise QueryError(f"Invalid {name}")
+        return min(value, maximum) if maximum else value
+
+    def conditions(self) -> list:
+        prefix = PREFIX[self.level]
+        direct, nested = [], []
+        for keyword, tag_, vr, value in self.matches:
+            if keyword == "ModalitiesInStudy":
+                keyword, tag_, vr = resolve("Modality")
+            path = COLUMNS.get(keyword)
+            if path is not None and path.startswith(prefix):
+                direct += _column_match(path[len(prefix):], vr, value)
+            elif path is not None:
+                nested += _column_match(path, vr, value)
+            else:
+                nested += _metadata_match(tag_, vr, value)
+        if nested and self.level == INSTANCE:
+            direct += nested
+        elif nested:
+            # one instance has to match all of them
+            direct.append(Exists(Instance.objects.filter(
+                *nested, **{OWNER_PATH[self.level]: OuterRef("pk")}
+            )))
+        return direct
+
+    def page(self, queryset):
+        return queryset[self.offset:self.offset + self.limit]
+
+
+def related_count(queryset, group_by: str):
+    """Correlated COUNT of ``queryset`` rows per ``group_by`` = OuterRef("pk")."""
+    rows = queryset.filter(**{group_by: OuterRef("pk")}).order_by().values(group_by)
+    return Coalesce(Subquery(rows.annotate(n=Count("pk")).values("n")), 0)
+
+
+def representative(group_by: str):
+    """Metadata of the first instance per ``group_by`` = OuterRef("pk")."""
+    first = Instance.objects.filter(**{group_by: OuterRef("pk")}).order_by("series_id", "frame_number")
+    return Subquery(first.values("metadata")[:1])
+
+
+def first_value(keyword: str) -> KT:
+    return KT(f"metadata__{tag(keyword)}__Value__0")
+
+
+def instance_fields(path: str) -> dict:
+    """``metadata`` and ``frame_number`` of an Instance, from its file's header."""
+    ds = dcmread(path, stop_before_pixels=True)
+    return dict(metadata=ds.to_json_dict(), frame_number=ds.get("InstanceNumber"))
+
+
+def element(keyword: str, value) -> tuple[str, dict]:
+    """DICOM JSON element for a python value (None leaves it empty)."""
+    _, tag_, vr = resolve(keyword)
+    values = value if isinstance(value, (list, tuple)) else [value]
+    values = [v for v in values if v not in (None, "")]
+    if not values:
+        return tag_, {"vr": vr}
+    if vr == "PN":
+        values = [{"Alphabetic": str(v)} for v in values]
+    elif vr == "DA":
+        values = [v.strftime("%Y%m%d") if hasattr(v, "strftime") else str(v) for v in values]
+    elif vr not in INTEGER_VRS | DECIMAL_VRS:
+        values = [str(v) for v in values]
+    return tag_, {"vr": vr, "Value": values}
+
+
+def dataset(query: Query, values: dict, metadata: dict | None) -> dict:
+    """
+    A result of ``query``: the wanted attributes of ``metadata``, overridden
+    by the column/computed ``values`` ({keyword: value}).
+    """
+    metadata = metadata or {}
+    if query.tags is None:
+        # includefield=all, without attributes of levels below the result
+        below = {
+            STUDY: SERIES_ATTRIBUTES + INSTANCE_ATTRIBUTES,
+            SERIES: INSTANCE_ATTRIBUTES,
+            INSTANCE: [],
+        }[query.level]
+        skip = {tag(k) for k in below}
+        result = {t: v for t, v in metadata.items() if t not in skip}
+    else:
+        result = {t: metadata[t] for t in query.tags if t in metadata}
+    for keyword, value in values.items():
+        tag_, elem = element(keyword, value)
+        if query.tags is None or tag_ in query.tags:
+            if "Value" in elem or tag_ not in result:
+                result[tag_] = elem
+    return dict(sorted(result.items()))
@@ -0,0 +1,80 @@
+"""
+Analysis status events over Redis pub/sub.
+
+Status transitions (enqueue, progress, success, failure, cancel) are published
+on ``ANALYSIS_EVENTS_CHANNEL``; the SSE endpoint in ``views.analysis_events``
+subscribes and forwards them to connected front-ends, which replaces polling
+of the analysis list.
+"""
+import json
+import logging
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger("bfitserver")
+
+_client = None
+
+
+def _redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
+
+
+def status_event(analysis, progress=None, **extra) -> dict:
+    event = {
+        "id": analysis.id,
+        "queue": analysis.queue,
+        "status": analysis.status,
+        "stage": analysis.stage,
+        "owner": analysis.owner_id,
+        "progress": analysis.progress if progress is None else progress,
+        "at": timezone.now().isoformat(),
+    }
+    event.update(extra)
+    return event
+
+
+def publish_status(analysis, progress=None, **extra) -> None:
+    """
+    Publish the current status of ``analysis``.
+
+    Never raises: a Redis outage must not fail the job or request that
+    triggered the transition, clients simply fall back to polling.
+    """
+    try:
+        _redis().publish(
+            settings.ANALYSIS_EVENTS_CHANNEL,
+            json.dumps(status_event(analysis, progress, **extra), default=str),
+        )
+    except Exception:
+        logger.warning("Could not publish status of analysis %s", analysis.id, exc_info=True)
+
+
+async def subscribe(heartbeat: float = 15.0):
+    """
+    Yield decoded events from the channel, or None every ``heartbeat`` seconds
+    of silence so callers can keep idle connections alive.
+    """
+    client = aioredis.Redis.from_url(settings.REDIS_URL)
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(settings.ANALYSIS_EVENTS_CHANNEL)
+    try:
+        while True:
+            message = await pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield None
+                continue
+            try:
+                yield json.loads(message["data"])
+            except (TypeError, ValueError):
+                logger.warning("Dropping malformed analysis event %r", message["data"])
+    finally:
+        await pubsub.unsubscribe(settings.ANALYSIS_EVENTS_CHANNEL)
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,104 @@
+"""
+Streaming responses for stored FileFields (segmentation masks, artifacts, ...).
+
+Files are served as stored – a ``.nii.gz`` goes out as ``application/gzip``,
+never with ``Content-Encoding``, so byte ranges address the stored file and
+clients keep the compressed bytes – and single byte ranges are honoured so
+viewers can fetch large volumes progressively. When ``FILE_ACCEL_REDIRECT_PREFIX`` is set the
+transfer is handed to nginx via ``X-Accel-Redirect`` instead.
+"""
+import mimetypes
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+CHUNK_SIZE = 256 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def content_type_for(filename: str) -> str:
+    """Content type of a stored file name; compressed files are gzip bodies."""
+    if filename.endswith(".gz"):
+        return "application/gzip"
+    content_type, _ = mimetypes.guess_type(filename)
+    return content_type or "application/octet-stream"
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single ``bytes=`` range into inclusive (start, end) offsets.
+
+    Returns None when no usable range was sent (multi-range requests are answered
+    with the full body) and raises ValueError when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    m = RANGE_RE.match(header.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+def _iter_range(f, start: int, length: int):
+    with f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def stored_file_response(request, field_file, as_attachment: bool = False):
+    """Stream a FieldFile to the client, honouring ``Range`` and nginx offloading."""
+    name = Path(field_file.name).name
+    content_type = content_type_for(name)
+    disposition = "attachment" if as_attachment else "inline"
+
+    prefix = getattr(settings, "FILE_ACCEL_REDIRECT_PREFIX", None)
+    if prefix:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = f"{prefix.rstrip('/')}/{field_file.name}"
+    else:
+        size = field_file.size
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+        if byte_range is None:
+            response = FileResponse(field_file.open("rb"), content_type=content_type)
+            response["Content-Length"] = str(size)
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                _iter_range(field_file.open("rb"), start, length),
+                status=206,
+                content_type=content_type,
+            )
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = str(length)
+        response["Accept-Ranges"] = "bytes"
+
+    response["Content-Disposition"] = f'{disposition}; filename="{name}"'
+    return response
@@ -0,0 +1,51 @@
+"""
+Idempotent analysis creation.
+
+Every analysis carries ``input_hash``, a content hash of what determines its
+result: the queue, the deployed model version, the ``model_params`` and the
+series' SOP Instance UIDs (which DICOM guarantees to be unique per instance
+content), whether the series was uploaded or is read from the PACS index. A
+request whose hash matches an analysis that is still processing or has
+completed gets that analysis back instead of a new job, so double clicks and
+client retries attach to the running inference or reuse its results.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+
+from ..models.analysis import Analysis
+from ..models.dicomweb import Instance, PACSInstance, PACSSeries, Series
+
+REUSABLE = (Analysis.Status.PROCESSING, Analysis.Status.COMPLETED)
+
+
+def model_version(queue: str) -> str:
+    return settings.ANALYSIS_MODEL_VERSIONS.get(queue, "")
+
+
+def input_hash(
+    series: Series | PACSSeries, queue: str, version: str, model_params: dict | None
+) -> str:
+    instances = PACSInstance if isinstance(series, PACSSeries) else Instance
+    h = hashlib.sha256()
+    h.update(f"{queue}\0{version}\0".encode())
+    h.update(json.dumps(model_params or {}, sort_keys=True, separators=(",", ":")).encode())
+    for instance_id in (
+        instances.objects.filter(series=series)
+        .order_by("instance_id")
+        .values_list("instance_id", flat=True)
+        .iterator()
+    ):
+        h.update(b"\0")
+        h.update(instance_id.encode())
+    return h.hexdigest()
+
+
+def find_reusable(owner, digest: str) -> Analysis | None:
+    """The newest processing or completed analysis of ``owner`` with this input hash."""
+    return (
+        Analysis.objects.filter(owner=owner, input_hash=digest, status__in=REUSABLE)
+        .order_by("-created_at")
+        .first()
+    )
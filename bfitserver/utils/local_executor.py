@@ -0,0 +1,67 @@
+"""
+Bounded in-process executor for ``ANALYSIS_LOCAL_MODE``.
+
+Development setups without Redis and RQ workers run analyses here:
+``ANALYSIS_LOCAL_WORKERS`` threads consume a queue of at most
+``ANALYSIS_LOCAL_QUEUE_SIZE`` waiting jobs, and ``submit`` raises ``QueueFull``
+instead of piling up more. Outcomes go through the same ``report_success`` /
+``report_failure`` callbacks as RQ jobs, so status and progress are real.
+Threads cannot be killed, so the time limit is the HTTP timeout in the task.
+"""
+import logging
+import queue
+import threading
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .analysis import report_failure, report_success
+
+logger = logging.getLogger("bfitserver")
+
+_jobs: queue.Queue | None = None
+_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    """The local executor already has ``ANALYSIS_LOCAL_QUEUE_SIZE`` jobs waiting."""
+
+
+def _start() -> queue.Queue:
+    global _jobs
+    with _lock:
+        if _jobs is None:
+            _jobs = queue.Queue(maxsize=settings.ANALYSIS_LOCAL_QUEUE_SIZE)
+            for idx in range(settings.ANALYSIS_LOCAL_WORKERS):
+                threading.Thread(
+                    target=_work, args=(_jobs,), name=f"analysis-local-{idx}", daemon=True
+                ).start()
+    return _jobs
+
+
+def submit(func, analysis_id: str, **kwargs) -> None:
+    """Queue ``func(analysis_id=..., **kwargs)``; raises ``QueueFull`` when saturated."""
+    try:
+        _start().put_nowait((func, analysis_id, kwargs))
+    except queue.Full:
+        raise QueueFull(f"{settings.ANALYSIS_LOCAL_QUEUE_SIZE} analyses already waiting") from None
+    logger.info("Queued local analysis %s", analysis_id)
+
+
+def _work(jobs: queue.Queue) -> None:
+    while True:
+        func, analysis_id, kwargs = jobs.get()
+        job = SimpleNamespace(id=analysis_id)   # all the callbacks read
+        try:
+            try:
+                result = func(analysis_id=analysis_id, **kwargs)
+            except Exception as e:
+                report_failure(job, None, type(e), e, e.__traceback__)
+            else:
+                report_success(job, None, result)
+        except Exception:
+            logger.exception("Local analysis %s could not be finalised", analysis_id)
+        finally:
+            close_old_connections()
+            jobs.task_done()
@@ -1,11 +1,118 @@
 import logging
+import reprlib
+import threading
+import time
+
 
 class TruncateLogFilter(logging.Filter):
+    """
+    Cap the size of a log message without formatting large payloads first.
+
+    String/bytes arguments are sliced and containers are rendered with a bounded
+    repr *before* ``%`` formatting, so a base64 body passed as ``%s`` is never
+    expanded in full; the formatted message is then cut to ``max_length``.
+    Non-string ``msg`` objects (exceptions, dicts, ...) are handled the same way.
+    """
+
     def __init__(self, max_length=500):
         super().__init__()
-        self.max_length = max_length 
+        self.max_length = max_length
+        self._repr = reprlib.Repr()
+        self._repr.maxstring = self._repr.maxother = max_length
+        self._repr.maxlist = self._repr.maxtuple = self._repr.maxdict = self._repr.maxset = 20
+
+    def _shorten(self, value):
+        if isinstance(value, (str, bytes, bytearray)):
+            size = len(value)
+            if size <= self.max_length:
+                return value
+            head = value[:self.max_length]
+            if not isinstance(head, str):
+                head = repr(bytes(head))
+            return f"{head}...({size} chars)"
+        if isinstance(value, (list, tuple, dict, set, frozenset)):
+            return self._repr.repr(value)
+        return value
+
+    def filter(self, record):
+        msg = record.msg if isinstance(record.msg, str) else self._shorten(record.msg)
+        if not isinstance(msg, str):
+            msg = str(msg)
+
+        args = record.args
+        if args:
+            if isinstance(args, dict):
+                args = {k: self._shorten(v) for k, v in args.items()}
+            else:
+                args = tuple(self._shorten(a) for a in args)
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                # leave malformed calls to logging's own error reporting
+                record.msg, record.args = msg, args
+                return True
+
+        if len(msg) > self.max_length:
+            msg = msg[:self.max_length] + "..."
+        record.msg, record.args = msg, None
+        return True
+
+
+class RateLimitLogFilter(logging.Filter):
+    """
+    Rate-limit repeats of the same message.
+
+    Per message (logger, format string, arguments) at most ``burst`` records pass
+    in any ``interval`` seconds; the rest are dropped and counted, and the next
+    record that passes reports how many were suppressed. Records at or above
+    ``max_level`` (warnings and errors by default) always pass. Attach it to a
+    chatty logger only, such as the progress polling of a running inference.
+    """
+
+    def __init__(self, interval=60.0, burst=5, max_level=logging.WARNING, max_keys=1024):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.max_level = max_level
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._windows = {}  # message -> [window start, passed, suppressed]
 
     def filter(self, record):
-        if len(record.msg) > self.max_length:
-            record.msg = record.msg[:self.max_length] + "..."
-        return True
\ No newline at end of file
+        if record.levelno >= self.max_level:
+            return True
+
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                if window is None and len(self._windows) >= self.max_keys:
+                    self._expire(now)
+                self._windows[key] = window = [now, 0, 0]
+            else:
+                suppressed = 0
+
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+    @staticmethod
+    def _key(record):
+        key = (record.name, record.msg, record.args)
+        try:
+            hash(key)
+        except TypeError:
+            # e.g. a dict or list argument
+            key = (record.name, str(record.msg), repr(record.args))
+        return key
+
+    def _expire(self, now):
+        for key in [k for k, w in self._windows.items() if now - w[0] >= self.interval]:
+            del self._windows[key]
@@ -0,0 +1,115 @@
+"""
+Prometheus metrics for analysis jobs and queues.
+
+``AIWorker`` records job counters and durations; the web process serves them on
+``/metrics`` together with the ``abd``/``thigh``/``mmap`` queue depths, which are
+read from the database and Redis at scrape time. Workers run as separate
+processes, so set ``PROMETHEUS_MULTIPROC_DIR`` to a directory shared by the
+workers and the web process (and emptied on deploy): the endpoint then
+aggregates every process.
+"""
+import logging
+import os
+
+import django_rq
+import redis
+from django.db.models import Count
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from ..models.analysis import Analysis
+from .scheduling import rq_queue_name
+
+logger = logging.getLogger("bfitserver")
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# Segmentation jobs run from tens of seconds to well over ten minutes
+JOB_BUCKETS = (10, 30, 60, 120, 180, 300, 450, 600, 900, 1200, 1800, 3600)
+
+JOBS_STARTED = Counter(
+    "bfit_jobs_started_total", "Analysis jobs picked up by a worker", ["queue"],
+)
+JOBS_FINISHED = Counter(
+    "bfit_jobs_finished_total", "Analysis jobs that left a worker", ["queue", "outcome"],
+)
+JOBS_CANCELLED = Counter(
+    "bfit_jobs_cancelled_total", "Running jobs cancelled by a worker shutdown", ["queue"],
+)
+JOB_DURATION = Histogram(
+    "bfit_job_duration_seconds", "Wall time of analysis jobs inside the worker",
+    ["queue", "outcome"], buckets=JOB_BUCKETS,
+)
+WORKERS_BUSY = Gauge(
+    "bfit_workers_busy", "Workers currently executing a job", ["queue"],
+    multiprocess_mode="livesum",
+)
+
+
+def job_finished(queue: str, outcome: str, seconds: float) -> None:
+    JOBS_FINISHED.labels(queue, outcome).inc()
+    JOB_DURATION.labels(queue, outcome).observe(seconds)
+
+
+def worker_exited(pid: int | None = None) -> None:
+    """Drop the live gauges of an exiting worker process (multi-process mode)."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+class QueueCollector:
+    """Queue depths per analysis queue and priority, collected on every scrape."""
+
+    @staticmethod
+    def _family():
+        return GaugeMetricFamily(
+            "bfit_queue_jobs", "Jobs per analysis queue, priority and state",
+            labels=["queue", "priority", "state"],
+        )
+
+    def describe(self):
+        # lets the registry register us without running queries at import time
+        yield self._family()
+
+    def collect(self):
+        depth = self._family()
+        # waiting for admission by the scheduler, not on RQ yet
+        pending = (
+            Analysis.objects.filter(status=Analysis.Status.PROCESSING, admitted_at__isnull=True)
+            .values_list("queue", "priority").annotate(n=Count("id"))
+        )
+        counts = {(queue, priority): n for queue, priority, n in pending}
+        for queue in Analysis.Queue.values:
+            for priority in Analysis.Priority.values:
+                depth.add_metric([queue, priority, "pending"], counts.get((queue, priority), 0))
+        try:
+            for queue in Analysis.Queue.values:
+                for priority in Analysis.Priority.values:
+                    rq_queue = django_rq.get_queue(rq_queue_name(queue, priority))
+                    labels = [queue, priority]
+                    depth.add_metric(labels + ["queued"], rq_queue.count)
+                    depth.add_metric(labels + ["started"], rq_queue.started_job_registry.count)
+                    depth.add_metric(labels + ["deferred"], rq_queue.deferred_job_registry.count)
+                    depth.add_metric(labels + ["failed"], rq_queue.failed_job_registry.count)
+        except redis.RedisError:
+            logger.warning("Could not read queue lengths from Redis", exc_info=True)
+        yield depth
+
+
+_queue_registry = CollectorRegistry()
+_queue_registry.register(QueueCollector())
+
+
+def render() -> tuple[bytes, str]:
+    """Return the exposition body and its content type."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_queue_registry), CONTENT_TYPE_LATEST
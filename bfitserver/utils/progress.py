@@ -0,0 +1,118 @@
+"""
+Stage/progress reporting for analysis jobs.
+
+Workers call ``report_stage`` when a job enters a new stage. The stage and
+percentage go to ``job.meta`` (visible to RQ tooling) and are persisted on the
+``Analysis`` together with per-stage start/end timestamps, which gives a
+latency breakdown per job. Stages executed inside the inference service
+(``SERVICE_STAGES``) are reported live while the request runs, as the worker
+polls the service's progress endpoint (see tasks.py); the exact durations the
+service measured are merged afterwards (``merge_remote_timings``).
+"""
+import logging
+from datetime import datetime
+
+from django.db import transaction
+from django.utils import timezone
+from rq import get_current_job
+
+from ..models.analysis import Analysis
+from .events import publish_status
+
+logger = logging.getLogger("rq.worker")
+
+Stage = Analysis.Stage
+
+# stages run inside the inference service, in pipeline order
+SERVICE_STAGES = (
+    Stage.CONVERSION, Stage.WINDOWING, Stage.INFERENCE, Stage.POST_PROCESSING, Stage.SEG_EXPORT,
+)
+
+# progress (%) reported when a stage starts
+STAGE_PROGRESS = {
+    Stage.QUEUED:          0,
+    Stage.CONVERSION:      10,
+    Stage.WINDOWING:       20,
+    Stage.INFERENCE:       30,
+    Stage.POST_PROCESSING: 70,
+    Stage.SEG_EXPORT:      80,
+    Stage.UPLOAD:          90,
+    Stage.DONE:            100,
+}
+
+
+def _close(timings: dict, stage: str, now, **extra) -> None:
+    entry = timings.get(stage)
+    if entry and "started_at" in entry and "ended_at" not in entry:
+        started = datetime.fromisoformat(entry["started_at"])
+        entry["ended_at"] = now.isoformat()
+        entry["duration_s"] = round((now - started).total_seconds(), 3)
+        entry.update(extra)
+
+
+def _update(analysis_id: str, mutate) -> Analysis | None:
+    with transaction.atomic():
+        analysis = (
+            Analysis.objects.select_for_update().filter(id=analysis_id).first()
+        )
+        if analysis is None:
+            logger.warning("Progress for unknown analysis %s", analysis_id)
+            return None
+        analysis.stage_timings = dict(analysis.stage_timings or {})
+        mutate(analysis)
+        analysis.save(update_fields=["stage", "progress", "stage_timings", "ended_at"])
+    return analysis
+
+
+def report_stage(stage: str, analysis_id: str | None = None, progress: int | None = None):
+    """Mark the current job's analysis as having entered ``stage``."""
+    job = get_current_job()
+    analysis_id = analysis_id or (job.id if job else None)
+    if analysis_id is None:
+        raise ValueError("report_stage needs an analysis id outside of an RQ job")
+    progress = STAGE_PROGRESS[stage] if progress is None else progress
+
+    if job is not None and job.id == analysis_id:
+        job.meta.update(stage=str(stage), progress=progress)
+        job.save_meta()
+
+    now = timezone.now()
+
+    def mutate(analysis):
+        _close(analysis.stage_timings, analysis.stage, now)
+        if stage != Stage.DONE:
+            analysis.stage_timings[stage] = {"started_at": now.isoformat()}
+        analysis.stage, analysis.progress = stage, progress
+
+    analysis = _update(analysis_id, mutate)
+    if analysis is not None:
+        publish_status(analysis)
+    return analysis
+
+
+def report_stage_failed(analysis_id: str, error: str = ""):
+    """Close the stage that was running when the job failed."""
+    now = timezone.now()
+
+    def mutate(analysis):
+        _close(analysis.stage_timings, analysis.stage, now, failed=True, error=error[:500])
+
+    return _update(analysis_id, mutate)
+
+
+def merge_remote_timings(analysis: Analysis, timings: dict | None) -> None:
+    """
+    Fold per-stage durations reported by the inference service
+    (``{"conversion": 3.2, "inference": 41.0, ...}`` in seconds) into
+    ``analysis.stage_timings``; the caller saves the analysis.
+    """
+    if not timings:
+        return
+    merged = dict(analysis.stage_timings or {})
+    for stage, seconds in timings.items():
+        if stage not in Stage.values:
+            continue
+        entry = dict(merged.get(stage, {}))
+        entry["remote_duration_s"] = round(float(seconds), 3)
+        merged[stage] = entry
+    analysis.stage_timings = merged
@@ -0,0 +1,29 @@
+"""
+Retry policy of analysis jobs.
+
+Each queue retries transient inference failures, meaning 5xx responses,
+connection errors and timeouts, up to ``ANALYSIS_RETRIES[queue]`` times. The
+waits grow exponentially from ``ANALYSIS_RETRY_BACKOFF[queue]`` seconds, so
+1 → 30s, 2 → 60s, 3 → 120s. RQ's scheduler runs the retries, and the analysis
+stays admitted and PROCESSING until the last attempt. Rejected input, bugs and
+canceled analyses fail right away. ``utils.checkpoints`` lets a retry resume
+after the last completed stage.
+"""
+import requests
+from django.conf import settings
+from rq import Retry
+
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+def retry_policy(queue: str) -> Retry | None:
+    retries = settings.ANALYSIS_RETRIES.get(queue, 0)
+    if retries <= 0:
+        return None
+    backoff = settings.ANALYSIS_RETRY_BACKOFF.get(queue, 30)
+    return Retry(max=retries, interval=[backoff * 2 ** attempt for attempt in range(retries)])
+
+
+def is_retryable(error: BaseException | None) -> bool:
+    # InferenceError sets .retryable for server-side failures
+    return bool(getattr(error, "retryable", False)) or isinstance(error, RETRYABLE_ERRORS)
@@ -0,0 +1,138 @@
+"""
+Admission and fair-share scheduling of analysis jobs.
+
+Every ``Analysis.Queue`` is served by two RQ queues: ``<queue>`` for interactive
+and ``<queue>-batch`` for batch jobs. Workers listen to both in that order, so a
+waiting interactive job is always picked up first.
+
+Jobs are not pushed to RQ when they are created. ``dispatch`` admits pending
+analyses while fewer than ``ANALYSIS_ADMISSION_LIMITS[queue]`` are in flight:
+interactive jobs first (oldest first), then batch jobs round-robin over owners,
+least-loaded owner first, so one clinic's large batch cannot starve everybody
+else. Dispatch runs when a job is submitted and whenever a worker finishes one.
+"""
+import logging
+from collections import deque
+
+import django_rq
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+from redis.exceptions import LockError, RedisError
+
+from ..models.analysis import Analysis
+from ..models.dicomweb import Instance, PACSInstance
+from ..tasks import ENQUEUE_OPTIONS, TASKS
+from .events import publish_status
+from .retry import retry_policy
+
+logger = logging.getLogger("bfitserver")
+
+Priority = Analysis.Priority
+
+BATCH_SUFFIX = "-batch"
+DEFAULT_ADMISSION_LIMIT = 4
+
+
+def rq_queue_name(queue: str, priority: str) -> str:
+    return f"{queue}{BATCH_SUFFIX}" if priority == Priority.BATCH else str(queue)
+
+
+def analysis_queue(rq_name: str) -> str:
+    """Map an RQ queue name back to its ``Analysis.Queue`` value."""
+    return rq_name.removesuffix(BATCH_SUFFIX)
+
+
+def admission_limit(queue: str) -> int:
+    return settings.ANALYSIS_ADMISSION_LIMITS.get(queue, DEFAULT_ADMISSION_LIMIT)
+
+
+def in_flight(queue: str):
+    return Analysis.objects.filter(
+        queue=queue, status=Analysis.Status.PROCESSING, admitted_at__isnull=False
+    )
+
+
+def pending(queue: str):
+    return Analysis.objects.filter(
+        queue=queue, status=Analysis.Status.PROCESSING, admitted_at__isnull=True
+    )
+
+
+def pick(queue: str, slots: int) -> list[Analysis]:
+    """Choose up to ``slots`` pending analyses to admit, in admission order."""
+    chosen = list(
+        pending(queue).filter(priority=Priority.INTERACTIVE).order_by("created_at")[:slots]
+    )
+    slots -= len(chosen)
+    if slots <= 0:
+        return chosen
+
+    load = dict(
+        in_flight(queue).values("owner").annotate(n=Count("id")).values_list("owner", "n")
+    )
+    waiting: dict[int, deque] = {}
+    for analysis in pending(queue).filter(priority=Priority.BATCH).order_by("created_at"):
+        waiting.setdefault(analysis.owner_id, deque()).append(analysis)
+
+    while slots and waiting:
+        owner = min(waiting, key=lambda o: (load.get(o, 0), waiting[o][0].created_at))
+        chosen.append(waiting[owner].popleft())
+        load[owner] = load.get(owner, 0) + 1
+        slots -= 1
+        if not waiting[owner]:
+            del waiting[owner]
+    return chosen
+
+
+def input_files(analysis: Analysis) -> list[str]:
+    """
+    Paths of the DICOM files to analyse. PACS-indexed series are read where
+    the PACS export keeps them, without a copy into media storage.
+    """
+    if analysis.pacs_series_id is not None:
+        return list(
+            PACSInstance.objects.filter(series_id=analysis.pacs_series_id)
+            .order_by("instance_id").values_list("location", flat=True)
+        )
+    return [d.file.path for d in Instance.objects.filter(series_id=analysis.series_id)]
+
+
+def admit(analysis: Analysis) -> None:
+    """Put ``analysis`` on its RQ queue; the RQ job id is the analysis id."""
+    django_rq.get_queue(rq_queue_name(analysis.queue, analysis.priority)).enqueue(
+        TASKS[analysis.queue], dicoms=input_files(analysis), job_id=analysis.id,
+        retry=retry_policy(analysis.queue), **ENQUEUE_OPTIONS
+    )
+    now = timezone.now()
+    # .update() bypasses auto_now; bump ended_at so API ETags change
+    Analysis.objects.filter(id=analysis.id).update(admitted_at=now, ended_at=now)
+    analysis.admitted_at = analysis.ended_at = now
+    publish_status(analysis)
+
+
+def dispatch(queue: str) -> int:
+    """
+    Admit as many pending analyses of ``queue`` as its limit allows.
+
+    Redis errors are logged, not raised: whatever stays pending is admitted by
+    the next dispatch.
+    """
+    conn = django_rq.get_connection(str(queue))
+    try:
+        with conn.lock(f"bfit:dispatch:{queue}", timeout=60, blocking_timeout=10):
+            slots = admission_limit(queue) - in_flight(queue).count()
+            if slots <= 0:
+                return 0
+            admitted = pick(queue, slots)
+            for analysis in admitted:
+                admit(analysis)
+    except LockError:
+        logger.warning("Dispatch of %s queue skipped, lock busy", queue)
+        return 0
+    except RedisError:
+        logger.warning("Dispatch of %s queue failed", queue, exc_info=True)
+        return 0
+    if admitted:
+        logger.info("Admitted %d %s analyses", len(admitted), queue)
+    return len(admitted)
@@ -0,0 +1,265 @@
+"""
+DICOMweb STOW-RS ingest.
+
+The ``multipart/related; type="application/dicom"`` body is parsed while it
+is read, in ``CHUNK_SIZE`` pieces, so no part is ever held in memory. Each
+part is written next to its final location, then renamed into place as
+``get_dicomweb_instance_upload_path`` once its header gives the UIDs. Its
+Instance row is inserted in batches of ``BATCH_SIZE``; a re-sent instance
+replaces the stored one.
+
+As with the upload form, only series that match a ``dicom_config.json``
+rule (abd/thigh) are stored; other instances are reported as failed.
+"""
+import json
+import logging
+import os
+import re
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+
+from dicom_sorter import match_rule
+from ..models.dicomweb import Instance, Series, Study, get_dicomweb_instance_upload_path
+from . import dicomweb
+from .files import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+# FailureReason values (PS3.4 annex GG.4)
+PROCESSING_FAILURE = 0x0110
+CANNOT_UNDERSTAND = 0xC000
+
+# UIDs name the stored files and folders, so only PS3.5 9.1 UIDs are accepted
+UID = re.compile(r"[0-9]+(\.[0-9]+)*")
+UID_MAX_LENGTH = 64
+
+
+class StoreError(ValueError):
+    """A STOW-RS request that cannot be parsed at all; carries the HTTP status."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def boundary(content_type: str) -> bytes:
+    """The boundary of a ``multipart/related`` body of DICOM parts."""
+    media_type, _, params = content_type.partition(";")
+    params = dict(
+        (k.strip().lower(), v.strip().strip('"'))
+        for k, _, v in (p.partition("=") for p in params.split(";")) if k.strip()
+    )
+    if media_type.strip().lower() != "multipart/related":
+        raise StoreError("Expected multipart/related", 415)
+    if params.get("type", "application/dicom").lower() != "application/dicom":
+        raise StoreError("Only application/dicom parts are accepted", 415)
+    if not params.get("boundary"):
+        raise StoreError("Missing multipart boundary")
+    return params["boundary"].encode()
+
+
+def iter_parts(stream, boundary: bytes):
+    """
+    Yield ``(headers, chunks)`` per part of a multipart body read from
+    ``stream``. Each part's ``chunks`` must be consumed before the next.
+    """
+    delimiter = b"\r\n--" + boundary
+    buffer = b"\r\n"          # the first delimiter has no preceding CRLF
+
+    def fill() -> bool:
+        nonlocal buffer
+        chunk = stream.read(CHUNK_SIZE)
+        buffer += chunk
+        return bool(chunk)
+
+    # preamble
+    while (start := buffer.find(delimiter)) < 0:
+        buffer = buffer[-len(delimiter):]
+        if not fill():
+            raise StoreError("No multipart parts found")
+    buffer = buffer[start + len(delimiter):]
+
+    while True:
+        while len(buffer) < 2 and fill():
+            pass
+        if buffer.startswith(b"--"):
+            return
+        while (end := buffer.find(b"\r\n\r\n")) < 0:
+            if not fill():
+                raise StoreError("Truncated multipart headers")
+        lines = buffer[:end].decode("latin-1").split("\r\n")[1:]
+        headers = {
+            name.strip().lower(): value.strip()
+            for name, _, value in (line.partition(":") for line in lines)
+        }
+        buffer = buffer[end + 4:]
+
+        def chunks():
+            nonlocal buffer
+            while (end := buffer.find(delimiter)) < 0:
+                keep = len(delimiter) - 1
+                if len(buffer) > keep:
+                    yield buffer[:-keep]
+                    buffer = buffer[-keep:]
+                if not fill():
+                    raise StoreError("Truncated multipart body")
+            if end:
+                yield buffer[:end]
+            buffer = buffer[end + len(delimiter):]
+
+        body = chunks()
+        yield headers, body
+        for _ in body:    # drain a part the caller skipped
+            pass
+
+
+def valid_uid(uid: str) -> bool:
+    return len(uid) <= UID_MAX_LENGTH and UID.fullmatch(uid) is not None
+
+
+def _failure(ds, reason: int) -> dict:
+    return dict([
+        dicomweb.element("ReferencedSOPClassUID", ds and ds.get("SOPClassUID")),
+        dicomweb.element("ReferencedSOPInstanceUID", ds and ds.get("SOPInstanceUID")),
+        dicomweb.element("FailureReason", reason),
+    ])
+
+
+def _study_date(ds):
+    try:
+        return datetime.strptime(str(ds.get("StudyDate", "")), "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+class Ingest:
+    """Store the DICOM parts of one STOW-RS request for ``owner``."""
+
+    def __init__(self, owner, study_uid: str | None, base_url: str):
+        self.owner = owner
+        self.study_uid = study_uid
+        self.base_url = base_url
+        self.storage = Instance._meta.get_field("file").storage
+        with open(Path(settings.BASE_DIR) / "dicom_config.json") as f:
+            self.rules = json.load(f)["rules"]
+        self.studies: dict[str, Study] = {}
+        self.series: dict[str, Series | None] = {}
+        self.pending: dict[str, Instance] = {}
+        self.stored: list[dict] = []
+        self.failed: list[dict] = []
+
+    def add(self, headers: dict, chunks):
+        content_type = headers.get("content-type", "application/dicom")
+        if not content_type.lower().startswith("application/dicom"):
+            self.failed.append(_failure(None, CANNOT_UNDERSTAND))
+            return
+        spool = Path(self.storage.path(f"{self.owner.username}/stow/{uuid.uuid4().hex}.part"))
+        spool.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with spool.open("wb") as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            self._place(spool)
+        finally:
+            spool.unlink(missing_ok=True)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def _place(self, spool: Path):
+        try:
+            ds = dcmread(spool, stop_before_pixels=True)
+            study_uid, series_uid = str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID)
+            sop_uid = str(ds.SOPInstanceUID)
+            metadata = ds.to_json_dict()
+        except (InvalidDicomError, AttributeError, OSError, ValueError, TypeError) as e:
+            logger.warning("STOW part is not a readable DICOM instance: %s", e)
+            self.failed.append(_failure(None, CANNOT_UNDERSTAND))
+            return
+        if not all(valid_uid(uid) for uid in (study_uid, series_uid, sop_uid)):
+            logger.warning("STOW part has an invalid UID: %r", (study_uid, series_uid, sop_uid))
+            self.failed.append(_failure(ds, CANNOT_UNDERSTAND))
+            return
+        if self.study_uid and study_uid != self.study_uid:
+            self.failed.append(_failure(ds, CANNOT_UNDERSTAND))
+            return
+        series = self._series(ds, study_uid, series_uid)
+        if series is None:
+            self.failed.append(_failure(ds, PROCESSING_FAILURE))
+            return
+
+        instance = Instance(
+            instance_id=sop_uid, series=series, owner=self.owner,
+            frame_number=ds.get("InstanceNumber"), metadata=metadata,
+        )
+        # unique per owner, so a re-sent instance lands on the same file
+        filename = sop_uid + ".dcm"
+        instance.file.name = get_dicomweb_instance_upload_path(instance, filename)
+        target = Path(self.storage.path(instance.file.name))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(spool, target)
+        self.pending[sop_uid] = instance     # the last copy sent wins
+        self.stored.append(dict([
+            dicomweb.element("ReferencedSOPClassUID", ds.get("SOPClassUID")),
+            dicomweb.element("ReferencedSOPInstanceUID", sop_uid),
+            dicomweb.element(
+                "RetrieveURL",
+                f"{self.base_url}/{study_uid}/series/{series_uid}/instances/{sop_uid}",
+            ),
+        ]))
+
+    def _series(self, ds, study_uid: str, series_uid: str) -> Series | None:
+        if series_uid in self.series:
+            return self.series[series_uid]
+        tag = match_rule(
+            self.rules, ds.get("ProtocolName", ""), ds.get("ScanOptions", ""),
+            ds.get("PixelBandwidth", -1),
+        )
+        series = None
+        if tag is not None:
+            study = self.studies.get(study_uid)
+            if study is None:
+                study, _ = Study.objects.get_or_create(
+                    study_id=study_uid, owner=self.owner,
+                    defaults=dict(
+                        patient_id=ds.get("PatientID"),
+                        patient_name=str(ds.get("PatientName", "")) or None,
+                        study_date=_study_date(ds),
+                    ),
+                )
+                self.studies[study_uid] = study
+            series, _ = Series.objects.get_or_create(
+                series_id=series_uid, owner=self.owner,
+                defaults=dict(study=study, modality=tag),
+            )
+        self.series[series_uid] = series
+        return series
+
+    def flush(self):
+        if self.pending:
+            Instance.objects.bulk_create(
+                list(self.pending.values()),
+                update_conflicts=True,
+                unique_fields=["instance_id", "owner"],
+                update_fields=["series", "metadata", "frame_number", "file"],
+            )
+            self.pending = {}
+
+    def response(self) -> tuple[int, dict]:
+        """(HTTP status, DICOM JSON store response)."""
+        result = {}
+        if self.study_uid:
+            result.update([dicomweb.element("RetrieveURL", f"{self.base_url}/{self.study_uid}")])
+        if self.stored:
+            result["00081199"] = {"vr": "SQ", "Value": self.stored}
+        if self.failed:
+            result["00081198"] = {"vr": "SQ", "Value": self.failed}
+        if not self.failed:
+            return 200, result
+        return (202 if self.stored else 409), result
@@ -0,0 +1,221 @@
+"""
+DICOMweb WADO-RS retrieval helpers.
+
+Instances are streamed from storage as ``multipart/related`` parts, chunk by
+chunk. Frames are cut from the stored pixel data without decoding it: native
+frames are read at their offset, encapsulated frames one item after the
+other. Both keep the stored transfer syntax. Only ``rendered`` decodes pixels.
+
+Under ASGI, the parts are pulled through an async iterator. Django would
+otherwise buffer a sync iterator in full before sending it.
+"""
+import io
+import uuid
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+from PIL import Image
+from pydicom import dcmread
+from pydicom.encaps import generate_frames
+from pydicom.pixels import apply_modality_lut, apply_voi_lut, pixel_array
+
+from .files import CHUNK_SIZE, _iter_range, parse_range
+
+PIXEL_DATA = 0x7FE00010
+
+# frame media type by transfer syntax (PS3.18 table 8.7.3-5)
+FRAME_MEDIA_TYPES = {
+    "1.2.840.10008.1.2.4.50": "image/jpeg",
+    "1.2.840.10008.1.2.4.51": "image/jpeg",
+    "1.2.840.10008.1.2.4.57": "image/jpeg",
+    "1.2.840.10008.1.2.4.70": "image/jpeg",
+    "1.2.840.10008.1.2.4.80": "image/jls",
+    "1.2.840.10008.1.2.4.81": "image/jls",
+    "1.2.840.10008.1.2.4.90": "image/jp2",
+    "1.2.840.10008.1.2.4.91": "image/jp2",
+    "1.2.840.10008.1.2.4.201": "image/jphc",
+    "1.2.840.10008.1.2.4.202": "image/jphc",
+    "1.2.840.10008.1.2.4.203": "image/jphc",
+    "1.2.840.10008.1.2.5": "image/x-dicom-rle",
+}
+RENDERED_TYPES = {"image/jpeg": "JPEG", "image/png": "PNG"}
+
+
+class RetrieveError(ValueError):
+    """A WADO-RS request that cannot be answered; carries the HTTP status."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def read_header(path: str):
+    """The dataset without loading pixel data (its value is left deferred)."""
+    return dcmread(path, defer_size=1024)
+
+
+def pixel_data(ds):
+    """The raw, deferred pixel data element (``value_tell``/``length``)."""
+    element = ds._dict.get(PIXEL_DATA)
+    if element is None:
+        raise RetrieveError("Instance has no pixel data", 404)
+    return element
+
+
+def number_of_frames(ds) -> int:
+    return int(ds.get("NumberOfFrames") or 1)
+
+
+def frame_media_type(ds) -> str:
+    syntax = str(ds.file_meta.TransferSyntaxUID)
+    media_type = FRAME_MEDIA_TYPES.get(syntax, "application/octet-stream")
+    return f"{media_type}; transfer-syntax={syntax}"
+
+
+def parse_frames(numbers: str, total: int) -> list[int]:
+    """1-based frame numbers of a ``frames/{list}`` path segment."""
+    try:
+        frames = [int(n) for n in numbers.split(",")]
+    except ValueError:
+        raise RetrieveError(f"Invalid frame list {numbers}") from None
+    if any(n < 1 or n > total for n in frames):
+        raise RetrieveError(f"Frames are 1-{total}", 404)
+    return frames
+
+
+def frame_reader(path: str, ds, frames: list[int]):
+    """
+    Iterator over the stored bytes of each wanted frame, in the requested
+    order. Checks run before anything is read.
+    """
+    element = pixel_data(ds)
+    if ds.file_meta.TransferSyntaxUID.is_encapsulated:
+        return _encapsulated_frames(path, element, number_of_frames(ds), frames)
+    bits = ds.Rows * ds.Columns * ds.get("SamplesPerPixel", 1) * ds.BitsAllocated
+    if bits % 8:
+        raise RetrieveError("Frames of packed 1-bit pixel data are not byte aligned", 406)
+    return _native_frames(path, element, bits // 8, frames)
+
+
+def _native_frames(path: str, element, size: int, frames: list[int]):
+    with open(path, "rb") as f:
+        for number in frames:
+            f.seek(element.value_tell + (number - 1) * size)
+            yield f.read(size)
+
+
+def _encapsulated_frames(path: str, element, total: int, frames: list[int]):
+    # items are read in file order; only frames asked for out of order wait
+    pending, position = {}, 0
+    with open(path, "rb") as f:
+        f.seek(element.value_tell)
+        for number, frame in enumerate(generate_frames(f, number_of_frames=total), 1):
+            if number in frames[position:]:
+                pending[number] = frame
+            while position < len(frames) and frames[position] in pending:
+                yield pending[frames[position]]
+                position += 1
+            if position == len(frames):
+                return
+
+
+def iter_file(storage, name: str):
+    with storage.open(name, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def multipart(parts, boundary: str):
+    """
+    Encode ``(content_type, chunks)`` parts as a multipart/related body,
+    pulling each part's chunks only when the previous part is sent.
+    """
+    for content_type, chunks in parts:
+        yield f"--{boundary}\r\nContent-Type: {content_type}\r\n\r\n".encode()
+        yield from chunks
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def stream(request, chunks):
+    """``chunks`` as a response body that is not buffered under ASGI either."""
+    return _aiter(chunks) if isinstance(request, ASGIRequest) else chunks
+
+
+async def _aiter(chunks):
+    chunks = iter(chunks)
+    pull = sync_to_async(next)     # thread sensitive: storage and DB reads stay on one thread
+    while (chunk := await pull(chunks, None)) is not None:
+        yield chunk
+
+
+def multipart_response(request, parts, part_type: str):
+    boundary = uuid.uuid4().hex
+    body = multipart(parts, boundary)
+    response = StreamingHttpResponse(
+        stream(request, body),
+        content_type=f'multipart/related; type="{part_type}"; boundary={boundary}',
+    )
+    response["Cache-Control"] = "private, max-age=3600"
+    return response
+
+
+def native_pixel_data_response(request, path: str, ds):
+    """Native (uncompressed) pixel data as one octet stream, ``Range``-aware."""
+    element = pixel_data(ds)
+    size = element.length
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    start, end = byte_range or (0, size - 1)
+    chunks = _iter_range(open(path, "rb"), element.value_tell + start, end - start + 1)
+    response = StreamingHttpResponse(
+        stream(request, chunks),
+        status=206 if byte_range else 200,
+        content_type="application/octet-stream",
+    )
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def render(path: str, frame: int, media_type: str, window: str | None, viewport: str | None) -> bytes:
+    """
+    Decode one frame (1-based) to a JPEG or PNG, applying the modality LUT
+    and the VOI window (``window=center,width``, else the stored one).
+    """
+    ds = dcmread(path, stop_before_pixels=True)
+    arr = pixel_array(path, index=frame - 1)
+    if ds.get("SamplesPerPixel", 1) == 1:
+        arr = apply_modality_lut(arr, ds).astype(np.float64)
+        if window:
+            try:
+                center, width = (float(v) for v in window.split(",")[:2])
+            except ValueError:
+                raise RetrieveError(f"Invalid window {window}") from None
+            low, high = center - width / 2, center + width / 2
+        elif "WindowCenter" in ds or "VOILUTSequence" in ds:
+            arr = apply_voi_lut(arr, ds).astype(np.float64)
+            low, high = arr.min(), arr.max()
+        else:
+            low, high = arr.min(), arr.max()
+        arr = np.clip((arr - low) / max(high - low, 1e-9), 0, 1) * 255
+        if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+            arr = 255 - arr
+    image = Image.fromarray(arr.astype(np.uint8))
+    if viewport:
+        try:
+            width, height = (int(v) for v in viewport.split(",")[:2])
+        except ValueError:
+            raise RetrieveError(f"Invalid viewport {viewport}") from None
+        image.thumbnail((width, height))
+    out = io.BytesIO()
+    image.save(out, RENDERED_TYPES[media_type])
+    return out.getvalue()
@@ -1,31 +1,50 @@
 """
-Views for BFIT demo – upload, list, and (dummy) analysis API.
-Replace the dummy analysis stubs with real RQ jobs when available.
+Views for BFIT demo – upload, list, and analysis API.
+Analyses run as RQ jobs (bfitserver/tasks.py), or on the bounded local
+executor when ANALYSIS_LOCAL_MODE is set.
 """
 from __future__ import annotations
-import json, logging, shutil, threading, uuid
+import hashlib, json, logging, shutil, uuid
+from functools import partial, wraps
 from pathlib import Path
 
 from django.conf           import settings
+from django.http           import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts      import render, redirect, get_object_or_404
 from django.urls           import reverse
+from django.db             import transaction
+from django.db.models      import Count, F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils          import timezone
+from django.utils.cache    import get_conditional_response
+from django.utils.http     import http_date
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from django.utils.decorators      import method_decorator
 
 # ─── models & serializers ───────────────────────────────────────────
 from .models.user          import User
-from .models.dicomweb      import Study, Series, Instance
-from .models.analysis      import Analysis
+from .models.dicomweb      import Study, Series, Instance, PACSSeries
+from .models.analysis      import (
+    Analysis, AnalysisArtifact, PredictionResult, SegmentationResult,
+)
 from .serializers          import AnalysisSerializer
+from .pagination           import AnalysisCursorPagination, SeriesCursorPagination
+from .utils.files          import stored_file_response
+from .utils                import (
+    artifact_cache, dicomweb, events, idempotency, local_executor, metrics, scheduling, stow,
+    wado,
+)
+from .utils.analysis       import fail_analysis
 
 # ─── DICOM sorting helper ───────────────────────────────────────────
 from dicom_sorter          import DicomToNiftiSorter   # ← your converter
+from pydicom.errors        import InvalidDicomError
 
 
-# from .utils.analysis import abd, thigh, mmap
-
 # ─── DRF & RQ bits (analysis API) ───────────────────────────────────
 from rest_framework.viewsets      import ModelViewSet
+from rest_framework.request       import Request
 from rest_framework.response      import Response
 from rest_framework.decorators    import action
 from rest_framework               import status
@@ -38,38 +57,39 @@ from rq.exceptions                import NoSuchJobError, InvalidJobOperation
 logger = logging.getLogger(__name__)
 
 # -------------------------------------------------------------------
-#  Import analysis *tasks* – may be real RQ tasks or local stubs
+#  Analysis tasks (RQ job functions)
 # -------------------------------------------------------------------
-try:
-    from .tasks import (
-        segmentation_abdomen,
-        segmentation_thigh,
-        segmentation_mmap,
-    )
-except ModuleNotFoundError:
-    # fallback to built-in stubs if real tasks missing
-    from . import tasks as _stub_tasks
-    segmentation_abdomen = _stub_tasks.segmentation_abdomen
-    segmentation_thigh   = _stub_tasks.segmentation_thigh
-    segmentation_mmap    = _stub_tasks.segmentation_mmap
-    logger.warning("Real RQ tasks not found – using local stubs")
+from .tasks import (
+    PROFILE_ARTIFACT_TYPE,
+    cancel_inference,
+    segmentation_abdomen,
+    segmentation_thigh,
+    segmentation_mmap,
+)
 
 # ════════════════════════════════════════════════════════════════════
 #  1. Landing page ---------------------------------------------------
 # ════════════════════════════════════════════════════════════════════
 def home(request):
-    """Show every series currently stored in DB (for demo only)."""
+    """Browse the stored series (for demo only), one keyset page at a time."""
     user = User.objects.filter(username="admin").first()
+    # counted per row of the page only, not grouped over every instance
+    instances = (
+        Instance.objects.filter(series=OuterRef("pk"))
+        .order_by().values("series").annotate(n=Count("pk")).values("n")
+    )
     series_qs = (
         Series.objects.filter(owner=user)
-        .select_related("study")
-        .order_by("-created_at")
+        .values("series_id", "modality", "created_at", study_uid=F("study__study_id"))
+        .annotate(instances=Coalesce(Subquery(instances), 0))
     )
-    entries = [
-        dict(study_id=s.study.study_id, series_id=s.series_id, modality=s.modality)
-        for s in series_qs
-    ]
-    return render(request, "uploader/success.html", {"entries": entries})
+    paginator = SeriesCursorPagination()
+    entries   = paginator.paginate_queryset(series_qs, Request(request))
+    return render(request, "uploader/success.html", {
+        "entries":  entries,
+        "next":     paginator.get_next_link(),
+        "previous": paginator.get_previous_link(),
+    })
 
 
 # ════════════════════════════════════════════════════════════════════
@@ -113,9 +133,14 @@ def upload_dicom_folder(request):
             series_id=m["series_id"], owner=user, study=study,
             defaults=dict(modality=m["modality"]),
         )
+        try:
+            fields = dicomweb.instance_fields(m["file_path"])
+        except (InvalidDicomError, OSError, ValueError, TypeError) as e:
+            logger.warning("Could not read the header of %s: %s", m["file_path"], e)
+            fields = dict(metadata={}, frame_number=None)
         Instance.objects.get_or_create(
             instance_id=m["instance_id"], owner=user, series=series,
-            defaults=dict(frame_number=1, metadata={}, file=m["file_path"]),
+            defaults=dict(file=m["file_path"], **fields),
         )
 
     shutil.rmtree(upload_root, ignore_errors=True)
@@ -123,22 +148,73 @@ def upload_dicom_folder(request):
 
 
 # ════════════════════════════════════════════════════════════════════
-#  3. Analysis API (dummy / dev) -------------------------------------
+#  3. Result file downloads (streamed, Range-aware) ------------------
+# ════════════════════════════════════════════════════════════════════
+def segmentation_file(request, pk):
+    """Stream a stored segmentation mask as-is (``.nii.gz`` stays gzip-encoded)."""
+    result = get_object_or_404(SegmentationResult, pk=pk)
+    return stored_file_response(request, result.segmentation_mask)
+
+
+def artifact_file(request, pk):
+    """Stream a stored analysis artifact as-is."""
+    artifact = get_object_or_404(AnalysisArtifact, pk=pk)
+    return stored_file_response(request, artifact.artifact)
+
+
+# ════════════════════════════════════════════════════════════════════
+#  4. Analysis status push (Server-Sent Events, served via ASGI) -----
+# ════════════════════════════════════════════════════════════════════
+async def analysis_events(request):
+    """
+    Stream analysis status changes as ``text/event-stream``.
+
+    ``?id=<job_id>`` (repeatable) limits the stream to specific analyses.
+    Run under ASGI (``dicom_project.asgi``) so each client holds a
+    coroutine rather than a worker thread.
+    """
+    wanted = set(request.GET.getlist("id"))
+
+    async def stream():
+        yield "retry: 5000\n\n"
+        async for event in events.subscribe():
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            if wanted and event.get("id") not in wanted:
+                continue
+            yield f"event: status\ndata: {json.dumps(event)}\n\n"
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"]     = "no-cache"
+    response["X-Accel-Buffering"] = "no"      # let nginx pass events through
+    return response
+
+
+# ════════════════════════════════════════════════════════════════════
+#  5. Prometheus metrics ---------------------------------------------
+# ════════════════════════════════════════════════════════════════════
+def prometheus_metrics(request):
+    """Scrape endpoint: job counters/durations, busy workers, queue depths."""
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
+
+
+# ════════════════════════════════════════════════════════════════════
+#  6. Analysis API (dummy / dev) -------------------------------------
 # ════════════════════════════════════════════════════════════════════
 
-# -- helper: run a plain function in a background thread -------------
-def _run_stub(fn, *a, **kw) -> str:
-    job_id = f"local-{uuid.uuid4()}"
-    t = threading.Thread(target=fn, args=a, kwargs=kw, daemon=True)
-    t.start()
-    logger.info("Started stub %s in thread %s", job_id, t.name)
-    return job_id
+# -- helper: parse a JSON artifact (memoized via artifact_cache) ------
+def _load_json_artifact(artifact: AnalysisArtifact):
+    with artifact.artifact.open("rb") as f:
+        return json.load(f)
 
 
 @method_decorator(csrf_exempt, name="dispatch")
 class AnalysisViewSet(ModelViewSet):
     queryset         = Analysis.objects.all()
     serializer_class = AnalysisSerializer
+    pagination_class = AnalysisCursorPagination
 
     # 🔧  ADD THIS ↓  – disables SessionAuthentication (and its CSRF check)
     authentication_classes = []        # <- nothing → no CSRF enforcement
@@ -146,75 +222,601 @@ class AnalysisViewSet(ModelViewSet):
     # ------------------- utils -------------------
     def get_queryset(self):
         return (
-            self.queryset.select_related("series", "series__study")
-            .order_by("-created_at")
+            self.queryset.select_related(
+                "series", "series__study", "pacs_series", "pacs_series__study"
+            )
+            .order_by("-created_at", "-id")
         )
 
-    def _enqueue(self, series: Series, dicoms: list[str]) -> tuple[str, Analysis.Queue]:
-        """Return (job_id, queue) – works with real RQ or local stub."""
-        if series.modality == Series.Modality.ABD:
-            task, queue = segmentation_abdomen, Analysis.Queue.ABDOMEN
-        elif series.modality == Series.Modality.THIGH:
-            task, queue = segmentation_thigh,  Analysis.Queue.THIGH
-        elif series.modality == Series.Modality.MMAP:
-            task, queue = segmentation_mmap,   Analysis.Queue.MMAP
-        else:
-            raise ValueError(f"Unsupported modality {series.modality}")
+    def _validators(self, ids: list, extra: str = "") -> tuple[str, float | None]:
+        """
+        (ETag, Last-Modified) for the analyses ``ids`` (one page at most).
+
+        Derived from the ids and their timestamps only – ``Analysis.ended_at``
+        is auto_now, results carry ``updated_at`` – so an unchanged poll costs
+        a few aggregates over one page, served by the (analysis, updated_at)
+        indexes, instead of a full serialization.
+        """
+        last = Analysis.objects.filter(pk__in=ids).aggregate(last=Max("ended_at"))["last"]
+        for model in (SegmentationResult, AnalysisArtifact, PredictionResult):
+            result_last = model.objects.filter(analysis__in=ids).aggregate(
+                last=Max("updated_at")
+            )["last"]
+            if result_last and (last is None or result_last > last):
+                last = result_last
+
+        # whole seconds, as If-Modified-Since is compared against it
+        last_modified = int(last.timestamp()) if last else None
+        digest = hashlib.md5(
+            f"{','.join(ids)}:{last_modified}:{extra}:{self.request.get_full_path()}".encode()
+        ).hexdigest()
+        return f'W/"{digest}"', last_modified
+
+    def _conditional(self, request, ids, render, extra=""):
+        """Answer 304 if the client's copy is current, else render and tag."""
+        etag, last_modified = self._validators(ids, extra)
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if not_modified is not None:
+            return not_modified
+
+        response = render()
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        response["Cache-Control"] = "no-cache"
+        return response
 
-        # real RQ job?
-        if hasattr(task, "delay"):
-            job = task.delay(dicoms=dicoms)
-            return job.id, queue
+    # ------------------- read --------------------
+    def list(self, request, *args, **kwargs):
+        # validate only the requested cursor page, not the whole table
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        links = f"{self.paginator.get_next_link()}:{self.paginator.get_previous_link()}"
+        return self._conditional(
+            request,
+            [analysis.pk for analysis in page],
+            lambda: self.get_paginated_response(self.get_serializer(page, many=True).data),
+            links,
+        )
 
-        # fallback → local thread
-        return _run_stub(task, dicoms=dicoms), queue
+    def retrieve(self, request, *args, **kwargs):
+        analysis = self.get_object()
+        return self._conditional(
+            request, [analysis.pk], partial(super().retrieve, request, *args, **kwargs)
+        )
+
+    def _route(self, series: Series | PACSSeries):
+        """Return (task, queue) for the series' modality."""
+        if series.modality == Series.Modality.ABD:
+            return segmentation_abdomen, Analysis.Queue.ABDOMEN
+        if series.modality == Series.Modality.THIGH:
+            return segmentation_thigh,  Analysis.Queue.THIGH
+        if series.modality == Series.Modality.MMAP:
+            return segmentation_mmap,   Analysis.Queue.MMAP
+        raise ValueError(f"Unsupported modality {series.modality}")
 
     # ------------------- create ------------------
     def create(self, request, *_, **__):
-        sid = request.query_params.get("series_id")
-        if not sid:
-            return Response({"error": "series_id missing"}, 400)
+        """
+        Start an analysis of ``?series_id=``, or return the existing one.
+
+        ``?pacs_series_id=`` analyses a PACS-indexed series instead: its
+        files are read where the index found them, not copied into storage.
 
-        series = get_object_or_404(Series, series_id=sid)
-        dicoms = [d.file.path for d in Instance.objects.filter(series=series)]
+        An analysis that is processing or completed for the same inputs (see
+        utils/idempotency.py) is returned with 200 instead of enqueuing a
+        duplicate; ``?force=1`` always starts a new run.
+        """
+        sid      = request.query_params.get("series_id")
+        pacs_sid = request.query_params.get("pacs_series_id")
+        if bool(sid) == bool(pacs_sid):
+            return Response({"error": "give either series_id or pacs_series_id"}, 400)
+        priority = request.query_params.get("priority", Analysis.Priority.INTERACTIVE)
+        if priority not in Analysis.Priority.values:
+            return Response({"error": f"priority must be one of {Analysis.Priority.values}"}, 400)
+        model_params = request.data.get("model_params") if hasattr(request.data, "get") else None
+        if model_params is not None and not isinstance(model_params, dict):
+            return Response({"error": "model_params must be an object"}, 400)
+        force = request.query_params.get("force", "").lower() in ("1", "true")
 
+        if pacs_sid:
+            series = get_object_or_404(PACSSeries, series_id=pacs_sid)
+        else:
+            series = get_object_or_404(Series, series_id=sid)
         try:
-            job_id, queue = self._enqueue(series, dicoms)
+            task, queue = self._route(series)
         except ValueError as e:
             return Response({"error": str(e)}, 400)
 
-        Analysis.objects.update_or_create(
-            id=job_id,
-            defaults=dict(
-                queue   = queue,
-                status  = Analysis.Status.PROCESSING,
-                series  = series,
-                owner   = User.objects.get(username="admin"),
-            ),
-        )
-        logger.info("Enqueued %s analysis – job_id=%s", queue, job_id)
+        owner   = User.objects.get(username="admin")
+        version = idempotency.model_version(queue)
+        digest  = idempotency.input_hash(series, queue, version, model_params)
+
+        with transaction.atomic():
+            # serialise creates per series so concurrent duplicates see each other
+            type(series).objects.select_for_update().filter(pk=series.pk).first()
+            existing = None if force else idempotency.find_reusable(owner, digest)
+            if existing is not None:
+                return self._reuse(existing, priority)
+
+            # RQ jobs go through the scheduler, local mode skips admission
+            local  = settings.ANALYSIS_LOCAL_MODE
+            job_id = str(uuid.uuid4())
+            analysis, _ = Analysis.objects.update_or_create(
+                id=job_id,
+                defaults=dict(
+                    queue   = queue,
+                    status  = Analysis.Status.PROCESSING,
+                    series      = None if pacs_sid else series,
+                    pacs_series = series if pacs_sid else None,
+                    owner   = owner,
+                    stage   = Analysis.Stage.QUEUED,
+                    progress      = 0,
+                    stage_timings = {
+                        Analysis.Stage.QUEUED: {"started_at": timezone.now().isoformat()}
+                    },
+                    priority      = priority,
+                    admitted_at   = timezone.now() if local else None,
+                    model_params  = model_params,
+                    model_version = version,
+                    input_hash    = digest,
+                ),
+            )
+        if local:
+            try:
+                local_executor.submit(task, job_id, dicoms=scheduling.input_files(analysis))
+            except local_executor.QueueFull as e:
+                fail_analysis(analysis, e)
+                return Response({"error": str(e)}, 503)
+        events.publish_status(analysis)
+        if not local:
+            scheduling.dispatch(queue)
+        logger.info("Enqueued %s %s analysis – job_id=%s", priority, queue, job_id)
         return Response(
-            {"job_id": job_id, "queue": queue, "status": "started"},
+            {"job_id": job_id, "queue": queue, "priority": priority,
+             "status": "started", "reused": False},
             status=201,
         )
 
+    def _reuse(self, analysis: Analysis, priority: str) -> Response:
+        # an interactive request promotes a batch job still waiting for admission
+        if (
+            priority == Analysis.Priority.INTERACTIVE
+            and analysis.priority == Analysis.Priority.BATCH
+            and analysis.admitted_at is None
+        ):
+            analysis.priority = priority
+            analysis.save(update_fields=["priority", "ended_at"])
+            transaction.on_commit(partial(scheduling.dispatch, analysis.queue))
+        logger.info("Reusing %s analysis – job_id=%s", analysis.status, analysis.id)
+        return Response(
+            {"job_id": analysis.id, "queue": analysis.queue, "priority": analysis.priority,
+             "status": analysis.status, "reused": True},
+            status=200,
+        )
+
     # ------------------- cancel ------------------
     @action(detail=True, methods=["post"])
     def cancel(self, request, pk=None):
         analysis = self.get_object()
-        # try real RQ first
+        running = analysis.status == Analysis.Status.PROCESSING
+        # marked first, so the failure of the aborted job does not overwrite it
+        analysis.status = Analysis.Status.CANCELED
+        analysis.save()
+        events.publish_status(analysis)
+        if settings.ANALYSIS_LOCAL_MODE:
+            if running:
+                cancel_inference(analysis.queue, analysis.id)
+        else:
+            try:
+                conn = get_connection(analysis.queue)
+                job  = Job.fetch(analysis.id, connection=conn)
+                if job.get_status() == "started":
+                    # the worker asks the inference service to abort the request
+                    send_stop_job_command(conn, job.id)
+                else:
+                    job.cancel()
+            except Exception:
+                # job not admitted yet, or job already gone
+                pass
+        if analysis.admitted_at is not None:
+            scheduling.dispatch(analysis.queue)   # hand the freed slot on
+        return Response(status=200)
+
+    # ------------------- profile -----------------
+    @action(detail=True, methods=["get"])
+    def profile(self, request, pk=None):
+        """
+        Per-slice tissue volumes from the ``volume_profile`` artifact.
+
+        ``?tissue=SSAT&tissue=VAT`` limits the tissues, ``?start=&stop=`` the
+        slice window, so viewers can fetch and plot the profile incrementally.
+        """
+        analysis = self.get_object()
+        artifact = (
+            AnalysisArtifact.objects.filter(
+                analysis=analysis, artifact_type=PROFILE_ARTIFACT_TYPE
+            )
+            .order_by("-updated_at")
+            .first()
+        )
+        if artifact is None:
+            return Response({"error": "volume profile not available"}, 404)
+
+        profile = artifact_cache.get_decoded(artifact, _load_json_artifact)
+
         try:
-            conn = get_connection(analysis.queue)
-            job  = Job.fetch(analysis.id, connection=conn)
-            if job.get_status() == "started":
-                send_stop_job_command(conn, job.id)
-            else:
-                job.cancel()
-            analysis.status = Analysis.Status.CANCELED
-            analysis.save()
-            return Response(status=200)
-        except Exception:
-            # stub or job already gone
-            analysis.status = Analysis.Status.CANCELED
-            analysis.save()
-            return Response(status=200)
+            num_slices = int(profile["num_slices"])
+            start = int(request.query_params.get("start", 0))
+            stop  = int(request.query_params.get("stop", num_slices))
+        except ValueError:
+            return Response({"error": "start/stop must be integers"}, 400)
+        # clamp before slicing so negative values never index from the end
+        start = min(max(start, 0), num_slices)
+        stop  = min(max(stop, start), num_slices)
+
+        wanted  = request.query_params.getlist("tissue") or list(profile["tissues"])
+        unknown = [t for t in wanted if t not in profile["tissues"]]
+        if unknown:
+            return Response({"error": f"unknown tissue(s) {', '.join(unknown)}"}, 400)
+
+        return Response({
+            "region":          profile["region"],
+            "unit":            profile["unit"],
+            "voxel_volume_cc": profile["voxel_volume_cc"],
+            "num_slices":      num_slices,
+            "start":           start,
+            "stop":            stop,
+            "tissues":         {t: profile["tissues"][t][start:stop] for t in wanted},
+        })
+
+
+# ════════════════════════════════════════════════════════════════════
+#  7. DICOMweb QIDO-RS search (see utils/dicomweb.py) ----------------
+# ════════════════════════════════════════════════════════════════════
+def _archive_owner(request):
+    """The archive DICOMweb serves: the signed-in user, else the demo admin."""
+    if request.user.is_authenticated:
+        return request.user
+    return User.objects.filter(username="admin").first()
+
+
+def _dicomweb_base(request) -> str:
+    """Absolute .../dicomweb/studies URL, under the prefix the client called."""
+    return request.build_absolute_uri(request.path.split("/dicomweb/")[0] + "/dicomweb/studies")
+
+
+def _qido(request, level: str, search):
+    try:
+        query = dicomweb.Query(request.GET, level)
+        conditions = query.conditions()
+    except dicomweb.QueryError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    results = search(query, conditions, _archive_owner(request), _dicomweb_base(request))
+    if not results:
+        return HttpResponse(status=204)
+    return JsonResponse(results, safe=False, content_type="application/dicom+json")
+
+
+def _study_values(row: dict, prefix: str = "") -> dict:
+    return {
+        "StudyInstanceUID": row[f"{prefix}study_id"],
+        "PatientID":        row[f"{prefix}patient_id"],
+        "PatientName":      row[f"{prefix}patient_name"],
+        "StudyDate":        row[f"{prefix}study_date"],
+    }
+
+
+@require_GET
+def qido_studies(request):
+    """QIDO-RS: GET /dicomweb/studies"""
+    def search(query, conditions, owner, base):
+        studies = list(query.page(
+            Study.objects.filter(*conditions, owner=owner).order_by("pk")
+            .values("pk", "study_id", "patient_id", "patient_name", "study_date")
+            .annotate(
+                metadata=dicomweb.representative("series__study"),
+                n_series=dicomweb.related_count(Series.objects.all(), "study"),
+                n_instances=dicomweb.related_count(Instance.objects.all(), "series__study"),
+            )
+        ))
+        # ModalitiesInStudy, from the first instance of each series
+        modalities = {}
+        first = Instance.objects.filter(series=OuterRef("pk")).order_by("frame_number")
+        for study, modality in (
+            Series.objects.filter(study__in=[s["pk"] for s in studies])
+            .annotate(dicom_modality=Subquery(
+                first.annotate(m=dicomweb.first_value("Modality")).values("m")[:1]
+            ))
+            .values_list("study", "dicom_modality")
+        ):
+            if modality:
+                modalities.setdefault(study, set()).add(modality)
+        return [
+            dicomweb.dataset(query, {
+                **_study_values(s),
+                "ModalitiesInStudy":             sorted(modalities.get(s["pk"], ())),
+                "NumberOfStudyRelatedSeries":    s["n_series"],
+                "NumberOfStudyRelatedInstances": s["n_instances"],
+                "RetrieveURL":                   f"{base}/{s['study_id']}",
+            }, s["metadata"])
+            for s in studies
+        ]
+
+    return _qido(request, dicomweb.STUDY, search)
+
+
+@require_GET
+def qido_series(request, study: str | None = None):
+    """QIDO-RS: GET /dicomweb/series, /dicomweb/studies/{study}/series"""
+    def search(query, conditions, owner, base):
+        series = Series.objects.filter(*conditions, owner=owner)
+        if study is not None:
+            series = series.filter(study__study_id=study)
+        rows = query.page(
+            series.order_by("pk")
+            .values(
+                "series_id", "study__study_id", "study__patient_id",
+                "study__patient_name", "study__study_date",
+            )
+            .annotate(
+                metadata=dicomweb.representative("series"),
+                n_instances=dicomweb.related_count(Instance.objects.all(), "series"),
+            )
+        )
+        return [
+            dicomweb.dataset(query, {
+                **_study_values(s, "study__"),
+                "SeriesInstanceUID":              s["series_id"],
+                "NumberOfSeriesRelatedInstances": s["n_instances"],
+                "RetrieveURL": f"{base}/{s['study__study_id']}/series/{s['series_id']}",
+            }, s["metadata"])
+            for s in rows
+        ]
+
+    return _qido(request, dicomweb.SERIES, search)
+
+
+@require_GET
+def qido_instances(request, study: str | None = None, series: str | None = None):
+    """
+    QIDO-RS: GET /dicomweb/instances, /dicomweb/studies/{study}/instances,
+    /dicomweb/studies/{study}/series/{series}/instances
+    """
+    def search(query, conditions, owner, base):
+        instances = Instance.objects.filter(*conditions, owner=owner)
+        if study is not None:
+            instances = instances.filter(series__study__study_id=study)
+        if series is not None:
+            instances = instances.filter(series__series_id=series)
+        rows = query.page(
+            instances.order_by("series_id", "frame_number")
+            .values(
+                "instance_id", "frame_number", "metadata", "series__series_id",
+                "series__study__study_id", "series__study__patient_id",
+                "series__study__patient_name", "series__study__study_date",
+            )
+        )
+        return [
+            dicomweb.dataset(query, {
+                **_study_values(i, "series__study__"),
+                "SeriesInstanceUID": i["series__series_id"],
+                "SOPInstanceUID":    i["instance_id"],
+                "InstanceNumber":    i["frame_number"],
+                "RetrieveURL": (
+                    f"{base}/{i['series__study__study_id']}/series/"
+                    f"{i['series__series_id']}/instances/{i['instance_id']}"
+                ),
+            }, i["metadata"])
+            for i in rows
+        ]
+
+    return _qido(request, dicomweb.INSTANCE, search)
+
+
+# ════════════════════════════════════════════════════════════════════
+#  8. DICOMweb WADO-RS retrieval (see utils/wado.py) -----------------
+# ════════════════════════════════════════════════════════════════════
+def _wado_instances(request, study: str, series: str | None = None, instance: str | None = None):
+    instances = Instance.objects.filter(
+        owner=_archive_owner(request), series__study__study_id=study
+    )
+    if series is not None:
+        instances = instances.filter(series__series_id=series)
+    if instance is not None:
+        instances = instances.filter(instance_id=instance)
+    return instances.order_by("series_id", "frame_number")
+
+
+def _wado_instance(request, study: str, series: str, instance: str) -> Instance:
+    found = _wado_instances(request, study, series, instance).first()
+    if found is None:
+        raise wado.RetrieveError("Instance not found", 404)
+    return found
+
+
+def _wado(view):
+    """Answer RetrieveError as a JSON error with its status."""
+    @require_GET
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except wado.RetrieveError as e:
+            return JsonResponse({"error": str(e)}, status=e.status)
+    return wrapper
+
+
+@_wado
+def wado_retrieve(request, study: str, series: str | None = None, instance: str | None = None):
+    """
+    WADO-RS: GET /dicomweb/studies/{study}[/series/{series}[/instances/{instance}]]
+
+    Streams the stored files as multipart/related parts. A single instance
+    asked for as plain ``application/dicom`` is sent as one Range-aware file.
+    """
+    accept = request.headers.get("Accept", "*/*")
+    instances = _wado_instances(request, study, series, instance)
+    if instance is not None and accept.split(";")[0].strip() == "application/dicom":
+        found = instances.first()
+        if found is None:
+            raise wado.RetrieveError("Instance not found", 404)
+        return stored_file_response(request, found.file)
+    if "multipart/related" not in accept and "*/*" not in accept:
+        raise wado.RetrieveError("Instances are sent as multipart/related application/dicom", 406)
+    if not instances.exists():
+        raise wado.RetrieveError("Not found", 404)
+
+    storage = Instance._meta.get_field("file").storage
+    names = instances.values_list("file", flat=True).iterator(chunk_size=500)
+    parts = (("application/dicom", wado.iter_file(storage, name)) for name in names)
+    return wado.multipart_response(request, parts, "application/dicom")
+
+
+@_wado
+def wado_metadata(request, study: str, series: str | None = None, instance: str | None = None):
+    """
+    WADO-RS: GET .../metadata of a study, series or instance
+
+    The stored DICOM JSON of each instance, served from the DB and streamed
+    as a JSON array; pixel data is referenced through a BulkDataURI.
+    """
+    instances = _wado_instances(request, study, series, instance)
+    if not instances.exists():
+        raise wado.RetrieveError("Not found", 404)
+    base = _dicomweb_base(request)
+    rows = instances.values(
+        "instance_id", "frame_number", "metadata", "series__series_id",
+        "series__study__study_id", "series__study__patient_id",
+        "series__study__patient_name", "series__study__study_date",
+    ).iterator(chunk_size=500)
+
+    def datasets():
+        yield "["
+        for n, row in enumerate(rows):
+            url = (
+                f"{base}/{row['series__study__study_id']}/series/"
+                f"{row['series__series_id']}/instances/{row['instance_id']}"
+            )
+            ds = dict(row["metadata"])
+            for keyword, value in {
+                **_study_values(row, "series__study__"),
+                "SeriesInstanceUID": row["series__series_id"],
+                "SOPInstanceUID":    row["instance_id"],
+                "InstanceNumber":    row["frame_number"],
+            }.items():
+                tag, element = dicomweb.element(keyword, value)
+                if "Value" in element:
+                    ds[tag] = element
+            if dicomweb.tag("Rows") in ds:
+                ds[dicomweb.tag("PixelData")] = {"vr": "OW", "BulkDataURI": f"{url}/bulkdata/7FE00010"}
+            yield ("," if n else "") + json.dumps(dict(sorted(ds.items())))
+        yield "]"
+
+    return StreamingHttpResponse(
+        wado.stream(request, datasets()), content_type="application/dicom+json"
+    )
+
+
+@_wado
+def wado_frames(request, study: str, series: str, instance: str, frames: str):
+    """
+    WADO-RS: GET .../instances/{instance}/frames/{1,2,...}
+
+    Frames in their stored transfer syntax, one multipart part each.
+    """
+    found = _wado_instance(request, study, series, instance)
+    ds    = wado.read_header(found.file.path)
+    numbers    = wado.parse_frames(frames, wado.number_of_frames(ds))
+    media_type = wado.frame_media_type(ds)
+    reader     = wado.frame_reader(found.file.path, ds, numbers)
+    return wado.multipart_response(
+        request, ((media_type, [frame]) for frame in reader), media_type.split(";")[0]
+    )
+
+
+@_wado
+def wado_bulkdata(request, study: str, series: str, instance: str, tag: str):
+    """
+    WADO-RS: GET .../instances/{instance}/bulkdata/7FE00010
+
+    Native pixel data as one Range-aware octet stream; encapsulated pixel
+    data as its frames.
+    """
+    if tag.upper() != "7FE00010":
+        raise wado.RetrieveError("Only pixel data is kept as bulk data", 404)
+    found = _wado_instance(request, study, series, instance)
+    ds    = wado.read_header(found.file.path)
+    if not ds.file_meta.TransferSyntaxUID.is_encapsulated:
+        return wado.native_pixel_data_response(request, found.file.path, ds)
+    numbers    = list(range(1, wado.number_of_frames(ds) + 1))
+    media_type = wado.frame_media_type(ds)
+    reader     = wado.frame_reader(found.file.path, ds, numbers)
+    return wado.multipart_response(
+        request, ((media_type, [frame]) for frame in reader), media_type.split(";")[0]
+    )
+
+
+@_wado
+def wado_rendered(request, study: str, series: str, instance: str, frames: str = "1"):
+    """
+    WADO-RS: GET .../instances/{instance}[/frames/{frame}]/rendered
+
+    One frame as JPEG (default) or PNG; ``window=center,width`` and
+    ``viewport=width,height`` are honoured.
+    """
+    accept = request.headers.get("Accept", "")
+    media_type = "image/png" if "image/png" in accept else "image/jpeg"
+    if accept and media_type not in accept and "image/*" not in accept and "*/*" not in accept:
+        raise wado.RetrieveError("Rendered frames are image/jpeg or image/png", 406)
+    found = _wado_instance(request, study, series, instance)
+    ds    = wado.read_header(found.file.path)
+    numbers = wado.parse_frames(frames, wado.number_of_frames(ds))
+    if len(numbers) != 1:
+        raise wado.RetrieveError("Render one frame at a time")
+    body = wado.render(
+        found.file.path, numbers[0], media_type,
+        request.GET.get("window"), request.GET.get("viewport"),
+    )
+    response = HttpResponse(body, content_type=media_type)
+    response["Cache-Control"] = "private, max-age=3600"
+    return response
+
+
+# ════════════════════════════════════════════════════════════════════
+#  9. DICOMweb STOW-RS ingest (see utils/stow.py) --------------------
+# ════════════════════════════════════════════════════════════════════
+def stow_instances(request, study: str | None = None):
+    """
+    STOW-RS: POST /dicomweb/studies[/{study}]
+
+    Stores the application/dicom parts of a multipart/related body as it is
+    read; answers 200 (all stored), 202 (some failed) or 409 (none stored).
+    """
+    ingest = stow.Ingest(_archive_owner(request), study, _dicomweb_base(request))
+    try:
+        boundary = stow.boundary(request.META.get("CONTENT_TYPE", ""))
+        for headers, chunks in stow.iter_parts(request, boundary):
+            ingest.add(headers, chunks)
+    except stow.StoreError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    finally:
+        ingest.flush()      # keep the rows of parts already stored
+    http_status, result = ingest.response()
+    logger.info(
+        "STOW stored %d instance(s), %d failed",
+        len(result.get("00081199", {}).get("Value", [])),
+        len(result.get("00081198", {}).get("Value", [])),
+    )
+    return JsonResponse(result, status=http_status, content_type="application/dicom+json")
+
+
+@csrf_exempt
+def dicomweb_studies(request, study: str | None = None):
+    """/dicomweb/studies[/{study}]: POST stores (STOW-RS), GET searches or retrieves."""
+    if request.method == "POST":
+        return stow_instances(request, study)
+    if study is None:
+        return qido_studies(request)
+    return wado_retrieve(request, study)
@@ -26,6 +26,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
+    'django_rq',
     'bfitserver',  # ✅ Renamed app
 ]
 
@@ -114,6 +116,10 @@ TEMPLATES = [
 # WSGI
 # ----------------------
 WSGI_APPLICATION = 'dicom_project.wsgi.application'
+# /api/analysis/events/ streams Server-Sent Events; serve it through the ASGI
+# app (e.g. `uvicorn dicom_project.asgi:application`) so idle streams do not
+# pin a worker thread each.
+ASGI_APPLICATION = 'dicom_project.asgi.application'
 
 # ----------------------
 # PostgreSQL Database
@@ -129,6 +135,91 @@ DATABASES = {
     }
 }
 
+# ----------------------
+# Redis (RQ queues and analysis status events)
+# ----------------------
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# Pub/sub channel carrying Analysis status transitions to the SSE endpoint
+ANALYSIS_EVENTS_CHANNEL = "bfit:analysis-events"
+
+# ----------------------
+# Analysis queues & scheduling (see bfitserver/utils/scheduling.py)
+# ----------------------
+# One RQ queue per analysis queue and priority; workers listen to
+# "<queue> <queue>-batch" so interactive jobs are always taken first.
+ANALYSIS_QUEUES = ("abd", "thigh", "mmap")
+RQ_QUEUES = {
+    f"{queue}{suffix}": {"URL": REDIS_URL}
+    for queue in ANALYSIS_QUEUES
+    for suffix in ("", "-batch")
+}
+# Jobs per analysis queue allowed on RQ at once; the rest wait for admission
+ANALYSIS_ADMISSION_LIMITS = {
+    queue: int(os.environ.get(f"{queue.upper()}_ADMISSION_LIMIT", 4))
+    for queue in ANALYSIS_QUEUES
+}
+# Worker processes per analysis queue, forked by "manage.py aiworkerpool <queue>"
+ANALYSIS_WORKER_CONCURRENCY = {
+    queue: int(os.environ.get(f"{queue.upper()}_WORKERS", 1))
+    for queue in ANALYSIS_QUEUES
+}
+# Imported by the pool parent before it forks its workers. Entries are modules or
+# "module:callable" hooks; the models themselves live in the inference services,
+# so list a loader here when a queue runs its model inside the worker.
+ANALYSIS_WORKER_PRELOAD = [
+    "bfitserver.tasks",
+    *filter(None, os.environ.get("ANALYSIS_WORKER_PRELOAD", "").split(",")),
+]
+# Retries of transient inference failures and the first backoff in seconds,
+# doubled per attempt (see bfitserver/utils/retry.py); run by the RQ scheduler
+ANALYSIS_RETRIES = {
+    queue: int(os.environ.get(f"{queue.upper()}_RETRIES", 2))
+    for queue in ANALYSIS_QUEUES
+}
+ANALYSIS_RETRY_BACKOFF = {
+    queue: int(os.environ.get(f"{queue.upper()}_RETRY_BACKOFF", 30))
+    for queue in ANALYSIS_QUEUES
+}
+# Model deployed behind each queue; part of the input hash, so bumping it makes
+# new requests re-run instead of reusing earlier results
+ANALYSIS_MODEL_VERSIONS = {
+    queue: os.environ.get(f"{queue.upper()}_MODEL_VERSION", "1")
+    for queue in ANALYSIS_QUEUES
+}
+
+# ----------------------
+# Inference services (see bfitserver/tasks.py)
+# ----------------------
+AI_ENDPOINTS = {
+    "abd":   os.environ.get("AI_ABD_ENDPOINT", "http://localhost:5000/segment/abdomen-ct"),
+    "thigh": os.environ.get("AI_THIGH_ENDPOINT", "http://localhost:5000/segment/thigh-ct"),
+    "mmap":  os.environ.get("AI_MMAP_ENDPOINT", "http://localhost:5001/musclemap/thigh"),
+}
+# Hard limit per analysis job (RQ kills the work horse) and per inference request
+ANALYSIS_JOB_TIMEOUT = int(os.environ.get("ANALYSIS_JOB_TIMEOUT", 3600))
+AI_CONNECT_TIMEOUT = int(os.environ.get("AI_CONNECT_TIMEOUT", 10))
+# Seconds between polls of the inference service's /progress/<analysis id>
+ANALYSIS_PROGRESS_POLL_INTERVAL = float(os.environ.get("ANALYSIS_PROGRESS_POLL_INTERVAL", 5))
+# Local mode runs analyses on a bounded thread pool inside the web process
+# instead of RQ, for development without Redis and workers.
+ANALYSIS_LOCAL_MODE = os.environ.get("ANALYSIS_LOCAL_MODE", "False") == "True"
+ANALYSIS_LOCAL_WORKERS = int(os.environ.get("ANALYSIS_LOCAL_WORKERS", 2))
+ANALYSIS_LOCAL_QUEUE_SIZE = int(os.environ.get("ANALYSIS_LOCAL_QUEUE_SIZE", 16))
+
+# ----------------------
+# Caches
+# ----------------------
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+# Decoded analysis artifacts (bfitserver/utils/artifact_cache.py): an LRU per
+# process, bounded by the total stored size of the cached artifacts
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get("ARTIFACT_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+# Artifacts larger than this are not cached
+ARTIFACT_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("ARTIFACT_CACHE_MAX_ENTRY_BYTES", 8 * 1024 * 1024))
+
 # ----------------------
 # Custom User Model
 # ----------------------
@@ -168,6 +259,10 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# When set (e.g. "/protected-media/"), result downloads are handed to nginx via
+# X-Accel-Redirect; the prefix must map to an `internal` location over MEDIA_ROOT.
+FILE_ACCEL_REDIRECT_PREFIX = os.environ.get("FILE_ACCEL_REDIRECT_PREFIX")
+
 # ----------------------
 # Default Primary Key Field
 # ----------------------
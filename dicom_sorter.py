@@ -7,6 +7,27 @@ from pydicom.multival import MultiValue
 from collections import defaultdict
 
 
+def clean(s):
+    if isinstance(s, MultiValue):
+        s = " ".join(str(item) for item in s)
+    return str(s).strip().lower().replace("+af8-", "_")
+
+
+def match_rule(rules, protocol_name, scan_options, bandwidth):
+    """Tag (abd/thigh) of the first config rule the acquisition matches, else None."""
+    protocol = clean(protocol_name)
+    scanopt = clean(scan_options)
+    bw = float(bandwidth)
+    for rule in rules:
+        if (
+            clean(rule["ProtocolName"]) in protocol
+            and clean(rule["ScanOptions"]) in scanopt
+            and abs(bw - float(rule["PixelBandwidth"])) < 1e-2
+        ):
+            return rule["Tag"]
+    return None
+
+
 class DicomToNiftiSorter:
     def __init__(self, input_root, config_path, user="admin"):
         self.input_root = input_root
@@ -19,9 +40,7 @@ class DicomToNiftiSorter:
         os.makedirs(self.output_root, exist_ok=True)
 
     def clean(self, s):
-        if isinstance(s, MultiValue):
-            s = " ".join(str(item) for item in s)
-        return str(s).strip().lower().replace("+af8-", "_")
+        return clean(s)
 
     def load_config(self):
         with open(self.config_path, "r") as f:
@@ -44,17 +63,10 @@ class DicomToNiftiSorter:
         try:
             with open(json_path, "r") as f:
                 j = json.load(f)
-                protocol = self.clean(j.get("ProtocolName", ""))
-                scanopt = self.clean(j.get("ScanOptions", ""))
-                bw = float(j.get("PixelBandwidth", -1))
-
-                for rule in self.config["rules"]:
-                    if (
-                        self.clean(rule["ProtocolName"]) in protocol
-                        and self.clean(rule["ScanOptions"]) in scanopt
-                        and abs(bw - float(rule["PixelBandwidth"])) < 1e-2
-                    ):
-                        return rule["Tag"]
+                return match_rule(
+                    self.config["rules"],
+                    j.get("ProtocolName", ""), j.get("ScanOptions", ""), j.get("PixelBandwidth", -1),
+                )
         except Exception as e:
             print(f"❌ Failed to read JSON {json_path}: {e}")
         return None
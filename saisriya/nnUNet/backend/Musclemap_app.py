@@ -1,20 +1,40 @@
 from flask import Flask, request, jsonify
-import subprocess
 import sys
 import os
 import base64
+import shutil
+import logging
+from utils.instrumentation import span, collect_spans, rounded
+from utils.metrics import init_metrics, observe_stages
+from utils import cancellation, progress
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+init_metrics(app, "musclemap", ("/musclemap/",))
+cancellation.init_cancellation(app)
+progress.init_progress(app)
 
 # Supported regions
 SUPPORTED_REGIONS = ['thigh', 'abdomen', 'pelvis']
 
 @app.route('/musclemap/<region>', methods=['POST'])
 def run_musclemap(region):
-    region = region.lower()
+    token = request.headers.get(cancellation.HEADER)
+    with collect_spans() as timings, cancellation.cancellable(token), progress.tracked(token):
+        body, status = musclemap_request(region.lower())
+    observe_stages("musclemap", timings)
+    if status == 200:
+        # seconds per pipeline stage, merged into Analysis.stage_timings by the worker
+        body['stage_timings'] = rounded(timings)
+    return jsonify(body), status
+
+def musclemap_request(region):
+    """Run the request; returns ``(body dict, status)``, serialized once by the view."""
 
     if region not in SUPPORTED_REGIONS:
-        return jsonify({'error': f'Invalid region: {region}. Supported regions: {SUPPORTED_REGIONS}'}), 400
+        return {'error': f'Invalid region: {region}. Supported regions: {SUPPORTED_REGIONS}'}, 400
 
     # Get patient ID from either form or JSON
     patient_id = request.form.get('patient_id') or (request.json.get('patient_id') if request.is_json else None) or 'test_case'
@@ -23,13 +43,23 @@ def run_musclemap(region):
     output_folder = os.path.join("/media/tct-bii/DataHDD/saisriya/nnUNet/nnunet_results/musclemap", region, patient_id)
     os.makedirs(output_folder, exist_ok=True)
 
-    processed_files = []
-    errors = []
-
     # Prepare upload folder
     upload_folder = os.path.join("uploads", region, patient_id)
     os.makedirs(upload_folder, exist_ok=True)
 
+    try:
+        return process_uploads(region, upload_folder, output_folder)
+    except cancellation.Cancelled:
+        # partial masks would be returned by the next run of this patient
+        shutil.rmtree(output_folder, ignore_errors=True)
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        logger.info("MuscleMap %s for %s cancelled", region, patient_id)
+        return {'error': 'Request cancelled'}, 409
+
+def process_uploads(region, upload_folder, output_folder):
+    processed_files = []
+    errors = []
+
     # === Handle base64 encoded dicoms ===
     if request.is_json and 'b64_encoded_dicoms' in request.json:
         b64_encoded_dicoms = request.json['b64_encoded_dicoms']
@@ -39,9 +69,11 @@ def run_musclemap(region):
             try:
                 with open(dcm_path, "wb") as f:
                     f.write(base64.b64decode(data))
-                print(f"Decoded and saved: {dcm_path}")
+                logger.debug("Decoded and saved: %s", dcm_path)
 
                 run_musclemap_on_file(dcm_path, region, output_folder, processed_files, errors)
+            except cancellation.Cancelled:
+                raise
             except Exception as e:
                 errors.append({'file': f'I{idx}.dcm', 'error': str(e)})
 
@@ -54,42 +86,43 @@ def run_musclemap(region):
 
             input_path = os.path.join(upload_folder, file.filename)
             file.save(input_path)
-            print(f"File uploaded and saved: {input_path}")
+            logger.debug("File uploaded and saved: %s", input_path)
 
             run_musclemap_on_file(input_path, region, output_folder, processed_files, errors)
 
     else:
-        return jsonify({'error': 'No files or base64 data provided'}), 400
+        return {'error': 'No files or base64 data provided'}, 400
 
     # If any errors during processing
     if errors:
-        return jsonify({
+        return {
             'message': 'Some files failed to process',
             'processed_files': processed_files,
             'errors': errors,
             'output_folder': output_folder
-        }), 500
+        }, 500
 
     # === Convert segmented output files to base64 ===
     encoded_outputs = []
-    for output_file in os.listdir(output_folder):
-        full_path = os.path.join(output_folder, output_file)
-        try:
-            with open(full_path, "rb") as f:
-                encoded_data = base64.b64encode(f.read()).decode('utf-8')
-                encoded_outputs.append({
-                    'filename': output_file,
-                    'b64_data': encoded_data
-                })
-        except Exception as e:
-            errors.append({'file': output_file, 'error': str(e)})
+    with span("base64_encode"):
+        for output_file in os.listdir(output_folder):
+            full_path = os.path.join(output_folder, output_file)
+            try:
+                with open(full_path, "rb") as f:
+                    encoded_data = base64.b64encode(f.read()).decode('utf-8')
+                    encoded_outputs.append({
+                        'filename': output_file,
+                        'b64_data': encoded_data
+                    })
+            except Exception as e:
+                errors.append({'file': output_file, 'error': str(e)})
 
     # Return final output
-    return jsonify({
+    return {
         'message': f'MuscleMap {region} segmentation completed',
         'processed_files': processed_files,
         'encoded_outputs': encoded_outputs
-    })
+    }, 200
 
 # === Helper function to call MuscleMap ===
 def run_musclemap_on_file(input_path, region, output_folder, processed_files, errors):
@@ -105,7 +138,9 @@ def run_musclemap_on_file(input_path, region, output_folder, processed_files, er
         '-g', 'N'
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    cancellation.check()
+    with span("inference", region=region, file=os.path.basename(input_path)):
+        result = cancellation.run(cmd, text=True)
 
     if result.returncode != 0:
         errors.append({'file': os.path.basename(input_path), 'error': result.stderr})
@@ -1,15 +1,27 @@
 import os
+import io
+import shutil
 import base64
+import logging
 import tempfile
 import contextlib
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from utils.dicom_converter import convert_dicom_to_nii as convert_dicom_to_nifti
-from utils.segmentation import process_scan, segmentation_commands
+from utils.segmentation import process_scan, segmentation_commands, case_id
 from utils.converter1 import DicomSegConverter
-from utils.fatPlotTest import genericVolumeAnalysis
+from utils.fatPlotTest import genericVolumeAnalysis, profile_plots, PROFILE_FILENAME
+from utils.plot_render import get_pool, wait_for_plots
 from utils.converter1 import DEFAULT_ABDOMEN_LABEL_MAP, DEFAULT_THIGH_LABEL_MAP
+from utils.instrumentation import span, collect_spans, rounded
+from utils.metrics import init_metrics, observe_stages
+from utils import cancellation, progress
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 DEBUG = os.environ.get("DEBUG_MODE", "True") == "True"
+# Volume graphs are derived from volume_profile.json; only render them when asked
+RENDER_VOLUME_PLOTS = os.environ.get("RENDER_VOLUME_PLOTS", "False") == "True"
 
 NNUNET_BASE = "/media/tct-bii/DataHDD/sriya/saisriya/nnUNet"
 os.environ["nnUNet_raw"] = os.path.join(NNUNET_BASE, "nnunet_raw")
@@ -17,6 +29,11 @@ os.environ["nnUNet_preprocessed"] = os.path.join(NNUNET_BASE, "nnunet_preprocess
 os.environ["nnUNet_results"] = os.path.join(NNUNET_BASE, "nnunet_results")
 
 app = Flask(__name__)
+init_metrics(app, "segment", ("/segment/",))
+cancellation.init_cancellation(app)
+progress.init_progress(app)
+# set up the plot pool with the service, before any request thread runs
+get_pool()
 
 def upload_files(region: str, modality: str):
     tmp_root = "/tmp"
@@ -27,16 +44,18 @@ def upload_files(region: str, modality: str):
     ) as tempdir:
         raw_dicom_dir = os.path.join(tempdir, "original_dicom")
         output_dir = os.path.join(tempdir, "outputs")
+        prediction_dir = os.path.join(tempdir, "predictions")
         os.makedirs(raw_dicom_dir, exist_ok=True)
         os.makedirs(output_dir, exist_ok=True)
-        saved_dicoms, saved_niis = [], []
+        saved_dicoms, saved_niis, saved_predictions = [], [], {}
 
         if request.is_json and 'b64_encoded_dicoms' in request.json:
-            for idx, data in enumerate(request.json['b64_encoded_dicoms']):
-                dicom_path = os.path.join(raw_dicom_dir, f"I{idx}.dcm")
-                with open(dicom_path, "wb") as f:
-                    f.write(base64.b64decode(data))
-                saved_dicoms.append(dicom_path)
+            with span("dicom_decode", count=len(request.json['b64_encoded_dicoms'])):
+                for idx, data in enumerate(request.json['b64_encoded_dicoms']):
+                    dicom_path = os.path.join(raw_dicom_dir, f"I{idx}.dcm")
+                    with open(dicom_path, "wb") as f:
+                        f.write(base64.b64decode(data))
+                    saved_dicoms.append(dicom_path)
         elif 'file' in request.files:
             for f in request.files.getlist('file'):
                 if f and f.filename:
@@ -49,6 +68,13 @@ def upload_files(region: str, modality: str):
                         dicom_path = os.path.join(raw_dicom_dir, f.filename)
                         f.save(dicom_path)
                         saved_dicoms.append(dicom_path)
+            # checkpointed predictions of a retried request, keyed by case
+            for f in request.files.getlist('prediction'):
+                if f and f.filename:
+                    os.makedirs(prediction_dir, exist_ok=True)
+                    prediction_path = os.path.join(prediction_dir, os.path.basename(f.filename))
+                    f.save(prediction_path)
+                    saved_predictions[case_id(prediction_path)] = prediction_path
         else:
             return None
 
@@ -58,10 +84,18 @@ def upload_files(region: str, modality: str):
             'has_dicoms': bool(saved_dicoms),
             'has_nifti': bool(saved_niis),
             'temp_input_dir': tempdir,
-            'temp_output_dir': output_dir
+            'temp_output_dir': output_dir,
+            'predictions': saved_predictions
+        }
+
+def encode_file(path):
+    with open(path, "rb") as f:
+        return {
+            'filename': os.path.basename(path),
+            'b64_data': base64.b64encode(f.read()).decode('utf-8')
         }
 
-def process_request(upload_result, region: str, modality: str):
+def process_request(upload_result, region: str, modality: str, timings=None):
     key = f"{region}_{modality}"
     output_dir = upload_result['temp_output_dir']
     dynamic_results_dir = os.path.join(output_dir, "results")
@@ -70,6 +104,9 @@ def process_request(upload_result, region: str, modality: str):
     segmented_nifti_files, segmented_dcm_files, original_nifti_files = [], [], []
     prediction_csv_b64 = None
     prediction_csv_name = "volume_stats.csv"
+    profile_b64 = None
+    plot_futures = []
+    render_plots = request.args.get("plots", str(RENDER_VOLUME_PLOTS)).lower() in ("1", "true")
 
     if region.lower() == "abdomen":
         label_map = DEFAULT_ABDOMEN_LABEL_MAP
@@ -89,11 +126,12 @@ def process_request(upload_result, region: str, modality: str):
                     'b64_data': base64.b64encode(f.read()).decode('utf-8')
                 })
     elif upload_result['has_dicoms']:
-        nii_files, _ = convert_dicom_to_nifti(
-            upload_result['dicom_folder'],
-            os.path.join(upload_result['temp_input_dir'], "original"),
-            modality
-        )
+        with span("conversion", modality=modality):
+            nii_files, _ = convert_dicom_to_nifti(
+                upload_result['dicom_folder'],
+                os.path.join(upload_result['temp_input_dir'], "original"),
+                modality
+            )
         for nii_path in nii_files:
             with open(nii_path, "rb") as f:
                 original_nifti_files.append({
@@ -105,43 +143,73 @@ def process_request(upload_result, region: str, modality: str):
     else:
         return jsonify({'error': 'No files available for segmentation'}), 400
 
+    predictions = upload_result.get('predictions') or {}
+    predicted_paths = []
     for nii_path in nii_files:
+        cancellation.check()
         try:
-            seg_output_path = process_scan(nii_path, region, modality, {}, segmentation_commands, {key: dynamic_results_dir}, [])
+            checkpointed = predictions.get(case_id(nii_path))
+            if checkpointed:
+                logger.info("Resuming %s from its checkpointed prediction", nii_path)
+                seg_output_path = shutil.copy(checkpointed, dynamic_results_dir)
+            else:
+                seg_output_path = process_scan(nii_path, region, modality, {}, segmentation_commands, {key: dynamic_results_dir}, [])
+            predicted_paths.append(seg_output_path)
 
-            print(f"[DEBUG] Running volume analysis for: {seg_output_path}")
-            print(f"[DEBUG] seg_output_path: {seg_output_path}")
+            logger.debug("Running volume analysis for: %s", seg_output_path)
 
-            genericVolumeAnalysis(seg_output_path, region, dynamic_results_dir)
-            print(f"[DEBUG] Volume analysis complete.")
+            # Plots render on the plot worker pool while the DICOM SEG export runs
+            with span("post_processing", region=region):
+                plot_futures.extend(genericVolumeAnalysis(seg_output_path, region, dynamic_results_dir, render_plots))
+            logger.debug("Volume analysis complete.")
 
             csv_path = os.path.join(dynamic_results_dir, "volume_stats.csv")
             if os.path.exists(csv_path):
                 with open(csv_path, "rb") as f:
                     prediction_csv_b64 = base64.b64encode(f.read()).decode("utf-8")
 
+            profile_path = os.path.join(dynamic_results_dir, PROFILE_FILENAME)
+            if os.path.exists(profile_path):
+                with open(profile_path, "rb") as f:
+                    profile_b64 = base64.b64encode(f.read()).decode("utf-8")
+
             dicom_seg_dir = os.path.join(dynamic_results_dir, 'dicom_seg')
             os.makedirs(dicom_seg_dir, exist_ok=True)
-            converter = DicomSegConverter(
-                input_dir=dynamic_results_dir,
-                dicom_ref=upload_result['dicom_folder'],
-                output_dir=dicom_seg_dir,
-                label_map=label_map,
-                rotate_180=(modality == "CT" and region.lower() == "abdomen")
-            )
-            converter.batch_convert()
+            cancellation.check()
+            with span("seg_export"):
+                converter = DicomSegConverter(
+                    input_dir=dynamic_results_dir,
+                    dicom_ref=upload_result['dicom_folder'],
+                    output_dir=dicom_seg_dir,
+                    label_map=label_map,
+                    rotate_180=(modality == "CT" and region.lower() == "abdomen")
+                )
+                converter.batch_convert()
+        except cancellation.Cancelled:
+            raise
         except Exception as e:
-            return jsonify({'error': f'Segmentation failed for {nii_path}: {str(e)}'}), 500
-
-    for file in os.listdir(dynamic_results_dir):
-        full_path = os.path.join(dynamic_results_dir, file)
-        if file.endswith(('.nii', '.nii.gz')):
-            with open(full_path, "rb") as f:
-                segmented_nifti_files.append({
-                    'filename': file,
-                    'b64_data': base64.b64encode(f.read()).decode('utf-8')
-                })
+            logger.exception("Segmentation failed for %s", nii_path)
+            return jsonify({
+                'error': f'Segmentation failed for {nii_path}: {str(e)}',
+                # outputs of the finished stages; a retry uploads them to skip those stages
+                'checkpoints': {
+                    'conversion': original_nifti_files,
+                    'inference': [encode_file(p) for p in predicted_paths if os.path.exists(p)],
+                },
+            }), 500
+
+    with span("base64_encode"):
+        for file in os.listdir(dynamic_results_dir):
+            full_path = os.path.join(dynamic_results_dir, file)
+            if file.endswith(('.nii', '.nii.gz')):
+                with open(full_path, "rb") as f:
+                    segmented_nifti_files.append({
+                        'filename': file,
+                        'b64_data': base64.b64encode(f.read()).decode('utf-8')
+                    })
 
+    with span("plotting"):
+        wait_for_plots(plot_futures)
     volume_plots = {}
     expected_labels = {
         "abdomen": ["SSAT", "DSAT", "VAT"],
@@ -158,13 +226,14 @@ def process_request(upload_result, region: str, modality: str):
 
     dicom_seg_dir = os.path.join(dynamic_results_dir, 'dicom_seg')
     if os.path.exists(dicom_seg_dir):
-        for seg_file in os.listdir(dicom_seg_dir):
-            full_path = os.path.join(dicom_seg_dir, seg_file)
-            with open(full_path, "rb") as f:
-                segmented_dcm_files.append({
-                    'filename': seg_file,
-                    'b64_data': base64.b64encode(f.read()).decode('utf-8')
-                })
+        with span("base64_encode"):
+            for seg_file in os.listdir(dicom_seg_dir):
+                full_path = os.path.join(dicom_seg_dir, seg_file)
+                with open(full_path, "rb") as f:
+                    segmented_dcm_files.append({
+                        'filename': seg_file,
+                        'b64_data': base64.b64encode(f.read()).decode('utf-8')
+                    })
 
     return jsonify({
         'segmented_nifti_files': segmented_nifti_files,
@@ -174,36 +243,70 @@ def process_request(upload_result, region: str, modality: str):
         'volume_csv': {
             'filename': prediction_csv_name,
             'b64_data': prediction_csv_b64
-        } if prediction_csv_b64 else None
+        } if prediction_csv_b64 else None,
+        'volume_profile': {
+            'filename': PROFILE_FILENAME,
+            'b64_data': profile_b64
+        } if profile_b64 else None,
+        # seconds per pipeline stage, merged into Analysis.stage_timings by the worker
+        'stage_timings': rounded(timings or {})
     })
 
+def segment(region: str, modality: str):
+    token = request.headers.get(cancellation.HEADER)
+    with collect_spans() as timings, cancellation.cancellable(token), progress.tracked(token):
+        upload_result = upload_files(region, modality)
+        if upload_result is None:
+            return jsonify({'error': 'No valid files uploaded'}), 400
+        try:
+            cancellation.check()
+            response = process_request(upload_result, region, modality, timings)
+        except cancellation.Cancelled:
+            # partial outputs are useless, drop them even in DEBUG mode
+            shutil.rmtree(upload_result['temp_input_dir'], ignore_errors=True)
+            logger.info("Segmentation %s cancelled", token)
+            return jsonify({'error': 'Request cancelled'}), 409
+    observe_stages("segment", timings)
+    return response
+
 @app.route('/segment/abdomen-ct', methods=['POST'])
 def segment_abdomen_ct():
-    upload_result = upload_files("Abdomen", "CT")
-    if upload_result is None:
-        return jsonify({'error': 'No valid files uploaded'}), 400
-    return process_request(upload_result, "Abdomen", "CT")
+    return segment("Abdomen", "CT")
 
 @app.route('/segment/abdomen-mr', methods=['POST'])
 def segment_abdomen_mr():
-    upload_result = upload_files("Abdomen", "MRI")
-    if upload_result is None:
-        return jsonify({'error': 'No valid files uploaded'}), 400
-    return process_request(upload_result, "Abdomen", "MRI")
+    return segment("Abdomen", "MRI")
 
 @app.route('/segment/thigh-ct', methods=['POST'])
 def segment_thigh_ct():
-    upload_result = upload_files("Thigh", "CT")
-    if upload_result is None:
-        return jsonify({'error': 'No valid files uploaded'}), 400
-    return process_request(upload_result, "Thigh", "CT")
+    return segment("Thigh", "CT")
 
 @app.route('/segment/thigh-mr', methods=['POST'])
 def segment_thigh_mr():
-    upload_result = upload_files("Thigh", "MRI")
-    if upload_result is None:
-        return jsonify({'error': 'No valid files uploaded'}), 400
-    return process_request(upload_result, "Thigh", "MRI")
+    return segment("Thigh", "MRI")
+
+@app.route('/plots/volume', methods=['POST'])
+def render_volume_plot():
+    """Render one tissue volume graph on demand from a posted volume_profile.json."""
+    profile = request.get_json(silent=True)
+    tissue = request.args.get('tissue')
+    if not profile or 'tissues' not in profile or 'region' not in profile:
+        return jsonify({'error': 'A volume profile is required'}), 400
+    if tissue not in profile['tissues']:
+        return jsonify({'error': f'Unknown tissue: {tissue}'}), 400
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        try:
+            plot_paths = wait_for_plots(profile_plots(
+                {**profile, 'tissues': {tissue: profile['tissues'][tissue]}}, tempdir
+            ))
+        except KeyError:
+            return jsonify({'error': f"Invalid region: {profile['region']}"}), 400
+        if not plot_paths:
+            return jsonify({'error': f'No volume to plot for {tissue}'}), 404
+        with open(plot_paths[0], "rb") as f:
+            png = io.BytesIO(f.read())
+    return send_file(png, mimetype='image/png', download_name=f"{tissue}.png")
 
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
\ No newline at end of file
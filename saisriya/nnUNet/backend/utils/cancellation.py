@@ -0,0 +1,134 @@
+import os
+import re
+import time
+import signal
+import logging
+import tempfile
+import contextlib
+import contextvars
+import subprocess
+from flask import jsonify
+
+logger = logging.getLogger(__name__)
+
+# Clients tag a request with this header (the Django worker sends the analysis
+# id) and cancel it later with POST /cancel/<token>.
+HEADER = "X-Cancel-Token"
+
+# Cancellations are marker files, so they reach the request whichever server
+# process or thread is running it.
+CANCEL_DIR = os.environ.get("CANCEL_DIR", os.path.join(tempfile.gettempdir(), "bfit_cancel"))
+POLL_INTERVAL = 0.5
+# seconds a cancelled subprocess gets between SIGTERM and SIGKILL
+KILL_GRACE = 5
+# markers of requests that never arrived
+MARKER_TTL = 24 * 3600
+
+_TOKEN = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+_current = contextvars.ContextVar("bfit_cancel_token", default=None)
+
+
+class Cancelled(Exception):
+    """The client cancelled the request this work belongs to."""
+
+
+def valid_token(token):
+    return bool(token) and bool(_TOKEN.match(token)) and token not in (".", "..")
+
+
+def _marker(token):
+    return os.path.join(CANCEL_DIR, token)
+
+
+def _prune():
+    cutoff = time.time() - MARKER_TTL
+    with os.scandir(CANCEL_DIR) as entries:
+        for entry in entries:
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+
+def cancel(token):
+    """Mark ``token`` cancelled; its running subprocess is killed within ``POLL_INTERVAL``."""
+    os.makedirs(CANCEL_DIR, exist_ok=True)
+    _prune()
+    with open(_marker(token), "w"):
+        pass
+    logger.info("Cancellation requested for %s", token)
+
+
+def is_cancelled():
+    token = _current.get()
+    return token is not None and os.path.exists(_marker(token))
+
+
+def check():
+    """Raise ``Cancelled`` if the current request was cancelled; call between stages."""
+    if is_cancelled():
+        raise Cancelled(_current.get())
+
+
+@contextlib.contextmanager
+def cancellable(token):
+    """Make ``check`` and ``run`` inside the block honour cancellations of ``token``."""
+    if not valid_token(token):
+        token = None
+    reset = _current.set(token)
+    try:
+        yield
+    finally:
+        _current.reset(reset)
+        if token:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(_marker(token))
+
+
+def _kill(proc):
+    # the command runs in its own session, so this reaches shells' children too
+    for sig, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)):
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(proc.pid, sig)
+        try:
+            proc.communicate(timeout=grace)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run(cmd, check=False, **kwargs):
+    """
+    ``subprocess.run`` with captured output that kills the command's process
+    group and raises ``Cancelled`` when the current request is cancelled.
+    """
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, **kwargs
+    )
+    try:
+        while True:
+            try:
+                stdout, stderr = proc.communicate(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if is_cancelled():
+                    logger.info("Killing cancelled command: %s", proc.args)
+                    _kill(proc)
+                    raise Cancelled(_current.get())
+    except BaseException:
+        if proc.poll() is None:
+            _kill(proc)
+        raise
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stdout, stderr)
+    return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+
+
+def init_cancellation(app):
+    """Register ``POST /cancel/<token>`` on ``app``."""
+
+    @app.route('/cancel/<token>', methods=['POST'])
+    def cancel_request(token):
+        if not valid_token(token):
+            return jsonify({'error': 'Invalid cancel token'}), 400
+        cancel(token)
+        return jsonify({'cancelled': token}), 202
@@ -1,9 +1,13 @@
 import os
 import shutil
-import subprocess
 import pydicom
+import logging
 import tempfile
 from glob import glob
+from utils.instrumentation import span
+from utils import cancellation
+
+logger = logging.getLogger(__name__)
 
 def is_dicom(file_path):
     try:
@@ -13,35 +17,33 @@ def is_dicom(file_path):
         return False
 
 def convert_dicom_to_nii(dicom_input, output_dir, modality):
+    # Create a temporary directory to store NIfTI files
+    temp_output_dir = tempfile.mkdtemp()
     try:
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
-        
-        # Create a temporary directory to store NIfTI files
-        temp_output_dir = tempfile.mkdtemp()
 
-        # Print for debugging: check if the input folder contains files
-        print(f"Checking input folder: {dicom_input}")
-        dicom_files = [f for f in os.listdir(dicom_input) if is_dicom(os.path.join(dicom_input, f))]
-        print(f"Found DICOM files: {dicom_files}")
+        logger.debug("Checking input folder: %s", dicom_input)
+        with span("dicom_decode"):
+            dicom_files = sorted(f for f in os.listdir(dicom_input) if is_dicom(os.path.join(dicom_input, f)))
+        logger.debug("Found %d DICOM files", len(dicom_files))
 
         if not dicom_files:
-            print("No valid DICOM files found.")
+            logger.warning("No valid DICOM files found in %s", dicom_input)
             return None, "No valid DICOM files found in the input folder"
 
         # Run dcm2niix to convert DICOM to NIfTI
-        result = subprocess.run(
-            ['dcm2niix', '-z', 'n', '-o', temp_output_dir, dicom_input],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False
-        )
-        print(f"stdout: {result.stdout.decode()}")
-        print(f"stderr: {result.stderr.decode()}")
+        with span("dcm2niix"):
+            result = cancellation.run(
+                ['dcm2niix', '-z', 'n', '-o', temp_output_dir, dicom_input],
+                check=False
+            )
+        logger.debug("dcm2niix stdout: %s", result.stdout.decode())
+        logger.debug("dcm2niix stderr: %s", result.stderr.decode())
 
         # Collect NIfTI files created by dcm2niix
         nii_files = glob(os.path.join(temp_output_dir, '*.nii'))
-        print(f"Converted NIfTI files: {nii_files}")
+        logger.debug("Converted NIfTI files: %s", nii_files)
         renamed_files = []
 
         if os.path.isfile(dicom_input):
@@ -51,11 +53,7 @@ def convert_dicom_to_nii(dicom_input, output_dir, modality):
             renamed_files.append(target_path)
 
         elif os.path.isdir(dicom_input):
-            dicom_files = sorted([
-                f for f in os.listdir(dicom_input)
-                if is_dicom(os.path.join(dicom_input, f))
-            ])
-            print(f"Valid DICOM files found: {dicom_files}")
+            # dicom_files was already listed and sorted above; no second header scan
             for i, nii_file in enumerate(nii_files):
                 if i < len(dicom_files):
                     base_name = os.path.splitext(dicom_files[i])[0]
@@ -67,6 +65,10 @@ def convert_dicom_to_nii(dicom_input, output_dir, modality):
 
         return renamed_files, f"{len(renamed_files)} NIfTI file(s) created and renamed."
 
+    except cancellation.Cancelled:
+        raise
     except Exception as e:
-        print(f"Error during conversion: {e}")
+        logger.error("Error during conversion: %s", e)
         return None, str(e)
+    finally:
+        shutil.rmtree(temp_output_dir, ignore_errors=True)
@@ -1,10 +1,20 @@
 import os
+import json
+import hashlib
 import numpy as np
 import nibabel as nib
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import logging
+from utils.plot_render import mask_digest, submit_tissue_plots, wait_for_plots
+from utils.instrumentation import span
+
+# Per-region tissue labels and plot colors
+REGION_TISSUES = {
+    "abdomen": ({1: "SSAT", 2: "DSAT", 3: "VAT"}, ["#e41a1c", "#4daf4a", "#377eb8"]),
+    "thigh": ({1: "SSAT", 2: "IMAT", 3: "Muscle"}, ["#ff7f00", "#984ea3", "#377eb8"]),
+}
+
+PROFILE_FILENAME = "volume_profile.json"
 
 def truncate(number, digits) -> float:
     stepper = 10.0 ** digits
@@ -17,62 +27,78 @@ def class_voxel(slice2D):
     unique, counts = np.unique(slice2D, return_counts=True)
     return dict(zip(unique.astype(int), counts))
 
-def tissueVolumeGraph(tissue_labels, volume_slices, class_colors, output_dir):
+def tissueVolumeGraph(tissue_labels, volume_slices, class_colors, output_dir, mask_hash=None, region=""):
+    """Render the per-tissue volume graphs and wait for them (see ``plot_render``)."""
     logging.info("Plotting individual tissue volume graphs")
-    volume_slices = [list(reversed(v)) for v in volume_slices]
-    os.makedirs(output_dir, exist_ok=True)
-
-    for i in range(len(tissue_labels)):
-        volumes = volume_slices[i]
-        if all(v == 0 for v in volumes):
-            logging.warning(f"Skipping {tissue_labels[i]} — all volumes are 0")
-            continue
-
-        fig, ax = plt.subplots(figsize=(4, 5))
-        fig.patch.set_facecolor('black')
-        ax.set_facecolor('black')
-
-        y_vals = list(range(1, len(volumes) + 1))
-        ax.barh(y_vals, volumes, color=class_colors[i])
-        ax.invert_yaxis()
-
-        ax.set_title(f"{tissue_labels[i]} in CC", color='white', fontweight="bold", fontsize=14)
-        ax.tick_params(axis='x', colors='white')
-        ax.tick_params(axis='y', colors='white')
-        ax.xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
-        ax.yaxis.set_major_locator(ticker.MaxNLocator(integer=True))
-
-        for spine in ax.spines.values():
-            spine.set_edgecolor('white')
-            spine.set_linewidth(1.5)
-
-        save_path = os.path.join(output_dir, f"{tissue_labels[i]}.png")
-        plt.tight_layout()
-        plt.savefig(save_path, dpi=300, bbox_inches="tight", facecolor=fig.get_facecolor())
-        plt.close()
-        logging.info(f"Saved individual plot to {save_path}")
-
-def genericVolumeAnalysis(seg_path, region, output_dir):
+    if mask_hash is None:
+        mask_hash = hashlib.sha256(repr(volume_slices).encode()).hexdigest()
+    for path in wait_for_plots(submit_tissue_plots(
+        mask_hash, region, tissue_labels, volume_slices, class_colors, output_dir
+    )):
+        logging.info(f"Saved individual plot to {path}")
+
+def write_volume_profile(path, region, vol_per_voxel, per_slice_volumes):
+    """
+    Store the per-slice tissue volumes (cc, slice 0 first) as a compact JSON profile.
+
+    This is the source of truth for the volume graphs: clients plot it directly
+    and ``profile_plots`` renders PNGs from it on demand.
+    """
+    profile = {
+        "region": region.lower(),
+        "unit": "cc",
+        "voxel_volume_cc": float(vol_per_voxel),
+        "num_slices": len(next(iter(per_slice_volumes.values()), [])),
+        "tissues": {
+            t: np.round(np.asarray(v, dtype=np.float64), 4).tolist()
+            for t, v in per_slice_volumes.items()
+        },
+    }
+    with open(path, "w") as f:
+        json.dump(profile, f, separators=(",", ":"))
+    return path
+
+def profile_plots(profile, output_dir):
+    """Queue the tissue volume graphs for a stored profile; returns plot futures."""
+    region = profile["region"]
+    label_mapping, class_colors = REGION_TISSUES[region]
+    colors = dict(zip(label_mapping.values(), class_colors))
+    tissue_labels = [t for t in label_mapping.values() if t in profile["tissues"]]
+    profile_hash = hashlib.sha256(
+        json.dumps(profile, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+    return submit_tissue_plots(
+        mask_hash=profile_hash,
+        region=region,
+        tissue_labels=tissue_labels,
+        volume_slices=[profile["tissues"][t] for t in tissue_labels],
+        class_colors=[colors[t] for t in tissue_labels],
+        output_dir=output_dir
+    )
+
+def genericVolumeAnalysis(seg_path, region, output_dir, render_plots=True):
+    """
+    Write ``volume_stats.csv`` and ``volume_profile.json`` for ``seg_path``.
+
+    With ``render_plots`` the tissue volume graphs are also queued on the
+    ``plot_render`` worker pool; the returned futures resolve to the PNG paths
+    once the caller needs them (``plot_render.wait_for_plots``).
+    """
     logging.info("genericVolumeAnalysis:: Start")
 
     seg_path = os.path.abspath(seg_path)
     seg_name = os.path.basename(seg_path).replace(".nii.gz", "").replace(".nii", "")
 
-    if region.lower() == "abdomen":
-        label_mapping = {1: "SSAT", 2: "DSAT", 3: "VAT"}
-        class_colors = ["#e41a1c", "#4daf4a", "#377eb8"]
-    elif region.lower() == "thigh":
-        label_mapping = {1: "SSAT", 2: "IMAT", 3: "Muscle"}
-        class_colors = ["#ff7f00", "#984ea3", "#377eb8"]
-    else:
+    if region.lower() not in REGION_TISSUES:
         raise ValueError(f"Unknown region: {region}")
+    label_mapping, class_colors = REGION_TISSUES[region.lower()]
 
     tissue_labels = list(label_mapping.values())
 
     try:
         img = nib.load(seg_path)
         data = img.get_fdata()
-        print(f"[DEBUG] Loaded NIfTI: shape={data.shape}, dtype={data.dtype}")
+        logging.debug("Loaded NIfTI: shape=%s, dtype=%s", data.shape, data.dtype)
     except Exception as e:
         logging.error(f"[ERROR] Failed to load or read NIfTI file {seg_path}: {e}")
         import traceback
@@ -81,44 +107,57 @@ def genericVolumeAnalysis(seg_path, region, output_dir):
 
     pixdim = img.header['pixdim'][1:4]
     if not np.all(pixdim > 0):
-        print(f"[WARN] Invalid pixdim {pixdim} in {seg_path}, using default (1.0 mm³)")
+        logging.warning("Invalid pixdim %s in %s, using default (1.0 mm³)", pixdim, seg_path)
         pixdim = [1.0, 1.0, 1.0]
     vol_per_voxel = pixdim[0] * pixdim[1] * pixdim[2] * 1e-3  # cm³
 
-    print(f"[DEBUG] pixdim: {pixdim}, unique labels: {np.unique(data)}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # np.unique sorts the whole volume, so only pay for it when it is logged
+        logging.debug("pixdim: %s, unique labels: %s", pixdim, np.unique(data))
 
-    slices_2D = SplitTo2D(data)
-    per_slice_volumes = {t: [] for t in tissue_labels}
-    total_volume = []
+    with span("stats", file=seg_name):
+        slices_2D = SplitTo2D(data)
+        per_slice_volumes = {t: [] for t in tissue_labels}
+        total_volume = []
 
-    for slice_2D in slices_2D:
-        cls = class_voxel(slice_2D)
-        slice_total = 0
-        for lbl, tissue in label_mapping.items():
-            vol = cls.get(lbl, 0) * vol_per_voxel
-            per_slice_volumes[tissue].append(vol)
-            slice_total += vol
-        total_volume.append(slice_total)
+        for slice_2D in slices_2D:
+            cls = class_voxel(slice_2D)
+            slice_total = 0
+            for lbl, tissue in label_mapping.items():
+                vol = cls.get(lbl, 0) * vol_per_voxel
+                per_slice_volumes[tissue].append(vol)
+                slice_total += vol
+            total_volume.append(slice_total)
 
-    cls_total = class_voxel(data)
-    tissue_totals = {t: cls_total.get(lbl, 0) * vol_per_voxel for lbl, t in label_mapping.items()}
-    fat_total = sum(tissue_totals.values())
-    tissue_percents = {t: (v / fat_total) * 100 if fat_total > 0 else 0 for t, v in tissue_totals.items()}
+        cls_total = class_voxel(data)
+        tissue_totals = {t: cls_total.get(lbl, 0) * vol_per_voxel for lbl, t in label_mapping.items()}
+        fat_total = sum(tissue_totals.values())
+        tissue_percents = {t: (v / fat_total) * 100 if fat_total > 0 else 0 for t, v in tissue_totals.items()}
 
-    print(f"[DEBUG] tissue_totals: {tissue_totals}")
-    print(f"[DEBUG] tissue_percents: {tissue_percents}")
-    print(f"[DEBUG] per_slice_volumes keys: {list(per_slice_volumes.keys())}")
+    logging.debug("tissue_totals: %s", tissue_totals)
+    logging.debug("tissue_percents: %s", tissue_percents)
 
     os.makedirs(output_dir, exist_ok=True)
     csv_path = os.path.join(output_dir, "volume_stats.csv")
 
     try:
-        tissueVolumeGraph(
-            tissue_labels=tissue_labels,
-            volume_slices=[per_slice_volumes[t] for t in tissue_labels],
-            class_colors=class_colors,
-            output_dir=output_dir
-        )
+        write_volume_profile(os.path.join(output_dir, PROFILE_FILENAME), region, vol_per_voxel, per_slice_volumes)
+    except Exception as e:
+        logging.error(f"[ERROR] Failed to write {PROFILE_FILENAME}: {e}")
+        import traceback
+        traceback.print_exc()
+
+    plot_futures = []
+    try:
+        if render_plots:
+            plot_futures = submit_tissue_plots(
+                mask_hash=mask_digest(seg_path),
+                region=region,
+                tissue_labels=tissue_labels,
+                volume_slices=[per_slice_volumes[t] for t in tissue_labels],
+                class_colors=class_colors,
+                output_dir=output_dir
+            )
     except Exception as e:
         logging.error(f"[ERROR] Failed to generate tissue volume graphs: {e}")
         import traceback
@@ -143,3 +182,4 @@ def genericVolumeAnalysis(seg_path, region, output_dir):
         traceback.print_exc()
 
     logging.info("genericVolumeAnalysis:: Done")
+    return plot_futures
@@ -0,0 +1,72 @@
+import time
+import json
+import logging
+import functools
+import contextlib
+import contextvars
+
+from utils import progress
+
+# One JSON line per finished span, e.g.
+#   {"span": "inference", "duration_s": 41.237, "region": "Abdomen"}
+logger = logging.getLogger("bfit.timing")
+
+_collector = contextvars.ContextVar("bfit_span_collector", default=None)
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """
+    Time the enclosed block as ``name``.
+
+    Entering a span named after a pipeline stage publishes it as the request's
+    live stage (``utils.progress``). The duration is logged as a structured line on ``bfit.timing`` and added to
+    the active ``collect_spans`` dict (durations of repeated spans are summed).
+    Extra keyword arguments are included in the log line.
+    """
+    progress.enter(name)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        collected = _collector.get()
+        if collected is not None:
+            collected[name] = collected.get(name, 0.0) + duration
+        if logger.isEnabledFor(logging.INFO):
+            record = {"span": name, "duration_s": round(duration, 4), **fields}
+            if error:
+                record["error"] = error
+            logger.info(json.dumps(record, default=str))
+
+
+def timed(name=None):
+    """Decorator form of ``span``; defaults to the function's name."""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def collect_spans():
+    """Collect ``{span name: total seconds}`` for everything timed in this context."""
+    collected = {}
+    token = _collector.set(collected)
+    try:
+        yield collected
+    finally:
+        _collector.reset(token)
+
+
+def rounded(collected, digits=3):
+    return {name: round(seconds, digits) for name, seconds in collected.items()}
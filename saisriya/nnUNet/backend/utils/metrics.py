@@ -0,0 +1,65 @@
+import time
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+
+# Requests wrap DICOM conversion, nnUNet/MuscleMap inference and SEG export
+REQUEST_BUCKETS = (1, 5, 10, 30, 60, 120, 180, 300, 450, 600, 900, 1200, 1800)
+STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+REQUEST_LATENCY = Histogram(
+    "bfit_inference_request_seconds", "Inference service request latency",
+    ["service", "endpoint", "status"], buckets=REQUEST_BUCKETS,
+)
+IN_PROGRESS = Gauge(
+    "bfit_inference_requests_in_progress", "Inference requests currently being served",
+    ["service", "endpoint"],
+)
+STAGE_DURATION = Histogram(
+    "bfit_inference_stage_seconds", "Time per pipeline stage inside the inference service",
+    ["service", "stage"], buckets=STAGE_BUCKETS,
+)
+
+
+def observe_stages(service, timings):
+    """Record the ``{stage: seconds}`` collected by ``instrumentation.collect_spans``."""
+    for stage, seconds in timings.items():
+        STAGE_DURATION.labels(service, stage).observe(seconds)
+
+
+def init_metrics(app, service, prefixes):
+    """
+    Time every request whose path starts with one of ``prefixes`` and expose
+    all metrics on ``GET /metrics``.
+    """
+    prefixes = tuple(prefixes)
+
+    def endpoint():
+        # the URL rule, not the raw path, keeps label cardinality bounded
+        return request.url_rule.rule if request.url_rule else "unmatched"
+
+    @app.before_request
+    def start_timer():
+        if request.path.startswith(prefixes):
+            g.metrics_start = time.perf_counter()
+            IN_PROGRESS.labels(service, endpoint()).inc()
+
+    def finish(status):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return
+        IN_PROGRESS.labels(service, endpoint()).dec()
+        REQUEST_LATENCY.labels(service, endpoint(), str(status)).observe(time.perf_counter() - start)
+
+    @app.after_request
+    def record_request(response):
+        finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failure(exc):
+        # only reached with a pending timer when the view raised
+        finish(500)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
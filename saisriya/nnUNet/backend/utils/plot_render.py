@@ -0,0 +1,278 @@
+import os
+import io
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# Headless backend, selected once before pyplot is imported anywhere in the service
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
+
+PLOT_CACHE_DIR = os.environ.get(
+    "PLOT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bfit_plot_cache")
+)
+PLOT_WORKERS = int(os.environ.get("PLOT_WORKERS", "2"))
+# The cache is trimmed to this size, least recently used PNGs first,
+# at most once per PLOT_CACHE_PRUNE_INTERVAL seconds
+PLOT_CACHE_MAX_BYTES = int(os.environ.get("PLOT_CACHE_MAX_BYTES", str(512 << 20)))
+PLOT_CACHE_PRUNE_INTERVAL = int(os.environ.get("PLOT_CACHE_PRUNE_INTERVAL", "600"))
+
+# === Plot styles ===
+# The resolved style is hashed into the cache key, so editing an entry invalidates its PNGs
+
+PLOT_STYLES = {
+    "tissue_dark": {
+        "figsize": (4, 5),
+        "dpi": 300,
+        "facecolor": "black",
+        "fgcolor": "white",
+        "title_fontsize": 14,
+        "spine_width": 1.5,
+    },
+    "slice_panel": {
+        "figsize": (16, 6),
+        "dpi": 100,
+        "colors": ["red", "green", "blue", "yellow"],
+    },
+}
+
+_pool = None
+_last_prune = 0.0
+_templates = {}  # (kind, key, style) -> (fig, axes), one set per worker process
+
+
+def get_pool():
+    """
+    The plot worker pool. Workers are spawned, not forked: the service is
+    threaded and holds torch/CUDA locks a forked child could inherit locked.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=PLOT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+# === Cache helpers ===
+
+def mask_digest(seg_path, chunk_size=1 << 20):
+    """Content hash of a segmentation file, used as the mask part of the cache key."""
+    h = hashlib.sha256()
+    with open(seg_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(mask_hash, region, name, style, color=None):
+    """Cache file of a plot; keyed on everything that changes its pixels."""
+    params = json.dumps([PLOT_STYLES[style], color], sort_keys=True, default=str)
+    key = hashlib.sha256(
+        f"{mask_hash}:{region.lower()}:{name}:{style}:{params}".encode()
+    ).hexdigest()
+    return os.path.join(PLOT_CACHE_DIR, key[:2], f"{key}.png")
+
+
+def copy_cached(mask_hash, region, name, style, output_path, color=None):
+    """Copy a previously rendered plot to ``output_path``; returns False on a cache miss."""
+    cached = cache_path(mask_hash, region, name, style, color)
+    try:
+        shutil.copyfile(cached, output_path)
+    except FileNotFoundError:
+        return False
+    os.utime(cached)  # mtime doubles as last use for prune_cache
+    return True
+
+
+def prune_cache(max_bytes=PLOT_CACHE_MAX_BYTES):
+    """Delete the least recently used cached PNGs until the cache fits in ``max_bytes``."""
+    entries, total = [], 0
+    for dirpath, _, filenames in os.walk(PLOT_CACHE_DIR):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _maybe_prune():
+    global _last_prune
+    now = time.monotonic()
+    if now - _last_prune >= PLOT_CACHE_PRUNE_INTERVAL:
+        _last_prune = now
+        try:
+            prune_cache()
+        except OSError as e:
+            logging.warning(f"Plot cache prune failed: {e}")
+
+
+def _store(png_bytes, cached_path, output_path):
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    # Write then rename so concurrent readers never see a partial PNG
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cached_path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(png_bytes)
+    os.replace(tmp_path, cached_path)
+    shutil.copyfile(cached_path, output_path)
+    return output_path
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+# === Figure templates ===
+
+def _tissue_template(tissue, style):
+    key = ("tissue", tissue, style)
+    if key not in _templates:
+        s = PLOT_STYLES[style]
+        fig, ax = plt.subplots(figsize=s["figsize"])
+        fig.patch.set_facecolor(s["facecolor"])
+        ax.set_facecolor(s["facecolor"])
+        ax.set_title(f"{tissue} in CC", color=s["fgcolor"], fontweight="bold", fontsize=s["title_fontsize"])
+        ax.tick_params(axis='x', colors=s["fgcolor"])
+        ax.tick_params(axis='y', colors=s["fgcolor"])
+        ax.xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
+        ax.yaxis.set_major_locator(ticker.MaxNLocator(integer=True))
+        for spine in ax.spines.values():
+            spine.set_edgecolor(s["fgcolor"])
+            spine.set_linewidth(s["spine_width"])
+        _templates[key] = (fig, ax)
+    return _templates[key]
+
+
+def _panel_template(label_names, style):
+    key = ("panel", tuple(label_names), style)
+    if key not in _templates:
+        s = PLOT_STYLES[style]
+        fig, axs = plt.subplots(1, len(label_names), figsize=s["figsize"], sharey=True)
+        for idx, name in enumerate(label_names):
+            axs[idx].set_title(f"{name} in CC")
+            axs[idx].set_xlabel("Volume (cc)")
+        axs[0].set_ylabel("Slice Index")
+        _templates[key] = (fig, axs)
+    return _templates[key]
+
+
+def _reset_bars(ax):
+    for container in list(ax.containers):
+        container.remove()
+
+
+# === Renderers (run inside the pool) ===
+
+def render_tissue_png(volumes, tissue, color, style="tissue_dark"):
+    s = PLOT_STYLES[style]
+    fig, ax = _tissue_template(tissue, style)
+    _reset_bars(ax)
+
+    ax.barh(range(1, len(volumes) + 1), volumes, color=color)
+    ax.relim()
+    ax.autoscale_view()
+    if not ax.yaxis_inverted():
+        ax.invert_yaxis()
+
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=s["dpi"], bbox_inches="tight", facecolor=fig.get_facecolor())
+    return buf.getvalue()
+
+
+def render_slice_panel_png(volumes, label_names, style="slice_panel"):
+    s = PLOT_STYLES[style]
+    fig, axs = _panel_template(label_names, style)
+    for idx, vol_list in enumerate(volumes):
+        _reset_bars(axs[idx])
+        axs[idx].barh(range(len(vol_list)), vol_list, color=s["colors"][idx % len(s["colors"])])
+        axs[idx].relim()
+        axs[idx].autoscale_view()
+        if not axs[idx].yaxis_inverted():
+            axs[idx].invert_yaxis()  # slice 0 at top
+
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=s["dpi"])
+    return buf.getvalue()
+
+
+def _render_tissue_to_file(volumes, tissue, color, style, cached_path, output_path):
+    return _store(render_tissue_png(volumes, tissue, color, style), cached_path, output_path)
+
+
+def _render_panel_to_file(volumes, label_names, style, cached_path, output_path):
+    return _store(render_slice_panel_png(volumes, label_names, style), cached_path, output_path)
+
+
+# === Public API ===
+
+def submit_tissue_plots(mask_hash, region, tissue_labels, volume_slices, class_colors,
+                        output_dir, style="tissue_dark"):
+    """
+    Queue one ``<tissue>.png`` per tissue in ``output_dir`` on the plot worker pool.
+
+    Plots already rendered for the same mask, region, style and color are copied
+    from the cache instead of being redrawn. Returns a list of futures resolving to PNG paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    _maybe_prune()
+    futures = []
+    for tissue, volumes, color in zip(tissue_labels, volume_slices, class_colors):
+        if all(v == 0 for v in volumes):
+            logging.warning(f"Skipping {tissue} — all volumes are 0")
+            continue
+
+        output_path = os.path.join(output_dir, f"{tissue}.png")
+        if copy_cached(mask_hash, region, tissue, style, output_path, color):
+            futures.append(_done(output_path))
+            continue
+
+        futures.append(get_pool().submit(
+            _render_tissue_to_file,
+            [float(v) for v in reversed(volumes)], tissue, color, style,
+            cache_path(mask_hash, region, tissue, style, color), output_path,
+        ))
+    return futures
+
+
+def submit_slice_panel(mask_hash, region, label_names, volumes, output_path, style="slice_panel"):
+    """Queue the slice panel; callers check ``copy_cached`` before computing ``volumes``."""
+    _maybe_prune()
+    return get_pool().submit(
+        _render_panel_to_file,
+        [[float(v) for v in vol_list] for vol_list in volumes], list(label_names), style,
+        cache_path(mask_hash, region, "slice_panel", style), output_path,
+    )
+
+
+def wait_for_plots(futures):
+    """Block until all plot futures finish; failures are logged, not raised."""
+    paths = []
+    for future in futures:
+        try:
+            paths.append(future.result())
+        except Exception as e:
+            logging.error(f"[ERROR] Failed to render plot: {e}")
+    return paths
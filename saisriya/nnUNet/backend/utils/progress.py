@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import contextlib
+import contextvars
+from flask import jsonify
+
+from utils.cancellation import valid_token, MARKER_TTL
+
+logger = logging.getLogger(__name__)
+
+# Pipeline stages a client can follow while its request runs, polled with
+# GET /progress/<token> (the same token as cancellations). They match the
+# Analysis.Stage values of the Django worker and the span names timing them.
+STAGES = ("conversion", "windowing", "inference", "post_processing", "seg_export")
+
+# One JSON file per running request, so any server process can answer the poll.
+PROGRESS_DIR = os.environ.get("PROGRESS_DIR", os.path.join(tempfile.gettempdir(), "bfit_progress"))
+
+_current = contextvars.ContextVar("bfit_progress_token", default=None)
+
+
+def _state_path(token):
+    return os.path.join(PROGRESS_DIR, f"{token}.json")
+
+
+def _prune():
+    # states of requests whose server process died before cleaning up
+    cutoff = time.time() - MARKER_TTL
+    with os.scandir(PROGRESS_DIR) as entries:
+        for entry in entries:
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+
+@contextlib.contextmanager
+def tracked(token):
+    """Publish the stages entered inside the block under ``token``."""
+    if not valid_token(token):
+        token = None
+    if token:
+        os.makedirs(PROGRESS_DIR, exist_ok=True)
+        _prune()
+    reset = _current.set(token)
+    try:
+        yield
+    finally:
+        _current.reset(reset)
+        if token:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(_state_path(token))
+
+
+def enter(stage):
+    """Record that the current request entered ``stage``; other names are ignored."""
+    token = _current.get()
+    if token is None or stage not in STAGES:
+        return
+    # write then rename so a poll never reads a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=PROGRESS_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"stage": stage, "started_at": time.time()}, f)
+    os.replace(tmp_path, _state_path(token))
+
+
+def init_progress(app):
+    """Register ``GET /progress/<token>`` on ``app``."""
+
+    @app.route('/progress/<token>', methods=['GET'])
+    def request_progress(token):
+        if not valid_token(token):
+            return jsonify({'error': 'Invalid progress token'}), 400
+        try:
+            with open(_state_path(token)) as f:
+                return jsonify(json.load(f))
+        except FileNotFoundError:
+            # not started yet, finished, or no stage entered so far
+            return jsonify({'stage': None}), 404
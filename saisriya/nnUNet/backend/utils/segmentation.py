@@ -3,24 +3,29 @@ import shutil
 import subprocess
 import tempfile
 import gzip
+import logging
 from typing import Dict, Tuple
 import nibabel as nib
+from utils.instrumentation import span
+from utils import cancellation
+
+logger = logging.getLogger(__name__)
 
 # === CT Windowing ===
 def run_windowing_script(input_file: str, wc: str, ww: str, target_min: str, target_max: str):
     script_path = os.path.join(os.path.dirname(__file__), "window_ct_images.py")
     try:
-        print(f"[DEBUG] Windowing command: python {script_path} {input_file} {wc} {ww} {target_min} {target_max}")
-        result = subprocess.run(
-            ["python", script_path, input_file, wc, ww, target_min, target_max],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        print(f"[STDOUT] {result.stdout}")
-        print(f"[STDERR] {result.stderr}")
+        logger.debug("Windowing command: python %s %s %s %s %s %s", script_path, input_file, wc, ww, target_min, target_max)
+        with span("windowing", file=os.path.basename(input_file)):
+            result = cancellation.run(
+                ["python", script_path, input_file, wc, ww, target_min, target_max],
+                text=True,
+                check=True
+            )
+        logger.debug("Windowing stdout: %s", result.stdout)
+        logger.debug("Windowing stderr: %s", result.stderr)
     except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Windowing failed:\nSTDOUT: {e.stdout}\nSTDERR: {e.stderr}")
+        logger.error("Windowing failed:\nSTDOUT: %s\nSTDERR: %s", e.stdout, e.stderr)
         raise RuntimeError("CT windowing failed")
 
 # === Compress .nii to .nii.gz if needed ===
@@ -30,15 +35,25 @@ def compress_nii_to_nii_gz(input_path: str) -> str:
 
     compressed_path = input_path + ".gz"
     if os.path.exists(compressed_path):
-        print(f"[INFO] Using existing compressed file: {compressed_path}")
+        logger.info("Using existing compressed file: %s", compressed_path)
         return compressed_path
 
-    print(f"[INFO] Compressing .nii to .nii.gz: {input_path} → {compressed_path}")
-    img = nib.load(input_path)
-    print(img.header)
-    nib.save(img, compressed_path)
+    logger.info("Compressing .nii to .nii.gz: %s → %s", input_path, compressed_path)
+    with span("compress_nii"):
+        img = nib.load(input_path)
+        logger.debug("%s", img.header)
+        nib.save(img, compressed_path)
     return compressed_path
 
+def case_id(path: str) -> str:
+    """nnUNet case name of a volume; its prediction is saved as ``<case_id>.nii.gz``."""
+    name = os.path.basename(path)
+    for ext in (".nii.gz", ".nii"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name.replace(".", "_")
+
 # === Segmentation Command Executor ===
 def run_segmentation_command(file_path: str, region: str, modality: str,
                              segmentation_commands: Dict[Tuple[str, str], str],
@@ -52,35 +67,37 @@ def run_segmentation_command(file_path: str, region: str, modality: str,
 
     # Ensure nnUNet input is .nii.gz
     nii_gz_path = compress_nii_to_nii_gz(file_path)
-    case_id = os.path.basename(nii_gz_path).replace(".nii.gz", "").replace(".", "_")
-    print(f"[DEBUG] Final case name used: {case_id}")
+    case = case_id(nii_gz_path)
     input_dir = tempfile.mkdtemp()
-    case_dir = os.path.join(input_dir, case_id)
-    os.makedirs(case_dir, exist_ok=True)
-    final_input_path = os.path.join(case_dir, f"{case_id}_0000.nii.gz")
-    shutil.copyfile(nii_gz_path, final_input_path)
-
-    # Run nnUNet command
-    command = command_template.format(input_file=case_dir, output_dir=output_folder)
-    print(f"[DEBUG] Final case name used: {case_id}")
-    print(f"[DEBUG] Input dir for nnUNet: {input_dir}")
-    print(f"[DEBUG] Case dir: {case_dir}")
-    print(f"[DEBUG] Case file: {final_input_path}")
-    print(f"[DEBUG] Running segmentation command: {command}")
-
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    print("stdout:", result.stdout)
-    print("stderr:", result.stderr)
+    try:
+        case_dir = os.path.join(input_dir, case)
+        os.makedirs(case_dir, exist_ok=True)
+        final_input_path = os.path.join(case_dir, f"{case}_0000.nii.gz")
+        shutil.copyfile(nii_gz_path, final_input_path)
+
+        # Run nnUNet command
+        command = command_template.format(input_file=case_dir, output_dir=output_folder)
+        logger.debug("Final case name used: %s", case)
+        logger.debug("Input dir for nnUNet: %s, case file: %s", input_dir, final_input_path)
+        logger.debug("Running segmentation command: %s", command)
+
+        with span("inference", region=region, modality=modality):
+            # killed together with its workers if the request is cancelled
+            result = cancellation.run(command, shell=True, text=True)
+    finally:
+        shutil.rmtree(input_dir, ignore_errors=True)
+    logger.debug("nnUNet stdout: %s", result.stdout)
+    logger.debug("nnUNet stderr: %s", result.stderr)
 
     # Corrected output path
-    predicted_gz = os.path.join(output_folder, f"{case_id}.nii.gz")
-    predicted_nii = os.path.join(output_folder, f"{case_id}.nii")
+    predicted_gz = os.path.join(output_folder, f"{case}.nii.gz")
+    predicted_nii = os.path.join(output_folder, f"{case}.nii")
 
     if os.path.exists(predicted_gz):
-        print(f"[DEBUG] predicted_gz: {predicted_gz}")
+        logger.debug("predicted_gz: %s", predicted_gz)
         return predicted_gz
     elif os.path.exists(predicted_nii):
-        print(f"[DEBUG] predicted_nii: {predicted_nii}")
+        logger.debug("predicted_nii: %s", predicted_nii)
         return predicted_nii
     else:
         raise FileNotFoundError(f"Segmentation output not found: {predicted_gz} or {predicted_nii}")
@@ -92,7 +109,7 @@ def process_scan(file_path: str, region: str, modality: str, directories: Dict[s
                  output_folders: Dict[str, str],
                  summary_rows: list) -> str:
 
-    print(f"🔍 Processing: {file_path}")
+    logger.info("Processing: %s", file_path)
 
     if modality.upper() == "CT":
         wc = "0"
@@ -31,7 +31,8 @@ def get_label_dict(region):
 
 def load_segmentation(seg_path):
     seg_img = nib.load(seg_path)
-    seg_data = seg_img.get_fdata()
+    # Read labels in their stored dtype instead of upcasting to float64
+    seg_data = np.asanyarray(seg_img.dataobj)
 
     # Handle possible shape issues
     if seg_data.ndim == 3 and seg_data.shape[2] == 1:
@@ -40,13 +41,126 @@ def load_segmentation(seg_path):
     if seg_data.ndim == 4 and seg_data.shape[0] <= 10:
         seg_data = np.argmax(seg_data, axis=0)
 
+    if not np.issubdtype(seg_data.dtype, np.integer):
+        seg_data = np.rint(seg_data).astype(np.int32)
+
     return seg_data
 
+# === Grouped per-label statistics ===
+
+def label_statistics(seg_data, labels, ct_data=None):
+    """
+    Compute voxel counts and (optionally) HU moments for every label in one sweep.
+
+    Voxels outside ``labels`` are dropped once, then counts, sums and squared
+    deviations are accumulated with ``np.bincount``. Min, median and max are read
+    off a single sort of the remaining voxels ordered by (label, value).
+
+    Returns a dict of label -> {"num_voxels", and if ct_data is given
+    "mean", "median", "std", "min", "max"}.
+    """
+    labels = np.asarray(sorted(labels), dtype=np.int64)
+    n_bins = int(labels.max()) + 1 if labels.size else 1
+
+    seg_flat = seg_data.reshape(-1)
+    keep = np.isin(seg_flat, labels)
+    lab = seg_flat[keep].astype(np.intp)
+    counts = np.bincount(lab, minlength=n_bins)
+
+    stats = {int(l): {"num_voxels": int(counts[l])} for l in labels}
+    if ct_data is None or lab.size == 0:
+        return stats
+
+    values = ct_data.reshape(-1)[keep]
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(np.float32)
+
+    safe_counts = np.maximum(counts, 1)
+    means = np.bincount(lab, weights=values, minlength=n_bins) / safe_counts
+    sq_dev = np.bincount(lab, weights=(values - means[lab]) ** 2, minlength=n_bins)
+    stds = np.sqrt(sq_dev / safe_counts)
+
+    # Sort by label, then by value, so each label is a contiguous sorted segment
+    sorted_values = values[np.lexsort((values, lab))]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    for l in labels:
+        n = int(counts[l])
+        if n == 0:
+            continue
+        seg = sorted_values[starts[l]:ends[l]]
+        mid = n // 2
+        median = seg[mid] if n % 2 else (float(seg[mid - 1]) + float(seg[mid])) / 2.0
+        stats[int(l)].update(
+            mean=float(means[l]),
+            median=float(median),
+            std=float(stds[l]),
+            min=float(seg[0]),
+            max=float(seg[-1]),
+        )
+
+    return stats
+
 # === Main volume analysis function ===
 
-def run_volume_analysis(ct_dir, seg_dir, output_csv, region, modality):
+def analyze_case(ct_path, seg_path, region, modality):
     label_dict = get_label_dict(region)
-    results = []
+    ct_filename = os.path.basename(ct_path)
+
+    ct_img = nib.load(ct_path)
+    seg_data = load_segmentation(seg_path)
+
+    # Only apply HU analysis for Abdomen CT
+    with_hu = modality == "CT" and region == "Abdomen"
+    ct_data = ct_img.get_fdata(dtype=np.float32) if with_hu else None
+    shape = ct_img.shape
+
+    vx, vy, vz = ct_img.header.get_zooms()[:3]
+    voxel_volume = vx * vy * vz
+
+    entry = {
+        "Filename": ct_filename,
+        "Vx_mm": round(vx, 3),
+        "Vy_mm": round(vy, 3),
+        "Vz_mm": round(vz, 3),
+        "No_x": shape[0],
+        "No_y": shape[1],
+        "No_z": shape[2],
+    }
+
+    stats = label_statistics(seg_data, label_dict.keys(), ct_data)
+
+    for label, region_name in label_dict.items():
+        label_stats = stats[label]
+        num_voxels = label_stats["num_voxels"]
+        if num_voxels == 0:
+            continue
+
+        vol_cc = (num_voxels * voxel_volume) / 1000.0
+        area_mm2 = num_voxels * vx * vy
+
+        entry[f"{region_name}_num_voxels"] = int(num_voxels)
+        entry[f"{region_name}_Vol_cc"] = round(vol_cc, 3)
+        entry[f"{region_name}_Area_mm2"] = round(area_mm2, 3)
+
+        if with_hu:
+            entry[f"{region_name}_Mean_HU"] = round(label_stats["mean"], 3)
+            entry[f"{region_name}_Median_HU"] = round(label_stats["median"], 3)
+            entry[f"{region_name}_Std_HU"] = round(label_stats["std"], 3)
+            entry[f"{region_name}_Min_HU"] = round(label_stats["min"], 3)
+            entry[f"{region_name}_Max_HU"] = round(label_stats["max"], 3)
+
+    return entry
+
+
+def run_volume_analysis(ct_dir, seg_dir, output_csv, region, modality):
+    """
+    Analyze every CT/segmentation pair found in ``ct_dir``/``seg_dir``, one case
+    after the other in the calling process (offline batch use; the service
+    analyses its single case through fatPlotTest).
+    """
+    get_label_dict(region)  # fail fast on an unknown region
 
     # Support both .nii and .nii.gz
     ct_files = sorted(glob(os.path.join(ct_dir, "*.nii*")))
@@ -57,6 +171,7 @@ def run_volume_analysis(ct_dir, seg_dir, output_csv, region, modality):
         os.path.basename(f).replace(".nii.gz", "").replace(".nii", ""): f for f in seg_files
     }
 
+    cases = []
     for ct_path in ct_files:
         ct_filename = os.path.basename(ct_path)
         subject_prefix = ct_filename.replace(".nii.gz", "").replace(".nii", "")
@@ -72,47 +187,9 @@ def run_volume_analysis(ct_dir, seg_dir, output_csv, region, modality):
             continue
 
         print(f"✅ Processing {ct_filename} with segmentation {os.path.basename(seg_path)}")
+        cases.append((ct_path, seg_path))
 
-        ct_img = nib.load(ct_path)
-        ct_data = ct_img.get_fdata()
-        seg_data = load_segmentation(seg_path)
-
-        vx, vy, vz = ct_img.header.get_zooms()
-        voxel_volume = vx * vy * vz
-
-        entry = {
-            "Filename": ct_filename,
-            "Vx_mm": round(vx, 3),
-            "Vy_mm": round(vy, 3),
-            "Vz_mm": round(vz, 3),
-            "No_x": ct_data.shape[0],
-            "No_y": ct_data.shape[1],
-            "No_z": ct_data.shape[2],
-        }
-
-        for label, region_name in label_dict.items():
-            mask = seg_data == label
-            num_voxels = np.sum(mask)
-            if num_voxels == 0:
-                continue
-
-            vol_cc = (num_voxels * voxel_volume) / 1000.0
-            area_mm2 = num_voxels * vx * vy
-
-            entry[f"{region_name}_num_voxels"] = int(num_voxels)
-            entry[f"{region_name}_Vol_cc"] = round(vol_cc, 3)
-            entry[f"{region_name}_Area_mm2"] = round(area_mm2, 3)
-
-            # Only apply HU analysis for Abdomen CT
-            if modality == "CT" and region == "Abdomen":
-                hu_values = ct_data[mask]
-                entry[f"{region_name}_Mean_HU"] = round(np.mean(hu_values), 3)
-                entry[f"{region_name}_Median_HU"] = round(np.median(hu_values), 3)
-                entry[f"{region_name}_Std_HU"] = round(np.std(hu_values), 3)
-                entry[f"{region_name}_Min_HU"] = round(np.min(hu_values), 3)
-                entry[f"{region_name}_Max_HU"] = round(np.max(hu_values), 3)
-
-        results.append(entry)
+    results = [analyze_case(ct, seg, region, modality) for ct, seg in cases]
 
     if not results:
         print("⚠️ No volumes calculated!")
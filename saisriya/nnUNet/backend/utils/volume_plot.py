@@ -1,7 +1,7 @@
 import os
 import nibabel as nib
 import numpy as np
-import matplotlib.pyplot as plt
+from utils.plot_render import copy_cached, mask_digest, submit_slice_panel
 
 ABDOMEN_LABEL_DICT = {
     1: "SSAT",
@@ -24,8 +24,12 @@ def get_label_dict(region):
     else:
         raise ValueError(f"Unknown region: {region}")
 
-def plot_fat_volume_per_slice(seg_path, region, output_path):
+def plot_fat_volume_per_slice(seg_path, region, output_path, wait=True):
     label_dict = get_label_dict(region)
+    mask_hash = mask_digest(seg_path)
+    if copy_cached(mask_hash, region, "slice_panel", "slice_panel", output_path):
+        return output_path
+
     seg_img = nib.load(seg_path)
     seg_data = seg_img.get_fdata()
     spacing = seg_img.header.get_zooms()  # (vx, vy, vz)
@@ -48,17 +52,14 @@ def plot_fat_volume_per_slice(seg_path, region, output_path):
             vol_cc = count * voxel_volume_cc
             volumes[label].append(vol_cc)
 
-    # === Plot individual horizontal bar plots ===
-    fig, axs = plt.subplots(1, len(volumes), figsize=(16, 6), sharey=True)
-    colors = ['red', 'green', 'blue', 'yellow']
-    for idx, (label, vol_list) in enumerate(volumes.items()):
-        axs[idx].barh(range(z_slices), vol_list, color=colors[idx])
-        axs[idx].set_title(f"{label_dict[label]} in CC")
-        axs[idx].invert_yaxis()  # slice 0 at top
-        axs[idx].set_xlabel("Volume (cc)")
-        if idx == 0:
-            axs[idx].set_ylabel("Slice Index")
-
-    plt.tight_layout()
-    plt.savefig(output_path)
-    plt.close()
+    # === Individual horizontal bar plots, rendered on the plot worker pool ===
+    future = submit_slice_panel(
+        mask_hash,
+        region,
+        [label_dict[label] for label in volumes],
+        list(volumes.values()),
+        output_path,
+    )
+    if not wait:
+        return future
+    return future.result()